@@ -0,0 +1,165 @@
+""" A benchmark of the tail latency mode of completions against a local fake Open AI server that injects latency.
+    Most responses take a short, log-normally distributed time while a small share is delayed by a long tail, as a congested upstream would.
+    The same requests are sent without and with hedging, and the p50/p95/p99 latency, the extra requests and the hedging events are reported.
+    Run from the project root: python benchmarks/hedging_benchmark.py --requests 400 --tail-probability 0.05 --tail-latency 2 --json hedging.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import openai
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+src_path = os.path.abspath(os.path.join(project_root, "src"))
+sys.path.insert(0, src_path)
+
+from gpt_utils import GPT_UTILS
+from telemetry_utils import llm_telemetry
+
+
+class FAKE_OPENAI_SERVER:
+    """ A class to serve chat completions locally with injected latency. Every request sleeps for a log-normal base latency
+        around the median, or for the tail latency with the tail probability. Requests of the slow model are also delayed by the tail latency.
+    """
+
+    def __init__(self, median_latency: float, tail_probability: float, tail_latency: float, slow_model: str=None, seed: int=0) -> None:
+        self.median_latency = median_latency
+        self.tail_probability = tail_probability
+        self.tail_latency = tail_latency
+        self.slow_model = slow_model
+        self.rng = random.Random(seed)
+        self.requests = {}  # Number of requests received per model
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.api_base = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def _latency(self, model: str) -> float:
+        with self._lock:
+            self.requests[model] = self.requests.get(model, 0) + 1
+            latency = self.median_latency * self.rng.lognormvariate(0, 0.25)
+            if model == self.slow_model or self.rng.random() < self.tail_probability:
+                latency += self.tail_latency
+        return latency
+
+    def _handler(self):
+        fake_server = self
+
+        class HANDLER(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                time.sleep(fake_server._latency(body["model"]))
+                response = json.dumps({
+                    "id": "fake", "object": "chat.completion", "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "A fake answer."}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 20, "completion_tokens": 4, "total_tokens": 24},
+                }).encode("utf-8")
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(response)))
+                    self.end_headers()
+                    self.wfile.write(response)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The request was cancelled by the client
+
+            def log_message(self, format, *args):
+                pass
+
+        return HANDLER
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+
+
+def run_requests(gpt: GPT_UTILS, num_requests: int, concurrency: int) -> dict:
+    """ A function to send completion requests from a pool of threads and return their latency percentiles.
+    """
+    def request(i):
+        start_time = time.perf_counter()
+        try:
+            gpt.get_completion_from_messages(messages=[{"role": "user", "content": f"Question {i}"}], max_tokens=16)
+            return time.perf_counter() - start_time, None
+        except Exception as e:
+            return time.perf_counter() - start_time, type(e).__name__
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(request, range(num_requests)))
+    latencies_ms = np.array([latency for latency, _ in results]) * 1e3
+    return {
+        "requests": num_requests,
+        "errors": sum(error is not None for _, error in results),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(latencies_ms.max()),
+        "mean_ms": float(latencies_ms.mean()),
+    }
+
+
+def tail_events() -> dict:
+    with llm_telemetry._lock:
+        events = {}
+        for (event, _, _), count in llm_telemetry.tail_events.items():
+            events[event] = events.get(event, 0) + count
+        return events
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--median-latency", type=float, default=0.1, help="Median seconds of a regular response")
+    parser.add_argument("--tail-probability", type=float, default=0.05, help="Share of responses delayed by the tail latency")
+    parser.add_argument("--tail-latency", type=float, default=2.0, help="Extra seconds of a delayed response")
+    parser.add_argument("--hedge-percentile", type=float, default=90)
+    parser.add_argument("--deadline", type=float, default=5.0, help="Seconds before a hedged completion falls back to the other model")
+    parser.add_argument("--slow-default-model", action="store_true", help="Delay every request of the default model to exercise the fallback")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Optional path of the JSON report")
+    args = parser.parse_args()
+
+    gpt = GPT_UTILS(api_key="sk-benchmark", use_response_cache=False, use_semantic_cache=False)
+    gpt.async_client.hedge_percentile = args.hedge_percentile
+    gpt.async_client.deadline = args.deadline
+
+    results = {}
+    server = FAKE_OPENAI_SERVER(args.median_latency, args.tail_probability, args.tail_latency,
+                                slow_model=gpt.default_model if args.slow_default_model else None, seed=args.seed)
+    with server:
+        openai.api_base = server.api_base
+        # The requests without hedging also fill the latency window that the hedge delay is derived from
+        for mode, enabled in [("baseline", False), ("hedged", True)]:
+            gpt.tail_latency_mode = enabled
+            requests_before = sum(server.requests.values())
+            events_before = tail_events()
+            results[mode] = run_requests(gpt, args.requests, args.concurrency)
+            results[mode]["upstream_requests"] = sum(server.requests.values()) - requests_before
+            results[mode]["extra_requests"] = results[mode]["upstream_requests"] / args.requests - 1
+            results[mode]["tail_events"] = {event: count - events_before.get(event, 0) for event, count in tail_events().items()}
+            results[mode]["hedge_delay_ms"] = gpt.async_client.hedge_delay(gpt.default_model) * 1e3 if enabled else None
+
+    for mode, result in results.items():
+        print(f"{mode:<9} p50 {result['p50_ms']:8.1f} ms  p95 {result['p95_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  max {result['max_ms']:8.1f} ms  "
+              f"extra requests {result['extra_requests']:6.1%}  errors {result['errors']}  {result['tail_events']}")
+    print(f"p99 reduced by {1 - results['hedged']['p99_ms'] / results['baseline']['p99_ms']:.1%}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+""" A micro-benchmark to compare the vectorized MMR retriever against LangChain's MMR search on a synthetic vector db.
+    Run from the project root: python benchmarks/mmr_benchmark.py --num-vectors 20000 --dimension 1536
+"""
+
+import os
+import sys
+import time
+import argparse
+import faiss
+import numpy as np
+from langchain.vectorstores import FAISS
+from langchain.embeddings import FakeEmbeddings
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+src_path = os.path.abspath(os.path.join(project_root, "src"))
+sys.path.insert(0, src_path)
+
+from retriever_utils import MMR_RETRIEVER, normalize_rows, mmr_rerank
+
+
+def build_db(num_vectors: int, dimension: int, seed: int=0) -> FAISS:
+    """ A function to build a flat vector db of random embeddings.
+    """
+    vectors = np.random.default_rng(seed).standard_normal((num_vectors, dimension), dtype=np.float32)
+    index = faiss.IndexFlatL2(dimension)
+    index.add(vectors)
+    ids = [str(i) for i in range(num_vectors)]
+    docstore = InMemoryDocstore({chunk_id: Document(page_content=f"chunk {chunk_id}") for chunk_id in ids})
+    return FAISS(FakeEmbeddings(size=dimension), index, docstore, dict(enumerate(ids)))
+
+
+def time_per_query(function, num_queries: int, repeat: int) -> float:
+    """ A function to return the best time per query in microseconds over the repetitions.
+    """
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return best_time / num_queries * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-vectors", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--num-queries", type=int, default=64)
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--lambda-mult", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db = build_db(args.num_vectors, args.dimension)
+    queries = np.random.default_rng(1).standard_normal((args.num_queries, args.dimension), dtype=np.float32)
+
+    start_time = time.perf_counter()
+    retriever = MMR_RETRIEVER.from_db(db)
+    print(f"Normalized embedding matrix built in {time.perf_counter() - start_time:.3f} seconds ({retriever.vectors.nbytes / 2**20:.1f} MiB)")
+
+    # Both paths must select the same chunks
+    langchain_ids = [[document.page_content for document in db.max_marginal_relevance_search_by_vector(query, k=args.k, fetch_k=args.fetch_k,
+                                                                                                      lambda_mult=args.lambda_mult)]
+                     for query in queries]
+    retriever_ids = [[document.page_content for document in documents]
+                     for documents in retriever.search_by_vectors(queries, k=args.k, fetch_k=args.fetch_k, lambda_mult=args.lambda_mult)]
+    agreement = np.mean([a == b for a, b in zip(langchain_ids, retriever_ids)])
+
+    # Re-ranking alone, on candidates fetched beforehand
+    _, candidate_positions = db.index.search(queries, args.fetch_k)
+    candidate_vectors = retriever.vectors[candidate_positions]
+    normalized_queries = normalize_rows(queries)
+
+    results = {
+        "LangChain MMR search, one query at a time": time_per_query(
+            lambda: [db.max_marginal_relevance_search_by_vector(query, k=args.k, fetch_k=args.fetch_k, lambda_mult=args.lambda_mult) for query in queries],
+            args.num_queries, args.repeat),
+        "Vectorized MMR search, one query at a time": time_per_query(
+            lambda: [retriever.search_by_vectors(query, k=args.k, fetch_k=args.fetch_k, lambda_mult=args.lambda_mult) for query in queries],
+            args.num_queries, args.repeat),
+        "Vectorized MMR search, batched queries": time_per_query(
+            lambda: retriever.search_by_vectors(queries, k=args.k, fetch_k=args.fetch_k, lambda_mult=args.lambda_mult),
+            args.num_queries, args.repeat),
+        "Vectorized MMR re-ranking only, batched queries": time_per_query(
+            lambda: mmr_rerank(normalized_queries, candidate_vectors, k=args.k, lambda_mult=args.lambda_mult),
+            args.num_queries, args.repeat),
+    }
+
+    print(f"Identical selections: {agreement:.1%} of {args.num_queries} queries")
+    for name, microseconds in results.items():
+        print(f"{name:<50} {microseconds:>10.1f} us/query")
+
+
+if __name__ == "__main__":
+    main()
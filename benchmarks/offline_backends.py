@@ -0,0 +1,98 @@
+""" Offline stand-ins for the Open AI services used by the benchmarks: deterministic local embeddings and a stub LLM.
+    Both run without network access and produce the same output for the same input, so that benchmark runs are comparable over time.
+"""
+
+import re
+import time
+import zlib
+import asyncio
+import contextlib
+import numpy as np
+import openai
+from openai.util import convert_to_openai_object
+from langchain.embeddings.base import Embeddings
+
+token_pattern = re.compile(r"\w+")
+
+
+class HASH_EMBEDDINGS(Embeddings):
+    """ A class to embed texts locally by feature hashing of their lower case words into a signed, L2-normalized vector.
+        Texts that share words get similar vectors, so that retrieval behaves like a real embedding model on the synthetic corpus.
+        An optional delay per request simulates the latency of a remote embedding model.
+    """
+
+    def __init__(self, size: int=1536, delay: float=0.0) -> None:
+        self.size = size
+        self.delay = delay
+        self.num_requests = 0
+        self.num_texts = 0
+
+    def _embed(self, text: str) -> list:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in token_pattern.findall(text.lower()):
+            hash_value = zlib.crc32(word.encode("utf-8"))
+            vector[hash_value % self.size] += 1.0 if hash_value & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        self.num_requests += 1
+        self.num_texts += len(texts)
+        if self.delay:
+            time.sleep(self.delay)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+
+class STUB_LLM:
+    """ A class to answer chat completion requests locally with a fixed latency and a completion sized by max_tokens.
+        It replaces openai.ChatCompletion.create and acreate while installed, so that GPT_UTILS runs unchanged,
+        including model selection, caching and streaming.
+    """
+
+    def __init__(self, latency: float=0.0, completion_tokens: int=64) -> None:
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.num_requests = 0
+
+    def _response(self, model: str, messages: list, max_tokens: int=None) -> dict:
+        prompt_tokens = sum(len(message["content"].split()) for message in messages)
+        completion_tokens = min(self.completion_tokens, max_tokens or self.completion_tokens)
+        return {
+            "id": f"stub-{self.num_requests}",
+            "object": "chat.completion",
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(["answer"] * completion_tokens)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def _stream(self, response: dict):
+        for word in response["choices"][0]["message"]["content"].split(" "):
+            yield convert_to_openai_object({"object": "chat.completion.chunk", "model": response["model"],
+                                            "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]})
+
+    def create(self, model: str, messages: list, max_tokens: int=None, stream: bool=False, **kwargs):
+        self.num_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        response = self._response(model, messages, max_tokens)
+        return self._stream(response) if stream else convert_to_openai_object(response)
+
+    async def acreate(self, model: str, messages: list, max_tokens: int=None, **kwargs):
+        self.num_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return convert_to_openai_object(self._response(model, messages, max_tokens))
+
+    @contextlib.contextmanager
+    def installed(self):
+        """ A context manager to route the chat completion requests of the openai library to the stub.
+        """
+        create, acreate = openai.ChatCompletion.create, openai.ChatCompletion.acreate
+        openai.ChatCompletion.create, openai.ChatCompletion.acreate = self.create, self.acreate
+        try:
+            yield self
+        finally:
+            openai.ChatCompletion.create, openai.ChatCompletion.acreate = create, acreate
@@ -0,0 +1,229 @@
+""" An offline benchmark of the ingestion and retrieval pipeline on synthetic corpora of several sizes.
+    Open AI is replaced by deterministic local embeddings and a stub LLM, so runs need no network access once the tiktoken encoding is cached.
+    Every corpus size runs in a fresh process so that its peak memory is measured on its own.
+    Reports the throughput of every stage, the p50/p95/p99 latency of retrieval QA and the peak memory as JSON.
+    Run from the project root: python benchmarks/pipeline_benchmark.py --sizes 20 100 500 --json benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+src_path = os.path.abspath(os.path.join(project_root, "src"))
+sys.path.insert(0, src_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_corpus import SYNTHETIC_CORPUS
+from offline_backends import HASH_EMBEDDINGS, STUB_LLM
+
+
+class STAGE_TIMER:
+    """ A class to measure the wall time, the peak traced Python memory and the peak resident memory of a stage.
+    """
+
+    def __init__(self, results: dict, name: str, trace_memory: bool) -> None:
+        self.results = results
+        self.name = name
+        self.trace_memory = trace_memory
+        self.stats = {}
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.start_time = time.perf_counter()
+        return self.stats
+
+    def __exit__(self, *exc_info) -> None:
+        seconds = time.perf_counter() - self.start_time
+        stats = {"seconds": seconds}
+        if self.trace_memory:
+            stats["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        # ru_maxrss is the high-water mark of the process in KiB on Linux
+        stats["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+        for counter in ["docs", "chunks", "tokens", "bytes"]:
+            if counter in self.stats:
+                stats[counter] = self.stats[counter]
+                unit = "mb" if counter == "bytes" else counter
+                stats[f"{unit}_per_s"] = (self.stats[counter] / 2**20 if counter == "bytes" else self.stats[counter]) / seconds if seconds else 0.0
+        stats.update({key: value for key, value in self.stats.items() if key not in stats})
+        self.results[self.name] = stats
+
+
+def stage_files(file_paths: list, folder_path: str) -> int:
+    """ A function to copy the corpus files into a knowledge base folder, since ingestion moves them away. Returns their total size.
+    """
+    shutil.rmtree(folder_path, ignore_errors=True)
+    os.makedirs(folder_path)
+    for file_path in file_paths:
+        shutil.copy2(file_path, folder_path)
+    return sum(os.path.getsize(file_path) for file_path in file_paths)
+
+
+def percentiles(latencies: list) -> dict:
+    latencies_ms = np.array(latencies) * 1e3
+    return {
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+    }
+
+
+def run_size(num_documents: int, args: dict) -> dict:
+    """ A function to generate a corpus of the given size and benchmark every stage of the pipeline on it.
+    """
+    from db_utils import VECTOR_DB_UTILS, db_pool
+    from cache_utils import EMBEDDING_CACHE
+    from gpt_utils import GPT_UTILS
+    from prompts import prompt_doc_qa
+
+    stages = {}
+    work_dir = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    try:
+        corpus = SYNTHETIC_CORPUS(seed=args["seed"])
+        with STAGE_TIMER(stages, "generate_corpus", False) as stats:
+            files = corpus.generate(os.path.join(work_dir, "corpus"), num_documents, args["words_per_document"])
+            document_paths = [file_path for doc_type in ["pdf", "txt", "xlsx"] for file_path, _ in files[doc_type]]
+            web_pages = [(file_path, topic) for file_path, topic in files["html"]]
+            stats["docs"] = num_documents
+            stats["bytes"] = sum(os.path.getsize(file_path) for doc_files in files.values() for file_path, _ in doc_files)
+
+        # Every path of the collection points into the work directory, with a cold embedding cache
+        vector_db = VECTOR_DB_UTILS()
+        vector_db.knowledge_base_path = os.path.join(work_dir, "knowledge_base")
+        vector_db.processed_dir_path = os.path.join(work_dir, "processed_documents")
+        vector_db.db_path = os.path.join(work_dir, "db_faiss")
+        vector_db.db_info_file_path = os.path.join(work_dir, "db_details.csv")
+        vector_db.manifest_path = os.path.join(work_dir, "db_manifest.json")
+        vector_db.embedding_cache = EMBEDDING_CACHE(cache_dir=os.path.join(work_dir, "embedding_cache"))
+        vector_db.extraction_workers = args["extraction_workers"]
+        embeddings = HASH_EMBEDDINGS(size=args["dimension"], delay=args["embedding_latency"])
+
+        num_bytes = stage_files(document_paths, vector_db.knowledge_base_path)
+        with STAGE_TIMER(stages, "create_documents", args["trace_memory"]) as stats:
+            documents, _ = vector_db.create_documents()
+            stats["docs"] = len(document_paths)
+            stats["bytes"] = num_bytes
+            stats["failed"] = sum(report["Status"] == "Failed" for report in vector_db.extraction_report)
+
+        with STAGE_TIMER(stages, "process_documents", args["trace_memory"]) as stats:
+            chunks = vector_db.process_documents(documents)
+            stats["docs"] = len(documents)
+            stats["chunks"] = len(chunks)
+            stats["tokens"] = sum(chunk.metadata["num_tokens"] for chunk in chunks)
+        del documents, chunks
+
+        num_bytes = stage_files(document_paths, vector_db.knowledge_base_path)
+        with STAGE_TIMER(stages, "run_db_build", args["trace_memory"]) as stats:
+            db, _ = vector_db.run_db_build(input_type="documents", embeddings=embeddings)
+            stats["docs"] = len(document_paths)
+            stats["bytes"] = num_bytes
+            stats["chunks"] = db.index.ntotal
+            stats["tokens"] = sum(db.docstore.search(chunk_id).metadata["num_tokens"] for chunk_id in db.index_to_docstore_id.values())
+
+        # Large web pages are extracted with trafilatura and merged one at a time
+        try:
+            import trafilatura
+            with STAGE_TIMER(stages, "web_ingestion", args["trace_memory"]) as stats:
+                num_bytes = 0
+                num_chunks = db.index.ntotal
+                for file_path, _ in web_pages:
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        html = f.read()
+                    num_bytes += len(html.encode("utf-8"))
+                    page_content = trafilatura.extract(html) or ""
+                    db, _ = vector_db.run_db_build(input_type="web_url", embeddings=embeddings, page_content=page_content,
+                                                   source_url=f"https://example.com/{os.path.basename(file_path)}", merge_with_existing_db=True)
+                stats["docs"] = len(web_pages)
+                stats["bytes"] = num_bytes
+                stats["chunks"] = db.index.ntotal - num_chunks
+        except ImportError as e:
+            stages["web_ingestion"] = {"skipped": f"trafilatura is not available: {e}"}
+
+        with STAGE_TIMER(stages, "load_local_db", args["trace_memory"]) as stats:
+            with db_pool.lock:
+                db_pool.pop(vector_db.db_path)
+            local_db = vector_db.load_local_db(embeddings=embeddings)
+            stats["chunks"] = local_db.index.ntotal
+
+        # Queries are answered by the stub LLM with the response and semantic caches disabled
+        gpt = GPT_UTILS(api_key="offline", use_response_cache=False, use_semantic_cache=False)
+        queries = [corpus.query(i % corpus.num_topics) for i in range(args["num_queries"])]
+        latencies = []
+        with STUB_LLM(latency=args["llm_latency"]).installed():
+            for query in queries[:min(5, len(queries))]:
+                gpt.retrieval_qa(query=query, prompt=prompt_doc_qa(), db=local_db)
+            with STAGE_TIMER(stages, "retrieval_qa", args["trace_memory"]) as stats:
+                for query in queries:
+                    start_time = time.perf_counter()
+                    response = gpt.retrieval_qa(query=query, prompt=prompt_doc_qa(), db=local_db)
+                    latencies.append(time.perf_counter() - start_time)
+                    if response is None:
+                        raise RuntimeError("Retrieval QA failed")
+                stats["queries"] = len(queries)
+                stats["queries_per_s"] = len(queries) / sum(latencies)
+                stats.update(percentiles(latencies))
+
+        return {"num_documents": num_documents, "num_web_pages": len(web_pages), "stages": stages}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 100, 500], help="Number of documents of every corpus")
+    parser.add_argument("--words-per-document", type=int, default=2000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--extraction-workers", type=int, default=1)
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Simulated seconds per embedding request")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per completion request")
+    parser.add_argument("--trace-memory", action="store_true", help="Also trace the peak Python allocations of every stage, which slows it down")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Optional path of the JSON report")
+    args = parser.parse_args()
+
+    results = []
+    for num_documents in args.sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_size, num_documents, vars(args)).result()
+        results.append(result)
+
+        print(f"\n{num_documents} documents and {result['num_web_pages']} web pages")
+        print(f"{'Stage':<18} {'Seconds':>9} {'Docs/s':>9} {'Chunks/s':>10} {'Tokens/s':>11} {'MB/s':>7} {'Peak RSS MB':>12}")
+        for name, stats in result["stages"].items():
+            if "skipped" in stats:
+                print(f"{name:<18} skipped, {stats['skipped']}")
+                continue
+            rates = [f"{stats[key]:.{digits}f}" if key in stats else "-" for key, digits in
+                     [("docs_per_s", 1), ("chunks_per_s", 1), ("tokens_per_s", 0), ("mb_per_s", 2)]]
+            print(f"{name:<18} {stats['seconds']:>9.3f} {rates[0]:>9} {rates[1]:>10} {rates[2]:>11} {rates[3]:>7} {stats['peak_rss_mb']:>12.1f}")
+        qa = result["stages"]["retrieval_qa"]
+        print(f"Retrieval QA latency: p50 {qa['p50_ms']:.2f} ms, p95 {qa['p95_ms']:.2f} ms, p99 {qa['p99_ms']:.2f} ms, {qa['queries_per_s']:.1f} queries/s")
+
+    if args.json:
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+            "parameters": vars(args),
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+""" A report of recall against memory for the vector encodings of the FAISS store on a synthetic clustered corpus.
+    Every index type and encoding is compared with an exact float32 Flat search, with and without re-ranking on the exact vectors on disk.
+    Run from the project root: python benchmarks/quantization_report.py --num-vectors 50000 --dimension 1536 --json report.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import faiss
+import numpy as np
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+src_path = os.path.abspath(os.path.join(project_root, "src"))
+sys.path.insert(0, src_path)
+
+from index_utils import EXACT_VECTOR_STORE, index_factory_string, set_search_params
+
+
+def build_corpus(num_vectors: int, dimension: int, num_clusters: int, seed: int=0) -> tuple:
+    """ A function to generate clustered embeddings and queries, which resemble the topical structure of document chunks better than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((num_clusters, dimension), dtype=np.float32)
+    labels = rng.integers(num_clusters, size=num_vectors)
+    vectors = centroids[labels] + 0.5 * rng.standard_normal((num_vectors, dimension), dtype=np.float32)
+    return vectors.astype(np.float32), centroids, rng
+
+
+def recall_at_k(positions: np.ndarray, ground_truth: np.ndarray) -> float:
+    """ A function to return the mean fraction of the exact nearest neighbours found per query.
+    """
+    return float(np.mean([len(set(found) & set(truth)) / len(truth) for found, truth in zip(positions, ground_truth)]))
+
+
+def exact_rerank(store: EXACT_VECTOR_STORE, queries: np.ndarray, candidate_positions: np.ndarray, k: int) -> np.ndarray:
+    """ A function to re-sort the candidates of every query by their exact L2 distance and keep the k nearest.
+    """
+    safe_positions = np.maximum(candidate_positions, 0)
+    vectors = store.get([str(position) for position in safe_positions.ravel()]).reshape(*safe_positions.shape, -1)
+    distances = ((vectors - queries[:, None, :]) ** 2).sum(axis=2)
+    distances[candidate_positions < 0] = np.inf
+    return np.take_along_axis(candidate_positions, np.argsort(distances, axis=1)[:, :k], axis=1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-vectors", type=int, default=50000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--num-clusters", type=int, default=200)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    parser.add_argument("--index-types", nargs="+", default=["Flat", "IVFFlat", "HNSW"])
+    parser.add_argument("--json", help="Optional path of the JSON report")
+    args = parser.parse_args()
+
+    vectors, centroids, rng = build_corpus(args.num_vectors, args.dimension, args.num_clusters)
+    queries = (centroids[rng.integers(args.num_clusters, size=args.num_queries)]
+               + 0.5 * rng.standard_normal((args.num_queries, args.dimension), dtype=np.float32)).astype(np.float32)
+
+    exact_index = faiss.IndexFlatL2(args.dimension)
+    exact_index.add(vectors)
+    _, ground_truth = exact_index.search(queries, args.k)
+
+    with tempfile.TemporaryDirectory() as db_path:
+        # The exact vectors are shared by every compressed configuration, as they would be stored next to the index
+        store = EXACT_VECTOR_STORE(db_path)
+        store.add([str(i) for i in range(args.num_vectors)], vectors)
+        exact_bytes = os.path.getsize(store.data_path)
+
+        nlist = max(1, int(np.sqrt(args.num_vectors)))
+        rows = []
+        for index_type in args.index_types:
+            for encoding in ["float32", "fp16", "int8"]:
+                index = faiss.index_factory(args.dimension, index_factory_string(index_type, nlist=nlist, encoding=encoding))
+                start_time = time.perf_counter()
+                if not index.is_trained:
+                    index.train(vectors)
+                index.add(vectors)
+                build_time = time.perf_counter() - start_time
+                set_search_params(index)
+                index_bytes = faiss.serialize_index(index).nbytes
+
+                start_time = time.perf_counter()
+                _, positions = index.search(queries, args.k)
+                search_time = (time.perf_counter() - start_time) / args.num_queries
+                rows.append({"index_type": index_type, "encoding": encoding, "exact_rerank": False, "index_bytes": index_bytes,
+                             "disk_bytes": index_bytes, f"recall@{args.k}": recall_at_k(positions, ground_truth),
+                             "build_seconds": build_time, "search_ms_per_query": search_time * 1e3})
+
+                if encoding == "float32":
+                    continue
+                start_time = time.perf_counter()
+                _, candidate_positions = index.search(queries, args.k * args.rerank_factor)
+                positions = exact_rerank(store, queries, candidate_positions, args.k)
+                search_time = (time.perf_counter() - start_time) / args.num_queries
+                rows.append({"index_type": index_type, "encoding": encoding, "exact_rerank": True, "index_bytes": index_bytes,
+                             "disk_bytes": index_bytes + exact_bytes, f"recall@{args.k}": recall_at_k(positions, ground_truth),
+                             "build_seconds": build_time, "search_ms_per_query": search_time * 1e3})
+
+    print(f"{args.num_vectors} vectors of dimension {args.dimension} in {args.num_clusters} clusters, {args.num_queries} queries")
+    print(f"{'Index':<8} {'Encoding':<8} {'Rerank':<7} {'RAM MiB':>9} {'Disk MiB':>9} {f'Recall@{args.k}':>10} {'ms/query':>9}")
+    for row in rows:
+        print(f"{row['index_type']:<8} {row['encoding']:<8} {str(row['exact_rerank']):<7} {row['index_bytes'] / 2**20:>9.1f} "
+              f"{row['disk_bytes'] / 2**20:>9.1f} {row[f'recall@{args.k}']:>10.3f} {row['search_ms_per_query']:>9.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"parameters": vars(args), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+""" A generator of synthetic corpora for the offline benchmarks: PDF, text and xlsx documents and large web pages.
+    Documents are built from a deterministic vocabulary of topics, so that the same seed always produces the same corpus
+    and queries drawn from a topic retrieve the chunks of that topic.
+    Run from the project root: python benchmarks/synthetic_corpus.py --num-documents 100 --output-dir /tmp/corpus
+"""
+
+import os
+import argparse
+import numpy as np
+from openpyxl import Workbook
+
+# Share of every document type in a corpus
+default_mix = {"pdf": 0.3, "txt": 0.4, "xlsx": 0.1, "html": 0.2}
+
+
+class SYNTHETIC_CORPUS:
+    """ A class to generate the documents of a synthetic corpus. Every document belongs to a topic with its own frequent terms.
+    """
+
+    def __init__(self, num_topics: int=20, vocabulary_size: int=5000, seed: int=0) -> None:
+        self.rng = np.random.default_rng(seed)
+        syllables = ["ka", "lo", "mi", "ne", "su", "ta", "vo", "ri", "pe", "da", "xo", "gu", "ze", "bi", "ha", "fu"]
+        self.vocabulary = list(dict.fromkeys("".join(self.rng.choice(syllables, size=self.rng.integers(2, 5)))
+                                             for _ in range(vocabulary_size * 2)))[:vocabulary_size]
+        self.num_topics = num_topics
+        self.topic_terms = [self.rng.choice(len(self.vocabulary), size=50, replace=False) for _ in range(num_topics)]
+        # Zipf-like background frequencies of the vocabulary
+        weights = 1 / np.arange(1, len(self.vocabulary) + 1)
+        self.background = weights / weights.sum()
+
+    def sentence(self, topic: int, num_words: int=None) -> str:
+        """ A method to generate a sentence that mixes the terms of a topic with background words.
+        """
+        num_words = num_words or int(self.rng.integers(8, 20))
+        from_topic = self.rng.random(num_words) < 0.3
+        word_ids = np.where(from_topic, self.rng.choice(self.topic_terms[topic], size=num_words),
+                            self.rng.choice(len(self.vocabulary), size=num_words, p=self.background))
+        words = [self.vocabulary[i] for i in word_ids]
+        return " ".join(words).capitalize() + "."
+
+    def paragraphs(self, topic: int, num_words: int) -> list:
+        """ A method to generate paragraphs of a topic with about the given number of words in total.
+        """
+        paragraphs = []
+        words = 0
+        while words < num_words:
+            paragraph = " ".join(self.sentence(topic) for _ in range(int(self.rng.integers(3, 8))))
+            paragraphs.append(paragraph)
+            words += paragraph.count(" ") + 1
+        return paragraphs
+
+    def query(self, topic: int) -> str:
+        """ A method to generate a question about a topic.
+        """
+        return "What is said about " + " ".join(self.vocabulary[i] for i in self.rng.choice(self.topic_terms[topic], size=4, replace=False)) + "?"
+
+    def write_txt(self, file_path: str, topic: int, num_words: int) -> None:
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(self.paragraphs(topic, num_words)))
+
+    def write_pdf(self, file_path: str, topic: int, num_words: int) -> None:
+        """ A method to write a minimal PDF with one page per 40 lines of text in a standard font.
+        """
+        lines = [line for paragraph in self.paragraphs(topic, num_words) for line in wrap_words(paragraph, 90) + [""]]
+        pages = [lines[i:i + 40] for i in range(0, len(lines), 40)]
+
+        objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+        page_ids = []
+        for page_lines in pages:
+            text = "\n".join(f"({escape_pdf(line)}) Tj T*" for line in page_lines)
+            stream = f"BT /F1 10 Tf 12 TL 50 780 Td\n{text}\nET"
+            objects.append(f"<< /Length {len(stream.encode('latin-1'))} >>\nstream\n{stream}\nendstream")
+            objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+            page_ids.append(len(objects))
+        objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {len(page_ids)} >>"
+
+        content = b"%PDF-1.4\n"
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(content))
+            content += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+        xref_offset = len(content)
+        content += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+        content += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+        content += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("latin-1")
+        with open(file_path, "wb") as f:
+            f.write(content)
+
+    def write_xlsx(self, file_path: str, topic: int, num_words: int) -> None:
+        """ A method to write a workbook with a table of records whose description columns hold sentences of the topic.
+        """
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(["Id", "Name", "Quantity", "Description"])
+        words = 0
+        row = 0
+        while words < num_words:
+            description = self.sentence(topic)
+            row += 1
+            sheet.append([row, self.vocabulary[self.rng.choice(self.topic_terms[topic])], int(self.rng.integers(1, 1000)), description])
+            words += description.count(" ") + 3
+        workbook.save(file_path)
+
+    def web_page(self, topic: int, num_words: int) -> str:
+        """ A method to generate a large HTML page with navigation and footer boilerplate around the article.
+        """
+        navigation = "".join(f"<li><a href='/{word}'>{word}</a></li>" for word in self.rng.choice(self.vocabulary, size=60))
+        article = "".join(f"<p>{paragraph}</p>" for paragraph in self.paragraphs(topic, num_words))
+        footer = " ".join(self.sentence(0) for _ in range(10))
+        return (f"<html><head><title>{self.query(topic)}</title></head><body><nav><ul>{navigation}</ul></nav>"
+                f"<main><article><h1>{self.query(topic)}</h1>{article}</article></main><footer>{footer}</footer></body></html>")
+
+    def generate(self, output_dir: str, num_documents: int, words_per_document: int=2000, mix: dict=default_mix) -> dict:
+        """ A method to write a corpus into a directory. Documents are written to the directory and web pages to its web subfolder.
+            Returns the written file paths and their topics keyed by document type.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        web_dir = os.path.join(output_dir, "web")
+        os.makedirs(web_dir, exist_ok=True)
+        types = self.rng.choice(list(mix), size=num_documents, p=np.array(list(mix.values())) / sum(mix.values()))
+        files = {doc_type: [] for doc_type in mix}
+        for i, doc_type in enumerate(types):
+            topic = i % self.num_topics
+            # Web pages are several times larger than documents
+            num_words = int(words_per_document * self.rng.uniform(0.5, 1.5) * (4 if doc_type == "html" else 1))
+            file_path = os.path.join(web_dir if doc_type == "html" else output_dir, f"doc_{i:05d}.{doc_type}")
+            if doc_type == "html":
+                with open(file_path, "w", encoding="utf-8") as f:
+                    f.write(self.web_page(topic, num_words))
+            else:
+                getattr(self, f"write_{doc_type}")(file_path, topic, num_words)
+            files[doc_type].append((file_path, topic))
+        return files
+
+
+def wrap_words(text: str, width: int) -> list:
+    """ A function to wrap a text into lines of at most the given number of characters.
+    """
+    lines, line = [], ""
+    for word in text.split(" "):
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    return lines + [line] if line else lines
+
+
+def escape_pdf(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-documents", type=int, default=100)
+    parser.add_argument("--words-per-document", type=int, default=2000)
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    files = SYNTHETIC_CORPUS(seed=args.seed).generate(args.output_dir, args.num_documents, args.words_per_document)
+    for doc_type, doc_files in files.items():
+        print(f"{doc_type}: {len(doc_files)} files, {sum(os.path.getsize(file_path) for file_path, _ in doc_files) / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -23,8 +23,10 @@ src_path = os.path.abspath(os.path.join(project_root, "src"))
 sys.path.insert(0, src_path)
 
 # Loading prompt templates and GPT Utilities from src
-from prompts import summarize_text
 from db_utils import VECTOR_DB_UTILS
+from summary_utils import SUMMARY_UTILS
+from gpt_utils import COMPLETION_STREAM
+from telemetry_utils import llm_telemetry
 from url_utils import *
 
 # Initialize database class
@@ -36,9 +38,7 @@ temp_dir = f"{project_root}/temp_docs"
 def summary_ytvideo():
     """A streamlit function to show the input options and summarize when YouTube Video URL is selected"""
 
-    summarized_text = ""
-    tokens_used = 0
-    exec_time = 0
+    summary_stream = None
 
     with st.form("yt_video_summerize"):
         yt_url = st.text_input(label="Paste an YouTube URL",
@@ -49,17 +49,16 @@ def summary_ytvideo():
         if submit_button:
             # Validate the YouTube Video URL
             if validate_youtube_url(yt_url):
-                extracted_text = vector_db.youtube_transcript(yt_url=yt_url)
+                transcript = vector_db.youtube_transcript(yt_url=yt_url)
+                extracted_text = "".join(document.page_content for document in transcript[0]) if transcript is not None else ""
                 if len(extracted_text) == 0:
                     st.error("Unable to extract transcript from this Video. Please try other Video URLs")
-                elif len(extracted_text) > 10000:
-                    st.error("The extracted web content is too large to summarize.")
                 else:
-                    summarized_text, tokens_used, exec_time = gpt_completions(text_input=extracted_text, word_limit=word_limit)
+                    summary_stream = gpt_completions(text_input=extracted_text, word_limit=word_limit)
             else:
                 st.error("Invalid URL. Please correct and submit again.")
 
-    return summarized_text, tokens_used, exec_time
+    return summary_stream
 
 def calculate_text_length(text_input: str):
     """A simple function to calculate the text length."""
@@ -67,30 +66,19 @@ def calculate_text_length(text_input: str):
     st.session_state.valid_text_length = is_text_enough
 
 def gpt_completions(text_input: str, word_limit: int):
-    """A function to build prompt and get gpt response."""
+    """A function to summarize the text with gpt, splitting long texts into chunks that are summarized and combined.
+    Returns a stream of the final summary that records its time to first token, total time and tokens used."""
     
-    # Start timer
-    start_time = time.time()
-    
-    prompt = summarize_text(text_input=text_input, word_limit=word_limit)
-    gpt_response = st.session_state.gpt.get_completion_from_messages(messages=prompt)
-    gpt_summary = gpt_response.choices[0].message["content"]
-    tokens_used = gpt_response.usage.total_tokens
-
-    # End timer
-    end_time = time.time()
+    summarizer = SUMMARY_UTILS(gpt=st.session_state.gpt)
+    with st.spinner("Summarizing ..."), llm_telemetry.feature("summary"):
+        summary_stream = summarizer.summarize_stream(text_input=text_input, word_limit=word_limit)
 
-    # Calculate the execution_time
-    execution_time = end_time - start_time
-
-    return gpt_summary, tokens_used, execution_time
+    return summary_stream
 
 def summary_text():
     """A streamlit function to show the input options and summarize when text input is selected"""
     
-    summarized_text = ""
-    tokens_used = 0
-    exec_time = 0
+    summary_stream = None
     
     with st.form("text_summarize"):
         text_input = st.text_area(label="Paste the text to summarise",
@@ -102,18 +90,17 @@ def summary_text():
         if submit_button:
             if len(text_input) < word_limit:
                 st.warning("Text is too short to summarize.")
-                summarized_text = text_input
+                summary_stream = COMPLETION_STREAM([text_input], model=st.session_state.gpt.default_model,
+                                                   usage={"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0})
             else:
-                summarized_text, tokens_used, exec_time = gpt_completions(text_input=text_input, word_limit=word_limit)
+                summary_stream = gpt_completions(text_input=text_input, word_limit=word_limit)
 
-    return summarized_text, tokens_used, exec_time
+    return summary_stream
 
 def summary_url():
     """A streamlit function to show the input options and summarize when URL input is selected"""
 
-    summarized_text = ""
-    tokens_used = 0
-    exec_time = 0
+    summary_stream = None
 
     with st.form("url_summarize"):
         url_input = st.text_input(label="Paste the URL",
@@ -125,21 +112,17 @@ def summary_url():
                 extracted_text = extract_text_url(url_input)
                 if len(extracted_text) == 0:
                     st.error("Unable to extract text content from this URL. Please try other URL.")
-                elif len(extracted_text) > 10000:
-                    st.error("The extracted web content is too large to summarize.")
                 else:
-                    summarized_text, tokens_used, exec_time = gpt_completions(text_input=extracted_text, word_limit=word_limit)
+                    summary_stream = gpt_completions(text_input=extracted_text, word_limit=word_limit)
             else:
                 st.error("Invalid URL. Please correct and submit again.")
 
-    return summarized_text, tokens_used, exec_time
+    return summary_stream
 
 def summary_document():
     """A streamlit function to show the input options and summarize when document upload input is selected"""
 
-    summarized_text = ""
-    tokens_used = 0
-    exec_time = 0
+    summary_stream = None
 
     with st.form("doc_summarize"):
         uploaded_file = st.file_uploader(label="Choose a file",
@@ -164,14 +147,12 @@ def summary_document():
 
                 if len(extracted_text) == 0:
                     st.error("Unable to extract text content from this document. Please try with other document.")
-                elif len(extracted_text) > 10000:
-                    st.error("The extracted text content is too large to summarize.")
                 else:
-                    summarized_text, tokens_used, exec_time = gpt_completions(text_input=extracted_text, word_limit=word_limit)
+                    summary_stream = gpt_completions(text_input=extracted_text, word_limit=word_limit)
             else:
                 st.error("Please upload a document")       
 
-    return summarized_text, tokens_used, exec_time
+    return summary_stream
 
 def summarization():
     """ A function to display the various summarization capabilities as streamlit page.
@@ -195,28 +176,22 @@ def summarization():
     if selected == "Document Q&A":
         switch_page("chat_with_data")
     
-    summarized_text = ""
-    
     # if not st.session_state.valid_key:
     #     st.warning("Invalid Open AI API Key. Please re-configure your Open AI API Key.")
     
     tab1, tab2, tab3, tab4 = st.tabs(["**Document(s)**", "**URL**", "**YouTube URL**", "**Text**"])
 
     with tab1:
-        summarized_text, tokens_used, exec_time = summary_document()
-        print_summary(summarized_text, tokens_used, exec_time)
+        print_summary(summary_document())
 
     with tab2:
-        summarized_text, tokens_used, exec_time = summary_url()
-        print_summary(summarized_text, tokens_used, exec_time)
+        print_summary(summary_url())
 
     with tab3:
-        summarized_text, tokens_used, exec_time = summary_ytvideo()
-        print_summary(summarized_text, tokens_used, exec_time)
+        print_summary(summary_ytvideo())
         
     with tab4:
-        summarized_text, tokens_used, exec_time = summary_text()
-        print_summary(summarized_text, tokens_used, exec_time)
+        print_summary(summary_text())
         
     v1.html("""
     <script>
@@ -253,14 +228,28 @@ def summarization():
     </script>
 """, height=0)
 
-def print_summary(summarized_text, tokens_used, exec_time):
-    if len(summarized_text) > 0:
+def print_summary(summary_stream):
+    """A function to render the summary incrementally as it streams, followed by the tokens used and timings."""
+    if summary_stream is not None:
         with st.expander(label='', expanded=True):
             st.markdown("### Summarized Content:")
             st.divider()
-            st.write(summarized_text)
+            summary_placeholder = st.empty()
+            summarized_text = ""
+            try:
+                for chunk in summary_stream:
+                    summarized_text += chunk
+                    summary_placeholder.markdown(summarized_text + "▌")
+            except Exception as e:
+                # A failed stream is neither cached nor counted, so only the error is shown
+                print(f"Error while streaming the summary: {e}")
+                summary_placeholder.empty()
+                st.error("Unable to complete the summary. Please try again.")
+                return
+            summary_placeholder.markdown(summarized_text)
             st.markdown(
-                f"<p style='font-size: smaller; color: green;'>Tokens used: {tokens_used}</br>Executed in {exec_time:.4f} seconds",
+                f"<p style='font-size: smaller; color: green;'>Tokens used: {summary_stream.total_tokens}</br>"
+                f"First token in {summary_stream.time_to_first_token or 0:.4f} seconds</br>Executed in {summary_stream.total_time:.4f} seconds",
                 unsafe_allow_html=True,
             )
             
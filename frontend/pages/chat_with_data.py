@@ -19,6 +19,8 @@ _ = load_dotenv(find_dotenv())  # read local .env file
 KNOWLDGE_BASE_DIR = os.environ["KNOWLDGE_BASE_DIR"]  # Load Knowledge base directory name
 FAISS_DB_DIR = os.environ["FAISS_DB_DIR"]  # Load Vector database directory name
 
+job_refresh_seconds = 2  # Interval of the refresh of the ingestion jobs while any of them is queued or running
+
 # Get the absolute path to the project root directory
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 src_path = os.path.abspath(os.path.join(project_root, "src"))
@@ -26,40 +28,109 @@ sys.path.insert(0, src_path)
 
 # Loading prompt templates and GPT Utilities from src
 from prompts import prompt_doc_qa
-from db_utils import VECTOR_DB_UTILS
+from db_utils import VECTOR_DB_UTILS, db_pool
+from collection_utils import DEFAULT_COLLECTION, list_collections, create_collection, validate_collection_name
 from url_utils import *
+from job_utils import ingestion_queue
+from telemetry_utils import llm_telemetry
 
 # Initialize database class
 vector_db = VECTOR_DB_UTILS()
 
-# Path for the knowledge base documents
-kb_path = f"{project_root}/{KNOWLDGE_BASE_DIR}"
-db_path = f"{project_root}/{FAISS_DB_DIR}"
-processed_dir_path = f"{project_root}/processed_documents"
-current_db_info_file_path = f"{project_root}/db_details.csv"
-
 if "db_exist" not in st.session_state:
     st.session_state.db_exist = False
     st.session_state.db_list = False
 
-def process_documents(merge_with_exist: bool=False):
-    """ A streamlit function to convert the uploaded document files into chunks and store in vector db.
+if "collection" not in st.session_state:
+    st.session_state.collection = DEFAULT_COLLECTION
+
+def select_collection():
+    """ A streamlit function to select the collection of the knowledge base that is ingested into and queried, or create a new one.
+    """
+    global vector_db
+    col1, col2 = st.columns([0.6, 0.4])
+    with col1:
+        collections = list_collections()
+        if st.session_state.collection not in collections:
+            collections.append(st.session_state.collection)
+        st.session_state.collection = st.selectbox(label="Collection",
+                                                   options=collections,
+                                                   index=collections.index(st.session_state.collection),
+                                                   help="Every collection has its own vector database. Collections are loaded on the first query and unloaded when memory is needed by others.")
+    with col2:
+        with st.form("Create_Collection"):
+            new_collection = st.text_input(label="New collection", placeholder="Letters, digits, - and _")
+            if st.form_submit_button(label="Create Collection") and new_collection:
+                if validate_collection_name(new_collection):
+                    create_collection(new_collection)
+                    st.session_state.collection = new_collection
+                    st.rerun()
+                else:
+                    st.error("Invalid collection name. Please use up to 64 letters, digits, - and _.")
+    vector_db = VECTOR_DB_UTILS(collection=st.session_state.collection)
+
+def submit_ingestion_job(input_type: str, merge_with_exist: bool=False, source_url: str="", job_id: str=None):
+    """ A streamlit function to queue an ingestion job into the selected collection. It returns immediately and the job runs in the background.
+    """
+    if job_id is None:
+        job_id, _ = ingestion_queue.create_staging_dir()
+    job = ingestion_queue.submit(job_id=job_id,
+                                 input_type=input_type,
+                                 embeddings=st.session_state.gpt.embeddings,
+                                 collection=st.session_state.collection,
+                                 merge_with_existing_db=merge_with_exist,
+                                 source_url=source_url)
+    st.info(f"Ingestion job {job['job_id'][:8]} is queued. Its progress is shown below.")
+    st.session_state.db_exist = True
+    return st.session_state.db_exist
+
+def job_progress(job: dict) -> str:
+    """ A function to describe the progress of the latest stage of an ingestion job.
     """
-    try:
-        db, db_build_time = vector_db.run_db_build(input_type="documents", embeddings=st.session_state.gpt.embeddings, merge_with_existing_db=merge_with_exist)
-        if db is not None:
-            st.info(f"Database build completed in {db_build_time:.4f} seconds")
-            st.session_state.db_exist = True
-            return st.session_state.db_exist
-        else:
-            st.session_state.db_exist = False
-            return st.session_state.db_exist
-
-    except Exception as e:
-        error_msg = f"An error occurred while reading files: {e}"
-        st.error(error_msg)
-        st.session_state.db_exist = False
-        return st.session_state.db_exist
+    if not job["stages"]:
+        return ""
+    stage, progress = list(job["stages"].items())[-1]
+    unit = {"extracting": "files", "crawling": "pages"}.get(stage, "chunks")
+    total = f"/{progress['total']}" if progress["total"] else ""
+    return f"{stage.capitalize()}: {progress['completed']}{total} {unit}"
+
+def show_ingestion_jobs():
+    """ A streamlit function to show the ingestion jobs of the selected collection. It runs as a fragment that refreshes itself while any of them is queued or running,
+        so that the rest of the page is not blocked, and reruns the whole page once the jobs finish or start, to update the controls that depend on them.
+    """
+    if ingestion_queue.has_active_jobs(collection=st.session_state.collection) != st.session_state.active_jobs:
+        st.rerun()
+    jobs = ingestion_queue.list_jobs(collection=st.session_state.collection)
+    if not jobs:
+        return
+
+    st.dataframe(pd.DataFrame([{
+        'Job': job['job_id'][:8],
+        'Input_Type': job['input_type'],
+        'Source': job['source'],
+        'Status': job['status'],
+        'Progress': job_progress(job),
+        'Build_Time': job['build_time'],
+        'Error': job['error'],
+    } for job in jobs]), use_container_width=True)
+
+    traced_jobs = {f"{job['job_id'][:8]} - {job['source']}": job for job in jobs if job.get('stage_breakdown')}
+    if traced_jobs:
+        with st.expander("Stage breakdown"):
+            selected_job = st.selectbox(label="Job", options=list(traced_jobs), help="Time spent in every stage of the ingestion job, with the bytes, chunks and tokens it handled.")
+            breakdown_df = pd.DataFrame(traced_jobs[selected_job]['stage_breakdown'])
+            st.dataframe(breakdown_df.style.format({'Seconds': "{:.3f}", 'Share': "{:.1%}"}), use_container_width=True)
+            st.bar_chart(breakdown_df[~breakdown_df['Stage'].isin(["ingestion_job", "run_db_build"])].set_index('Stage')['Seconds'])
+
+    failed_reports = [report for job in jobs for report in job['extraction_report'] if report['Status'] == "Failed"]
+    if failed_reports:
+        st.warning(f"Unable to extract text content from: {', '.join(report['File_Name'] for report in failed_reports)}")
+        with st.expander("Extraction details"):
+            st.dataframe(pd.DataFrame(failed_reports), use_container_width=True)
+
+    if st.button(label="Clear Finished Jobs"):
+        ingestion_queue.clear_finished(collection=st.session_state.collection)
+        st.rerun()
 
 def input_documents():
     """ A streamlit function to provide upload interface for documents and extract information from it.
@@ -75,14 +146,13 @@ def input_documents():
         submit_button = st.form_submit_button(label="Process Documents", disabled=not st.session_state.valid_key)
 
         if submit_button:
-            # Upload all the documents to a temporary directory
-            upload_state = write_uploaded_files(uploaded_files=uploaded_files, folder_path=kb_path)
+            # Upload all the documents to the staging directory of a new job
+            job_id, staging_path = ingestion_queue.create_staging_dir()
+            upload_state = write_uploaded_files(uploaded_files=uploaded_files, folder_path=staging_path)
             if not upload_state:
                 st.error("Error while uploading files. Please check input files.")
             else:
-                with st.spinner("Building database..."):
-                    db_status = process_documents(merge_with_exist_db)
-                    st.session_state.db_list = True
+                db_status = submit_ingestion_job("documents", merge_with_exist_db, job_id=job_id)
 
 def input_url():	
     """ A streamlit function to extract text content from web url.	
@@ -91,25 +161,15 @@ def input_url():
         input_url = st.text_input(label="Enter a URL",	
                                 value='''https://en.wikipedia.org/wiki/Eiffel_Tower''',
                                 disabled=not st.session_state.valid_key,)	
+        crawl_site = st.checkbox(label="Crawl all pages of the sitemap",
+                                 help="Check this box if the URL is a sitemap such as https://example.com/sitemap.xml. Every page it lists is downloaded and ingested in a single job.")
         merge_with_exist_db = st.checkbox(label="Merge with existing database",
                                           help="Check this box to merge with the existing database. Keep it unchecked to overwrite current database. Merging with exsiting database might result in unreliable responses.")
         submit_url = st.form_submit_button(label="Extract Content", disabled=not st.session_state.valid_key,)	
         if submit_url:	
-            # Extract web page content from the given URL	
+            # Extract the web page content and build the db in the background	
             if validate_input_url(input_url):	
-                extracted_text = extract_text_url(input_url)	
-                if len(extracted_text) == 0:	
-                    st.error("Unable to extract text content from this URL. Please try other URL.")	
-                else:	
-                    # Convert into chunks and build db	
-                    db, db_build_time = vector_db.run_db_build(input_type="web_url", embeddings=st.session_state.gpt.embeddings, page_content=extracted_text, source_url=input_url, merge_with_existing_db=merge_with_exist_db)	
-                    if db is not None:	
-                        st.info(f"Database build completed in {db_build_time:.4f} seconds")	
-                        st.session_state.db_exist = True	
-                        return st.session_state.db_exist	
-                    else:	
-                        st.session_state.db_exist = False	
-                        return st.session_state.db_exist	
+                return submit_ingestion_job("web_crawl" if crawl_site else "web_url", merge_with_exist_db, source_url=input_url)	
             else:	
                 st.error("Invalid URL. Please correct and submit again.")	
                 st.session_state.db_exist = False	
@@ -143,6 +203,8 @@ def chat_with_data():
     # if not st.session_state.valid_key:
     #     st.warning("Invalid Open AI API Key. Please re-configure your Open AI API Key.")
 
+    select_collection()
+
     # Create tabs for Ingest and Query pages
     ingest_tab, query_tab = st.tabs(["**Ingest Data**", "**Ask Questions**"])
 
@@ -156,7 +218,7 @@ def chat_with_data():
                     """
                     1. Click **Browse files** to upload the files and select whether or not they should be merged with an existing vector database.
                     2. To extract text content from documents and create a vector database, select **Process Documents**.
-                    3. After a successful build, the **Files in vector database** count should always be 2.
+                    3. After a successful build, the **Files in vector database** count shows the index files saved for the collection.
                     4. You can also reset the vector database by clicking the **Clear Database** button.
                     5. You can then proceed to ask queries regarding documents in the **Ask Questions** tab.
 
@@ -169,9 +231,9 @@ def chat_with_data():
                 input_url()
                 st.sidebar.info(
                     """
-                    1. Paste a Web URL and select whether or not they should be merged with an existing vector database.
+                    1. Paste a Web URL, or the URL of a sitemap to ingest all of its pages, and select whether or not they should be merged with an existing vector database.
                     2. To extract text content from an url and create a vector database, select **Extract Content**.
-                    3. After a successful build, the **Files in vector database** count should always be 2.
+                    3. After a successful build, the **Files in vector database** count shows the index files saved for the collection.
                     4. You can also reset the vector database by clicking the **Clear Database** button.
                     5. You can then proceed to ask queries regarding documents in the **Ask Questions** tab.
                     
@@ -184,7 +246,7 @@ def chat_with_data():
                     """
                     1. Paste a YouTube URL and select whether or not they should be merged with an existing vector database.
                     2. To extract the transcript from a YouTube url and create a vector database, select **Extract Transcript**.
-                    3. After a successful build, the **Files in vector database** count should always be 2.
+                    3. After a successful build, the **Files in vector database** count shows the index files saved for the collection.
                     4. You can also reset the vector database by clicking the **Clear Database** button.
                     5. You can then proceed to ask queries regarding documents in the **Ask Questions** tab.
                     
@@ -200,10 +262,8 @@ def chat_with_data():
                     if submit_url:	
                         # Validate the YouTube Video URL	
                         if validate_youtube_url(yt_url):	
-                            db, db_build_time = vector_db.run_db_build(input_type="yt_url", embeddings=st.session_state.gpt.embeddings, source_url=yt_url, merge_with_existing_db=merge_with_exist_db)	
+                            submit_ingestion_job("yt_url", merge_with_exist_db, source_url=yt_url)	
                             # video_info = vector_db._get_video_info(yt_url)	
-                            if db is not None:	
-                                st.info(f"Database build completed in {db_build_time:.4f} seconds")	
                         else:	
                             st.error("Invalid URL. Please correct and submit again.")	
             with col2:	
@@ -217,24 +277,32 @@ def chat_with_data():
 
         st.subheader("", divider='blue')
 
-        st.session_state.db_list = os.path.exists(current_db_info_file_path)
+        active_jobs = ingestion_queue.has_active_jobs(collection=st.session_state.collection)
+        st.session_state.active_jobs = active_jobs
+        st.fragment(show_ingestion_jobs, run_every=job_refresh_seconds if active_jobs else None)()
+        st.session_state.db_list = os.path.exists(vector_db.db_info_file_path)
 
         # st.markdown("#### Existing knowledge base info:")
         db_info_col1, db_info_col2 = st.columns([0.2, 0.8])
         with db_info_col1:
-            st.metric(label="Files in vector database", value=count_files_in_directory(db_path))
-            drop_database = st.button(label="Clear Database", use_container_width=True)
+            st.metric(label="Files in vector database", value=count_files_in_directory(vector_db.db_path))
+            drop_database = st.button(label="Clear Database", use_container_width=True, disabled=active_jobs,
+                                      help="The database can be cleared once the ingestion jobs of the collection are finished.")
             if drop_database:
-                delete_folder_contents(kb_path)
-                delete_folder_contents(db_path)
-                delete_folder_contents(processed_dir_path)
+                delete_folder_contents(vector_db.knowledge_base_path)
+                delete_folder_contents(vector_db.db_path)
+                delete_folder_contents(vector_db.processed_dir_path)
                 if st.session_state.db_list:
-                    os.remove(current_db_info_file_path)
+                    os.remove(vector_db.db_info_file_path)
+                if os.path.exists(vector_db.manifest_path):
+                    os.remove(vector_db.manifest_path)
                 st.session_state.db_list = False
         with db_info_col2:
             if st.session_state.db_list:
-                df = pd.read_csv(current_db_info_file_path)
+                df = pd.read_csv(vector_db.db_info_file_path)
                 st.dataframe(df)
+            pool_stats = db_pool.stats()
+            st.markdown(f"<p style='font-size: smaller; color: green;'>Collections in memory: {len(pool_stats['databases'])}, {pool_stats['total_bytes'] / 2**20:.1f} of {pool_stats['max_bytes'] / 2**20:.0f} MB</p>", unsafe_allow_html=True)
             # else:
             #     st.warning("No data exist in database.")
 
@@ -248,20 +316,18 @@ def chat_with_data():
                                        disabled=True)
 
         if (len(query_input) != 0):
-            start_time = time.time()
-            local_db = vector_db.load_local_db(embeddings=st.session_state.gpt.embeddings)
-            if local_db is not None:
-                with st.spinner("Retrieving response ..."):
+            if vector_db.get_db_version() is not None:
+                with st.spinner("Retrieving response ..."), llm_telemetry.feature("qa"):
                     response = st.session_state.gpt.retrieval_qa(query=query_input,
                                                 prompt=prompt_doc_qa(),
-                                                db=local_db,
-                                                return_source_documents=return_source_docs)
+                                                collection=st.session_state.collection,
+                                                return_source_documents=return_source_docs,
+                                                stream=True)
             else:
                 st.error("Please build the Vector Database")
-            end_time = time.time()
 
         if response is not None:
-            response_completion = response['result']
+            response_stream = response['stream']
             response_source_docs = []
             if return_source_docs:
                 source_docs = response['source_documents']
@@ -272,8 +338,26 @@ def chat_with_data():
                     })
 
             with st.expander('', expanded=True):
-                st.markdown(response_completion)
-            if return_source_docs: st.markdown(f"<p style='font-size: smaller; color: green;'>Source documents: {response_source_docs}</p>", unsafe_allow_html=True) 
-            st.markdown(f"<p style='font-size: smaller; color: green;'>Reponse time: {(end_time - start_time):.4f} seconds</p>", unsafe_allow_html=True)
+                # Render the answer incrementally as it streams
+                response_placeholder = st.empty()
+                response_completion = ""
+                try:
+                    for chunk in response_stream:
+                        response_completion += chunk
+                        response_placeholder.markdown(response_completion + "▌")
+                    response_placeholder.markdown(response_completion)
+                except Exception as e:
+                    # A failed stream is neither cached nor counted, so only the error is shown
+                    print(f"Error while streaming the response: {e}")
+                    response_placeholder.empty()
+                    st.error("Unable to complete the response. Please try again.")
+                    response_stream = None
+            if response_stream is not None:
+                if return_source_docs: st.markdown(f"<p style='font-size: smaller; color: green;'>Source documents: {response_source_docs}</p>", unsafe_allow_html=True) 
+                st.markdown(f"<p style='font-size: smaller; color: green;'>Tokens used: {response_stream.total_tokens}</br>First token in {response_stream.time_to_first_token or 0:.4f} seconds</br>Reponse time: {response_stream.total_time:.4f} seconds</p>", unsafe_allow_html=True)
+                semantic_cache = st.session_state.gpt.semantic_cache
+                if semantic_cache is not None:
+                    cache_stats = semantic_cache.stats()
+                    st.markdown(f"<p style='font-size: smaller; color: green;'>{'Answered from the semantic cache. ' if response['cached'] else ''}Semantic cache hit rate: {cache_stats['hit_rate']:.1%} ({cache_stats['hits']} of {cache_stats['hits'] + cache_stats['misses']} queries), saved {cache_stats['saved_latency']:.2f} seconds</p>", unsafe_allow_html=True)
 
 chat_with_data()
\ No newline at end of file
@@ -3,6 +3,7 @@ import os
 import sys
 import shutil
 import streamlit as st
+import pandas as pd
 from streamlit_extras.switch_page_button import switch_page
 
 # Get the absolute path to the project root directory
@@ -11,6 +12,11 @@ src_path = os.path.abspath(os.path.join(project_root, "src"))
 sys.path.insert(0, src_path)
 
 from gpt_utils import GPT_UTILS
+from telemetry_utils import llm_telemetry
+from trace_utils import start_metrics_server
+
+# Serve the ingestion and LLM metrics once per process if a metrics port is configured
+start_metrics_server()
 
 def set_open_api_key(api_key: str):
     st.session_state.OPENAI_API_KEY = api_key
@@ -68,6 +74,22 @@ def page_config():
                 api_key=st.session_state.get("OPENAI_API_KEY", "")
             )    
 
+        show_llm_usage()
+
+def show_llm_usage():
+    """A streamlit function to show the latency, tokens, cost and errors of the requests to Open AI by feature since the app started."""
+    usage = llm_telemetry.summary()
+    if not usage:
+        return
+    with st.expander("LLM usage"):
+        usage_df = pd.DataFrame(usage)
+        st.metric(label="Estimated cost", value=f"${usage_df['Cost'].sum():.4f}")
+        feature_df = usage_df[usage_df['Operation'] != "retrieval_qa"].groupby('Feature')[['Requests', 'Errors', 'Retries', 'Cache_Hits', 'Prompt_Tokens', 'Completion_Tokens', 'Cost']].sum()
+        st.dataframe(feature_df, use_container_width=True)
+        st.dataframe(usage_df[['Operation', 'Model', 'Feature', 'Requests', 'P50', 'P95', 'P99', 'Error_Rate']], use_container_width=True, hide_index=True)
+        for feature, escalations in llm_telemetry.escalation_rates().items():
+            st.caption(f"{feature}: {escalations['rate']:.1%} of {escalations['selections']} requests escalated to the large context model")
+
 @st.cache_resource
 def custom_css():
     st.markdown(
@@ -0,0 +1,296 @@
+""" A python file to define an asyncio client for Open AI's completions and embeddings.
+    Requests run with bounded concurrency under requests-per-minute and tokens-per-minute limits,
+    and rate limited or failed requests are retried with jittered exponential backoff.
+    Single completions can also be hedged with a duplicate request and bounded by a deadline to cut the tail latency.
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+import aiohttp
+import openai
+from langchain.embeddings.base import Embeddings
+from telemetry_utils import llm_telemetry
+from token_utils import num_tokens_from_messages
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+OPENAI_MAX_CONCURRENCY = int(os.environ["OPENAI_MAX_CONCURRENCY"])  # Maximum number of requests in flight per batch
+OPENAI_RPM_LIMIT = int(os.environ["OPENAI_RPM_LIMIT"])  # Requests per minute allowed by the Open AI account
+OPENAI_TPM_LIMIT = int(os.environ["OPENAI_TPM_LIMIT"])  # Tokens per minute allowed by the Open AI account
+OPENAI_MAX_RETRIES = int(os.environ["OPENAI_MAX_RETRIES"])  # Maximum number of retries of a failed request
+EMBEDDING_MODEL = os.environ["EMBEDDING_MODEL"]  # Embedding model used for the vector database
+COMPLETION_DEADLINE = float(os.environ["COMPLETION_DEADLINE"])  # Seconds a hedged completion may take before it falls back to the other model
+HEDGE_PERCENTILE = float(os.environ["HEDGE_PERCENTILE"])  # Percentile of the recent completion latencies after which a duplicate request is sent
+HEDGE_MIN_SAMPLES = int(os.environ["HEDGE_MIN_SAMPLES"])  # Number of recent completions needed before the percentile is used
+HEDGE_DEFAULT_DELAY = float(os.environ["HEDGE_DEFAULT_DELAY"])  # Seconds after which a duplicate request is sent until enough completions are recorded
+
+# Backoff limits in seconds
+base_backoff = 1.0
+max_backoff = 60.0
+
+
+class TOKEN_BUCKET:
+    """ A class to limit the rate of a resource such as requests or tokens per minute.
+        The bucket refills continuously and a caller waits until enough capacity is available.
+    """
+
+    def __init__(self, capacity_per_minute: int) -> None:
+        self.capacity = capacity_per_minute
+        self.refill_rate = capacity_per_minute / 60
+        self.available = float(capacity_per_minute)
+        self.updated_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, amount: float) -> float:
+        """ A method to take the amount from the bucket if available. Returns 0 on success, otherwise the seconds to wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated_time) * self.refill_rate)
+            self.updated_time = now
+            if self.available >= amount:
+                self.available -= amount
+                return 0.0
+            return (amount - self.available) / self.refill_rate
+
+    async def acquire(self, amount: float=1) -> None:
+        """ A method to wait until the amount can be taken from the bucket. Amounts above the capacity are capped to it.
+        """
+        amount = min(amount, self.capacity)
+        wait_time = self._try_acquire(amount)
+        while wait_time > 0:
+            await asyncio.sleep(wait_time)
+            wait_time = self._try_acquire(amount)
+
+    def refund(self, amount: float) -> None:
+        """ A method to return unused capacity, for example when a request used fewer tokens than estimated.
+        """
+        if amount > 0:
+            with self._lock:
+                self.available = min(self.capacity, self.available + amount)
+
+
+# Rate limit buckets of every api key, shared by all the clients of the process
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def shared_rate_limiter(api_key, rpm_limit: int, tpm_limit: int) -> tuple:
+    """ A function to return the requests and tokens per minute buckets of an api key, created on first use.
+        Every session, job and command line run of the process draws from the same buckets, so that together they stay within the account limits.
+    """
+    with rate_limiters_lock:
+        if api_key not in rate_limiters:
+            rate_limiters[api_key] = (TOKEN_BUCKET(rpm_limit), TOKEN_BUCKET(tpm_limit))
+        return rate_limiters[api_key]
+
+
+class ASYNC_OPENAI_CLIENT:
+    """ A class to send batches of completion and embedding requests to Open AI concurrently within the account rate limits.
+        The rate limits of an api key are shared by all the clients of the process.
+        The api_base can point to a local fake endpoint for testing.
+    """
+
+    def __init__(self, api_key, api_base: str=None, max_concurrency: int=OPENAI_MAX_CONCURRENCY, rpm_limit: int=OPENAI_RPM_LIMIT,
+                 tpm_limit: int=OPENAI_TPM_LIMIT, max_retries: int=OPENAI_MAX_RETRIES) -> None:
+        self.api_key = api_key
+        self.api_base = api_base
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.request_bucket, self.token_bucket = shared_rate_limiter(api_key, rpm_limit, tpm_limit)
+        self.retry_count = 0
+        self.deadline = COMPLETION_DEADLINE
+        self.hedge_percentile = HEDGE_PERCENTILE
+        self.hedge_min_samples = HEDGE_MIN_SAMPLES
+        self.hedge_default_delay = HEDGE_DEFAULT_DELAY
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        """ A method to decide whether a failed request should be retried: rate limits, server errors and connection problems.
+        """
+        if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                              openai.error.APIConnectionError, openai.error.Timeout, asyncio.TimeoutError)):
+            return True
+        http_status = getattr(error, "http_status", None)
+        return http_status is not None and (http_status == 429 or http_status >= 500)
+
+    async def _request(self, create, estimated_tokens: int, operation: str, **kwargs):
+        """ A method to send a request within the rate limits, retrying with full-jitter exponential backoff.
+            Every attempt is recorded in the telemetry under the operation, without the time spent waiting for the rate limits.
+        """
+        if self.api_base is not None:
+            kwargs["api_base"] = self.api_base
+
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(estimated_tokens)
+            start_time = time.time()
+            try:
+                response = await create(api_key=self.api_key, **kwargs)
+                used_tokens = response.get("usage", {}).get("total_tokens", estimated_tokens)
+                self.token_bucket.refund(estimated_tokens - used_tokens)
+                llm_telemetry.record_request(operation, kwargs["model"], time.time() - start_time, usage=response.get("usage"))
+                return response
+            except asyncio.CancelledError:
+                llm_telemetry.record_cancelled(operation, kwargs["model"], time.time() - start_time)
+                raise
+            except Exception as error:
+                llm_telemetry.record_request(operation, kwargs["model"], time.time() - start_time, error=error)
+                if attempt == self.max_retries or not self._is_retryable(error):
+                    raise
+                self.retry_count += 1
+                llm_telemetry.record_retry(operation, kwargs["model"])
+                delay = random.uniform(0, min(max_backoff, base_backoff * 2 ** attempt))
+                print(f"Retrying request in {delay:.2f} seconds after error: {error}")
+                await asyncio.sleep(delay)
+
+    async def acompletion(self, model: str, messages: list, temperature: float=0.5, max_tokens: int=1750, estimated_tokens: int=None, **kwargs):
+        """ A method to get a chat completion. The estimated tokens default to the prompt tokens plus the completion budget.
+            Other arguments such as functions are passed on to the request.
+        """
+        if estimated_tokens is None:
+            estimated_tokens = num_tokens_from_messages(messages, model) + max_tokens
+        return await self._request(openai.ChatCompletion.acreate, estimated_tokens, "completion",
+                                   model=model, messages=messages, temperature=temperature, max_tokens=max_tokens, **kwargs)
+
+    def hedge_delay(self, model: str) -> float:
+        """ A method to return the seconds after which a duplicate of a completion is sent: the configured percentile of the recent
+            completion latencies of the model, or the default delay until enough completions are recorded. It never exceeds the deadline.
+        """
+        delay = llm_telemetry.latency_percentile("completion", model, self.hedge_percentile, min_samples=self.hedge_min_samples)
+        return min(delay if delay is not None else self.hedge_default_delay, self.deadline)
+
+    @staticmethod
+    async def _first_success(tasks: set, timeout: float) -> tuple:
+        """ A method to wait for the first of the tasks that succeeds. Returns the task and its result.
+            Raises the last error if every task failed, or asyncio.TimeoutError once the timeout passes. The tasks are not cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        end_time = loop.time() + timeout
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, end_time - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError()
+            for task in done:
+                if task.exception() is None:
+                    return task, task.result()
+                error = task.exception()
+        raise error
+
+    async def ahedged_completion(self, model: str, messages: list, fallback_model: str=None, deadline: float=None, **kwargs):
+        """ A method to get a chat completion within a deadline. A duplicate request is sent if the first one is slower than the hedge delay,
+            the first response wins and the other request is cancelled. Once the deadline passes, both are cancelled and the request
+            is sent to the fallback model with a deadline of its own. Raises openai.error.Timeout if no response arrives in time.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        loop = asyncio.get_running_loop()
+        end_time = loop.time() + deadline
+        tasks = {asyncio.create_task(self.acompletion(model=model, messages=messages, **kwargs))}
+        try:
+            try:
+                _, response = await self._first_success(tasks, min(self.hedge_delay(model), deadline))
+                return response
+            except asyncio.TimeoutError:
+                llm_telemetry.record_tail_event("hedged", model)
+                hedge = asyncio.create_task(self.acompletion(model=model, messages=messages, **kwargs))
+                tasks.add(hedge)
+                task, response = await self._first_success(tasks, max(0.0, end_time - loop.time()))
+                if task is hedge:
+                    llm_telemetry.record_tail_event("hedge_won", model)
+                return response
+        except asyncio.TimeoutError:
+            llm_telemetry.record_tail_event("timeout", model)
+            if fallback_model is None:
+                raise openai.error.Timeout(f"No completion from {model} within {deadline:.1f} seconds")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        llm_telemetry.record_tail_event("fallback", fallback_model)
+        try:
+            return await asyncio.wait_for(self.acompletion(model=fallback_model, messages=messages, **kwargs), timeout=deadline)
+        except asyncio.TimeoutError:
+            llm_telemetry.record_tail_event("timeout", fallback_model)
+            raise openai.error.Timeout(f"No completion from {model} or {fallback_model} within {deadline:.1f} seconds each")
+
+    async def acompletions(self, requests: list) -> list:
+        """ A method to get the chat completions of a batch of requests concurrently. Every request is a dict of acompletion arguments.
+            Returns the responses in the order of the requests, with the exception in place of a request that failed.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded_completion(request):
+            async with semaphore:
+                return await self.acompletion(**request)
+
+        return await asyncio.gather(*[bounded_completion(request) for request in requests], return_exceptions=True)
+
+    async def aembeddings(self, texts: list, model: str=EMBEDDING_MODEL, batch_size: int=64) -> list:
+        """ A method to embed texts in concurrent batches. Returns the vectors in the order of the texts.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded_embedding(batch):
+            async with semaphore:
+                response = await self._request(openai.Embedding.acreate, sum(len(text) for text in batch) // 4 + 1, "embedding", model=model, input=batch)
+                return [item["embedding"] for item in sorted(response["data"], key=lambda item: item["index"])]
+
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        results = await asyncio.gather(*[bounded_embedding(batch) for batch in batches])
+        return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def completions(self, requests: list) -> list:
+        """ A method to run a batch of completion requests from synchronous code.
+        """
+        return asyncio.run(self.acompletions(requests))
+
+    def hedged_completion(self, model: str, messages: list, fallback_model: str=None, deadline: float=None, **kwargs):
+        """ A method to get a hedged chat completion within a deadline from synchronous code.
+            The requests share one HTTP session, which is closed once the cancelled requests are released.
+        """
+        async def hedged_completion_in_session():
+            async with aiohttp.ClientSession() as session:
+                token = openai.aiosession.set(session)
+                try:
+                    return await self.ahedged_completion(model=model, messages=messages, fallback_model=fallback_model, deadline=deadline, **kwargs)
+                finally:
+                    openai.aiosession.reset(token)
+
+        return asyncio.run(hedged_completion_in_session())
+
+    def embeddings(self, texts: list, model: str=EMBEDDING_MODEL) -> list:
+        """ A method to embed texts from synchronous code.
+        """
+        return asyncio.run(self.aembeddings(texts, model=model))
+
+
+class ASYNC_OPENAI_EMBEDDINGS(Embeddings):
+    """ A class to use the asyncio client as the embeddings model of the vector database.
+    """
+
+    def __init__(self, client: ASYNC_OPENAI_CLIENT, model: str=EMBEDDING_MODEL) -> None:
+        self.client = client
+        self.model = model
+
+    def embed_documents(self, texts: list) -> list:
+        """ A method to embed the texts with concurrent batched requests.
+        """
+        return self.client.embeddings(texts, model=self.model)
+
+    def embed_query(self, text: str) -> list:
+        """ A method to embed a single query text.
+        """
+        return self.client.embeddings([text], model=self.model)[0]
+
+    async def aembed_documents(self, texts: list) -> list:
+        return await self.client.aembeddings(texts, model=self.model)
+
+    async def aembed_query(self, text: str) -> list:
+        return (await self.client.aembeddings([text], model=self.model))[0]
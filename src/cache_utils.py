@@ -0,0 +1,467 @@
+""" A python file to define caching utilities that avoid repeated calls to external services.
+    It provides a persistent, content-addressed embedding cache, an embeddings wrapper that uses it,
+    a persistent cache of GPT completion responses, an in-memory semantic cache of answers to similar queries
+    and a persistent cache of the transcripts and metadata of YouTube videos.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from openai.util import convert_to_openai_object
+from langchain.embeddings.base import Embeddings
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+EMBEDDING_CACHE_DIR = os.environ["EMBEDDING_CACHE_DIR"]  # Load Embedding cache directory name
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ["EMBEDDING_CACHE_MAX_ENTRIES"])  # Maximum number of cached embeddings before LRU eviction
+RESPONSE_CACHE_DIR = os.environ["RESPONSE_CACHE_DIR"]  # Load GPT response cache directory name
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ["RESPONSE_CACHE_TTL_SECONDS"])  # Time to live of a cached GPT response
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ["RESPONSE_CACHE_MAX_ENTRIES"])  # Maximum number of cached GPT responses before LRU eviction
+SEMANTIC_CACHE_THRESHOLD = float(os.environ["SEMANTIC_CACHE_THRESHOLD"])  # Minimum cosine similarity of a query to reuse a cached answer
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ["SEMANTIC_CACHE_MAX_ENTRIES"])  # Maximum number of cached answers before LRU eviction
+YOUTUBE_CACHE_DIR = os.environ["YOUTUBE_CACHE_DIR"]  # Load YouTube cache directory name
+YOUTUBE_CACHE_TTL_SECONDS = int(os.environ["YOUTUBE_CACHE_TTL_SECONDS"])  # Time to live of a cached YouTube transcript or video metadata
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+embedding_cache_path = f"{project_root}/{EMBEDDING_CACHE_DIR}"
+response_cache_path = f"{project_root}/{RESPONSE_CACHE_DIR}"
+youtube_cache_path = f"{project_root}/{YOUTUBE_CACHE_DIR}"
+
+# Number of locks of the YouTube entries being fetched. Entries of the same stripe are fetched one after the other
+fetch_lock_stripes = 64
+
+
+class SQLITE_CACHE:
+    """ A base class of the caches persisted in a sqlite database. The database and its directory are created on first use,
+        so that importing or instantiating a cache has no side effect on disk.
+    """
+
+    file_name = None  # Name of the database file in the cache directory
+    schema = []  # Statements that create the tables of the database
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self._connection = None
+        self._connect_lock = threading.Lock()
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        if self._connection is None:
+            with self._connect_lock:
+                if self._connection is None:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    connection = sqlite3.connect(os.path.join(self.cache_dir, self.file_name), check_same_thread=False)
+                    for statement in self.schema:
+                        connection.execute(statement)
+                    connection.commit()
+                    self._connection = connection
+        return self._connection
+
+
+class EMBEDDING_CACHE(SQLITE_CACHE):
+    """ A class to persist embeddings on disk keyed by a hash of (embedding model, chunk text).
+        Least recently used entries are evicted once the cache grows beyond the configured number of entries.
+    """
+
+    file_name = "embeddings.sqlite"
+    schema = ["""CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    last_access REAL NOT NULL)""",
+              "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)"]
+
+    def __init__(self, cache_dir: str=embedding_cache_path, max_entries: int=EMBEDDING_CACHE_MAX_ENTRIES) -> None:
+        super().__init__(cache_dir)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """ A method to build the content address of a chunk for the given embedding model.
+        """
+        return hashlib.sha256(f"{model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: list) -> list:
+        """ A method to look up the cached embeddings of texts. Returns None in place of every cache miss.
+        """
+        keys = [self.make_key(model, text) for text in texts]
+        found = {}
+        with self._lock:
+            # Query in slices to stay below the sqlite variable limit
+            for i in range(0, len(keys), 500):
+                key_slice = list(set(keys[i:i + 500]))
+                placeholders = ",".join("?" * len(key_slice))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", key_slice).fetchall()
+                found.update({key: np.frombuffer(vector, dtype=np.float32).tolist() for key, vector in rows})
+
+            # Refresh the access time of the hits so that they survive eviction
+            now = time.time()
+            self._conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+            self._conn.commit()
+
+            vectors = [found.get(key) for key in keys]
+            hit_count = sum(vector is not None for vector in vectors)
+            self.hits += hit_count
+            self.misses += len(vectors) - hit_count
+
+        return vectors
+
+    def set_many(self, model: str, texts: list, vectors: list) -> None:
+        """ A method to store the embeddings of texts and evict the least recently used entries if required.
+        """
+        now = time.time()
+        rows = [(self.make_key(model, text), np.asarray(vector, dtype=np.float32).tobytes(), now) for text, vector in zip(texts, vectors)]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)", rows)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        """ A method to delete the least recently used entries beyond the maximum number of entries.
+        """
+        num_entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if num_entries > self.max_entries:
+            self._conn.execute("""DELETE FROM embeddings WHERE key IN (
+                                    SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)""",
+                               (num_entries - self.max_entries,))
+
+    def stats(self) -> dict:
+        """ A method to return the hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            num_entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": num_entries,
+        }
+
+    def clear(self) -> None:
+        """ A method to remove every cached embedding and reset the counters.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+
+class CACHED_EMBEDDINGS(Embeddings):
+    """ A class to wrap an embeddings model so that only cache misses are sent to the underlying model.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EMBEDDING_CACHE) -> None:
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = getattr(embeddings, "model", embeddings.__class__.__name__)
+
+    def embed_documents(self, texts: list) -> list:
+        """ A method to embed the texts, reusing cached vectors and embedding only the misses.
+        """
+        vectors = self.cache.get_many(self.model, texts)
+
+        # Embed every distinct missing text only once
+        missing_texts = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing_texts:
+            missing_vectors = self.embeddings.embed_documents(missing_texts)
+            self.cache.set_many(self.model, missing_texts, missing_vectors)
+            embedded = dict(zip(missing_texts, missing_vectors))
+            vectors = [vector if vector is not None else embedded[text] for text, vector in zip(texts, vectors)]
+
+        return vectors
+
+    def embed_query(self, text: str) -> list:
+        """ A method to embed the query text with the underlying model.
+        """
+        return self.embeddings.embed_query(text)
+
+
+class RESPONSE_CACHE(SQLITE_CACHE):
+    """ A class to persist GPT completion responses keyed by model, a hash of the messages, temperature and max_tokens.
+        Entries expire after the time to live, and least recently used entries are evicted beyond the configured number of entries.
+        The cached response keeps its original token usage.
+    """
+
+    file_name = "responses.sqlite"
+    schema = ["""CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_time REAL NOT NULL,
+                    last_access REAL NOT NULL)""",
+              "CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)"]
+
+    def __init__(self, cache_dir: str=response_cache_path, ttl_seconds: int=RESPONSE_CACHE_TTL_SECONDS, max_entries: int=RESPONSE_CACHE_MAX_ENTRIES) -> None:
+        super().__init__(cache_dir)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, messages: list, temperature: float, max_tokens: int, functions: list=None) -> str:
+        """ A method to build the cache key of a completion request.
+        """
+        messages_hash = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+        request = json.dumps([model, messages_hash, temperature, max_tokens, functions or []], sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """ A method to return the cached response of a request, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_time FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+
+        response = convert_to_openai_object(json.loads(row[0]))
+        response["cached"] = True
+        return response
+
+    def set(self, key: str, response) -> None:
+        """ A method to store the response of a request and evict expired and least recently used entries.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, response, created_time, last_access) VALUES (?, ?, ?, ?)",
+                               (key, json.dumps(response), now, now))
+            self._conn.execute("DELETE FROM responses WHERE created_time < ?", (now - self.ttl_seconds,))
+            num_entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if num_entries > self.max_entries:
+                self._conn.execute("""DELETE FROM responses WHERE key IN (
+                                        SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)""",
+                                   (num_entries - self.max_entries,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """ A method to return the hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            num_entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": num_entries,
+        }
+
+    def clear(self) -> None:
+        """ A method to remove every cached response and reset the counters.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+
+class SEMANTIC_QUERY_CACHE:
+    """ A class to answer queries that are semantically close to an earlier query of the same collection and vector db version.
+        Normalized query embeddings are kept in a small in-memory matrix that is searched by inner product, and an answer is reused
+        when the cosine similarity reaches the threshold. The entries of a collection are invalidated when the version of its vector db changes.
+    """
+
+    def __init__(self, threshold: float=SEMANTIC_CACHE_THRESHOLD, max_entries: int=SEMANTIC_CACHE_MAX_ENTRIES) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_latency = 0.0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        """ A method to drop every entry.
+        """
+        self.versions = {}  # Vector db version of every collection with cached entries
+        self._vectors = None  # Normalized query embeddings, one row per entry
+        self._collections = []  # Collection of every entry
+        self._namespaces = []  # Namespace of every entry, such as a hash of the prompt template
+        self._entries = []  # Cached answer of every entry
+        self._last_access = []
+
+    def _delete(self, positions: list) -> None:
+        """ A method to drop the entries at the given positions.
+        """
+        self._vectors = np.delete(self._vectors, positions, axis=0)
+        for position in sorted(positions, reverse=True):
+            del self._collections[position], self._namespaces[position], self._entries[position], self._last_access[position]
+
+    def _check_version(self, collection: str, version) -> None:
+        """ A method to invalidate the entries of a collection if the version of its vector db changed.
+        """
+        if self.versions.get(collection, version) != version:
+            positions = [i for i, entry_collection in enumerate(self._collections) if entry_collection == collection]
+            if positions:
+                self.invalidations += 1
+                self._delete(positions)
+        self.versions[collection] = version
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, version, namespace: str, query_vector, collection: str=None):
+        """ A method to return the cached answer of the most similar query of the collection above the threshold, or None.
+        """
+        with self._lock:
+            self._check_version(collection, version)
+            if self._entries:
+                similarities = self._vectors @ self._normalize(query_vector)[0]
+                similarities[[entry_namespace != namespace or entry_collection != collection
+                              for entry_namespace, entry_collection in zip(self._namespaces, self._collections)]] = -np.inf
+                best = int(similarities.argmax())
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    self.saved_latency += self._entries[best]["latency"]
+                    self._last_access[best] = time.time()
+                    return self._entries[best]
+            self.misses += 1
+            return None
+
+    def set(self, version, namespace: str, query_vector, entry: dict, collection: str=None) -> None:
+        """ A method to cache the answer of a query to a collection. The entry should hold the latency of producing the answer,
+            and the least recently used entry is evicted once the cache is full.
+        """
+        with self._lock:
+            self._check_version(collection, version)
+            vector = self._normalize(query_vector)
+            if self._entries and len(self._entries) >= self.max_entries:
+                self._delete([int(np.argmin(self._last_access))])
+            self._vectors = vector if self._vectors is None else np.vstack([self._vectors, vector])
+            self._collections.append(collection)
+            self._namespaces.append(namespace)
+            self._entries.append(entry)
+            self._last_access.append(time.time())
+
+    def stats(self) -> dict:
+        """ A method to return the hit/miss counters, the latency saved by hits and the current size of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "saved_latency": self.saved_latency,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+        }
+
+    def clear(self) -> None:
+        """ A method to remove every cached answer and reset the counters.
+        """
+        with self._lock:
+            self._reset()
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+            self.saved_latency = 0.0
+
+
+class YOUTUBE_CACHE(SQLITE_CACHE):
+    """ A class to persist the transcripts and metadata of YouTube videos keyed by video id and kind, so that every video is fetched at most once per time to live.
+        Concurrent requests of the same entry wait for a single fetch, and failed or empty fetches are not cached.
+    """
+
+    file_name = "videos.sqlite"
+    schema = ["""CREATE TABLE IF NOT EXISTS videos (
+                    video_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_time REAL NOT NULL,
+                    PRIMARY KEY (video_id, kind))"""]
+
+    def __init__(self, cache_dir: str=youtube_cache_path, ttl_seconds: int=YOUTUBE_CACHE_TTL_SECONDS) -> None:
+        super().__init__(cache_dir)
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # A fixed set of locks striped by entry, so that the memory of the locks stays bounded for a long-lived server
+        self._fetch_locks = [threading.Lock() for _ in range(fetch_lock_stripes)]
+
+    def _lookup(self, video_id: str, kind: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_time FROM videos WHERE video_id = ? AND kind = ?", (video_id, kind)).fetchone()
+            if row is not None and time.time() - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM videos WHERE video_id = ? AND kind = ?", (video_id, kind))
+                self._conn.commit()
+                row = None
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, video_id: str, kind: str, value) -> None:
+        """ A method to store an entry of a video and remove the expired entries.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO videos (video_id, kind, value, created_time) VALUES (?, ?, ?, ?)",
+                               (video_id, kind, json.dumps(value), now))
+            self._conn.execute("DELETE FROM videos WHERE created_time < ?", (now - self.ttl_seconds,))
+            self._conn.commit()
+
+    def get_or_fetch(self, video_id: str, kind: str, fetch):
+        """ A method to return the cached entry of a video, or to fetch and cache it if it is missing or expired.
+            The fetch function is called without arguments and its exceptions are raised to the caller.
+        """
+        value = self._lookup(video_id, kind)
+        if value is None:
+            with self._fetch_locks[hash((video_id, kind)) % len(self._fetch_locks)]:
+                # Another thread may have fetched the entry while this one was waiting
+                value = self._lookup(video_id, kind)
+                if value is None:
+                    with self._lock:
+                        self.misses += 1
+                    value = fetch()
+                    if value:
+                        self.set(video_id, kind, value)
+                    return value
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def stats(self) -> dict:
+        """ A method to return the hit/miss counters and the current size of the cache.
+        """
+        with self._lock:
+            num_entries = self._conn.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": num_entries,
+        }
+
+    def clear(self) -> None:
+        """ A method to remove every cached entry and reset the counters.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM videos")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
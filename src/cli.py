@@ -0,0 +1,299 @@
+""" A command line entry point to ingest documents and URLs into a collection of the vector database and to summarize documents in bulk, without the Streamlit UI.
+    Ingestion is checkpointed in batches of files through the source manifest, and summaries are appended to a JSONL file,
+    so that a run interrupted by a crash resumes where it stopped.
+
+    Run from the project root:
+        python src/cli.py ingest --dir path/to/documents --collection reports
+        python src/cli.py ingest --urls urls.txt
+        python src/cli.py ingest --sitemap https://example.com/sitemap.xml
+        python src/cli.py summarize --dir path/to/documents --output summaries.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv, find_dotenv
+from db_utils import VECTOR_DB_UTILS, loader_mapping, _load_file, EXTRACTION_WORKERS, EMBEDDING_BATCH_SIZE
+from gpt_utils import GPT_UTILS
+from summary_utils import SUMMARY_UTILS
+from manifest_utils import SOURCE_MANIFEST
+from collection_utils import DEFAULT_COLLECTION, build_lock
+from async_gpt_utils import OPENAI_MAX_CONCURRENCY
+from token_utils import num_tokens_from_string
+from trace_utils import tracer
+from telemetry_utils import llm_telemetry
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Number of files staged and ingested per checkpoint of the manifest
+default_checkpoint_files = 100
+
+
+class THROUGHPUT:
+    """ A class to count the documents, chunks and tokens processed by a run and report them per second.
+    """
+
+    def __init__(self) -> None:
+        self.start_time = time.time()
+        self.docs = 0
+        self.chunks = 0
+        self.tokens = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def report(self, action: str) -> str:
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return (f"{action} {self.docs} documents ({self.skipped} skipped, {self.failed} failed), {self.chunks} chunks and {self.tokens} tokens "
+                f"in {elapsed:.2f} seconds: {self.docs / elapsed:.2f} docs/s, {self.chunks / elapsed:.2f} chunks/s, {self.tokens / elapsed:.2f} tokens/s")
+
+
+def find_files(directory: str) -> dict:
+    """ A function to find the supported documents of a directory tree.
+        Returns the file paths keyed by their source name, the relative path with the directory separators replaced,
+        since the sources of a collection are stored in a single folder.
+    """
+    files = {}
+    for root, _, file_names in os.walk(directory):
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() in loader_mapping:
+                file_path = os.path.join(root, file_name)
+                files[os.path.relpath(file_path, directory).replace(os.sep, "__")] = file_path
+    return dict(sorted(files.items()))
+
+
+def count_ingested(db, manifest: SOURCE_MANIFEST, sources: list) -> tuple:
+    """ A function to count the chunks and tokens recorded in the manifest for the ingested sources.
+    """
+    chunk_ids = [chunk_id for source in sources if source in manifest for chunk_id in manifest.get_chunk_ids(source)]
+    num_tokens = sum(db.docstore.search(chunk_id).metadata.get("num_tokens", 0) for chunk_id in chunk_ids)
+    return len(chunk_ids), num_tokens
+
+
+def ingest_directory(vector_db: VECTOR_DB_UTILS, embeddings, directory: str, checkpoint_files: int, overwrite: bool, throughput: THROUGHPUT) -> None:
+    """ A function to ingest a directory tree in batches of files. Every batch is staged in its own folder and merged into the collection,
+        which saves the manifest, so that a restarted run skips the files that were already ingested.
+    """
+    # The collection is locked for the whole run, so that the builds of other processes do not interleave with its checkpoints and staging folder
+    with build_lock(vector_db.db_path):
+        files = find_files(directory)
+        manifest = SOURCE_MANIFEST(vector_db.manifest_path)
+        pending = {name: path for name, path in files.items()
+                   if overwrite or name not in manifest or manifest.file_changed(name, path) is not None}
+        throughput.skipped += len(files) - len(pending)
+        print(f"Found {len(files)} documents, {len(pending)} to ingest into collection {vector_db.collection}")
+
+        staging_path = os.path.join(os.path.dirname(vector_db.processed_dir_path), "cli_staging")
+        names = list(pending)
+        for start in range(0, len(names), checkpoint_files):
+            # Files left over by an interrupted run are staged again
+            shutil.rmtree(staging_path, ignore_errors=True)
+            os.makedirs(staging_path)
+            batch = names[start:start + checkpoint_files]
+            for name in batch:
+                shutil.copy2(pending[name], os.path.join(staging_path, name))
+
+            vector_db.knowledge_base_path = staging_path
+            db, _ = vector_db.run_db_build(input_type="documents", embeddings=embeddings, merge_with_existing_db=not (overwrite and start == 0))
+            ingested = [report["File_Name"] for report in vector_db.extraction_report if report["Status"] == "Success"]
+            throughput.docs += len(ingested)
+            throughput.failed += len(batch) - len(ingested)
+            if db is not None:
+                num_chunks, num_tokens = count_ingested(db, SOURCE_MANIFEST(vector_db.manifest_path), ingested)
+                throughput.chunks += num_chunks
+                throughput.tokens += num_tokens
+            print(f"Checkpoint {start + len(batch)}/{len(names)}: {throughput.report('ingested')}")
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+
+def ingest_urls(vector_db: VECTOR_DB_UTILS, embeddings, urls: list, num_workers: int, refresh: bool, throughput: THROUGHPUT) -> None:
+    """ A function to ingest a list of web pages and YouTube videos.
+        Web pages are crawled concurrently with the crawler and streamed into a single update of the vector db, while YouTube videos are ingested one at a time.
+        URLs that are already in the manifest are skipped unless refresh is set.
+    """
+    # The collection is locked for the whole run, so that the builds of other processes do not interleave with it
+    with build_lock(vector_db.db_path):
+        from url_utils import validate_input_url, validate_youtube_url, WEB_CRAWLER
+
+        urls = list(dict.fromkeys(urls))
+        manifest = SOURCE_MANIFEST(vector_db.manifest_path)
+        pending = [url for url in urls if refresh or url not in manifest]
+        throughput.skipped += len(urls) - len(pending)
+        print(f"Found {len(urls)} URLs, {len(pending)} to ingest into collection {vector_db.collection}")
+
+        invalid_urls = {url for url in pending if not validate_input_url(url)}
+        for url in invalid_urls:
+            print(f"Failed to ingest {url}: Invalid URL")
+        throughput.failed += len(invalid_urls)
+        youtube_urls = [url for url in pending if url not in invalid_urls and validate_youtube_url(url)]
+        web_urls = [url for url in pending if url not in invalid_urls and not validate_youtube_url(url)]
+
+        if web_urls:
+            crawler = WEB_CRAWLER(extraction_workers=num_workers)
+
+            def crawl_pages():
+                for completed, page in enumerate(crawler.crawl(web_urls), 1):
+                    if completed % 100 == 0 or completed == len(web_urls):
+                        print(f"Crawled {completed}/{len(web_urls)} pages: {crawler.stats}")
+                    yield page
+
+            db, _ = vector_db.run_db_build(input_type="web_pages", embeddings=embeddings, merge_with_existing_db=True, pages=crawl_pages())
+            ingested = [report["File_Name"] for report in vector_db.extraction_report if report["Status"] == "Success"]
+            throughput.docs += len(ingested)
+            throughput.failed += len(web_urls) - len(ingested)
+            if db is not None:
+                num_chunks, num_tokens = count_ingested(db, SOURCE_MANIFEST(vector_db.manifest_path), ingested)
+                throughput.chunks += num_chunks
+                throughput.tokens += num_tokens
+            print(f"Web pages: {throughput.report('ingested')}")
+
+        for url in youtube_urls:
+            db, _ = vector_db.run_db_build(input_type="yt_url", embeddings=embeddings, source_url=url, merge_with_existing_db=True)
+            if db is None:
+                print(f"Failed to ingest {url}: No content was added to the vector database")
+                throughput.failed += 1
+                continue
+            num_chunks, num_tokens = count_ingested(db, SOURCE_MANIFEST(vector_db.manifest_path), [url])
+            throughput.docs += 1
+            throughput.chunks += num_chunks
+            throughput.tokens += num_tokens
+            print(f"{url}: {throughput.report('ingested')}")
+
+
+def read_completed(output_file: str) -> set:
+    """ A function to read the documents already summarized into the JSONL output.
+        A last line cut off by a crash is dropped so that new records start on a line of their own.
+    """
+    if not os.path.exists(output_file):
+        return set()
+    with open(output_file, "rb") as f:
+        content = f.read()
+    if content and not content.endswith(b"\n"):
+        content = content[:content.rfind(b"\n") + 1]
+        with open(output_file, "wb") as f:
+            f.write(content)
+    records = [json.loads(line) for line in content.decode("utf-8").splitlines() if line.strip()]
+    return {record["path"] for record in records if "summary" in record}
+
+
+def summarize_directory(gpt: GPT_UTILS, directory: str, output_file: str, word_limit: int, num_workers: int, throughput: THROUGHPUT) -> None:
+    """ A function to summarize every supported document of a directory tree into a JSONL file with one record per document.
+        Documents are summarized concurrently, and documents that already have a summary in the output are skipped.
+    """
+    summarizer = SUMMARY_UTILS(gpt=gpt)
+    files = find_files(directory)
+    completed = read_completed(output_file)
+    pending = [file_path for file_path in files.values() if os.path.relpath(file_path, directory) not in completed]
+    throughput.skipped += len(files) - len(pending)
+    print(f"Found {len(files)} documents, {len(pending)} to summarize")
+
+    def summarize(file_path):
+        # Worker threads do not inherit the feature of the caller
+        with llm_telemetry.feature("summary"):
+            return summarize_file(file_path)
+
+    def summarize_file(file_path):
+        start_time = time.time()
+        _, document_contents, _, error = _load_file(file_path)
+        if error:
+            raise ValueError(error)
+        text = "\n\n".join(document.page_content for document in document_contents)
+        if not text.strip():
+            raise ValueError("No text content")
+        summary, tokens_used = summarizer.summarize(text_input=text, word_limit=word_limit)
+        return {
+            "summary": summary,
+            "num_chunks": len(summarizer.text_splitter.split_text(text)),
+            "input_tokens": num_tokens_from_string(text, gpt.default_model),
+            "tokens_used": tokens_used,
+            "elapsed": time.time() - start_time,
+        }
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor, open(output_file, "a", encoding="utf-8") as f:
+        futures = {executor.submit(summarize, file_path): file_path for file_path in pending}
+        for future in as_completed(futures):
+            record = {"path": os.path.relpath(futures[future], directory)}
+            try:
+                record.update(future.result())
+                throughput.docs += 1
+                throughput.chunks += record["num_chunks"]
+                throughput.tokens += record["tokens_used"]
+            except Exception as e:
+                record["error"] = str(e)
+                throughput.failed += 1
+            # Every record is flushed so that a crash loses at most the documents in flight
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            print(f"{record['path']}: {throughput.report('summarized')}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="Open AI API key, read from OPENAI_API_KEY by default")
+    parser.add_argument("--max-concurrency", type=int, default=OPENAI_MAX_CONCURRENCY, help="Maximum number of concurrent Open AI requests per batch of chunks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Ingest a directory tree or a URL list into a collection")
+    source_group = ingest_parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--dir", help="Directory tree of documents to ingest")
+    source_group.add_argument("--urls", help="File with one web page or YouTube URL per line")
+    source_group.add_argument("--sitemap", help="URL of a sitemap whose pages are crawled and ingested")
+    ingest_parser.add_argument("--collection", default=DEFAULT_COLLECTION)
+    ingest_parser.add_argument("--workers", type=int, default=EXTRACTION_WORKERS, help="Number of processes extracting documents or web pages")
+    ingest_parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE, help="Number of chunks embedded at a time")
+    ingest_parser.add_argument("--checkpoint-files", type=int, default=default_checkpoint_files, help="Number of files ingested per checkpoint")
+    ingest_parser.add_argument("--overwrite", action="store_true", help="Replace the collection instead of merging into it")
+    ingest_parser.add_argument("--refresh", action="store_true", help="Ingest URLs again even if they are in the manifest")
+
+    summarize_parser = subparsers.add_parser("summarize", help="Summarize the documents of a directory tree into a JSONL file")
+    summarize_parser.add_argument("--dir", required=True, help="Directory tree of documents to summarize")
+    summarize_parser.add_argument("--output", required=True, help="JSONL file that summaries are appended to")
+    summarize_parser.add_argument("--word-limit", type=int, default=250)
+    summarize_parser.add_argument("--workers", type=int, default=4, help="Number of documents summarized at the same time")
+    for command_parser in [ingest_parser, summarize_parser]:
+        command_parser.add_argument("--telemetry-output", help="Optional JSON file that the telemetry of the requests to Open AI is written to")
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error("An Open AI API key is required, either with --api-key or OPENAI_API_KEY")
+    gpt = GPT_UTILS(api_key=args.api_key)
+    gpt.async_client.max_concurrency = args.max_concurrency
+    throughput = THROUGHPUT()
+
+    if args.command == "ingest":
+        vector_db = VECTOR_DB_UTILS(collection=args.collection)
+        vector_db.extraction_workers = args.workers
+        vector_db.embedding_batch_size = args.batch_size
+        with llm_telemetry.feature("ingestion"):
+            if args.dir:
+                ingest_directory(vector_db, gpt.embeddings, args.dir, args.checkpoint_files, args.overwrite, throughput)
+            else:
+                if args.urls:
+                    with open(args.urls, "r") as f:
+                        urls = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+                else:
+                    from url_utils import WEB_CRAWLER
+                    urls = WEB_CRAWLER().sitemap_urls(args.sitemap)
+                ingest_urls(vector_db, gpt.embeddings, urls, args.workers, args.refresh, throughput)
+        print(throughput.report("Ingested"))
+        for stage in tracer.stage_totals():
+            print(f"  {stage['Stage']:<20} {stage['Seconds']:>10.2f} s {stage['Share']:>7.1%} of build time, {stage['Spans']} spans, "
+                  f"{stage['Bytes']} bytes, {stage['Chunks']} chunks, {stage['Tokens']} tokens")
+    else:
+        summarize_directory(gpt, args.dir, args.output, args.word_limit, args.workers, throughput)
+        print(throughput.report("Summarized"))
+
+    usage = llm_telemetry.summary()
+    print(f"Open AI requests: {sum(row['Requests'] for row in usage)}, errors: {sum(row['Errors'] for row in usage)}, "
+          f"retries: {sum(row['Retries'] for row in usage)}, estimated cost: ${sum(row['Cost'] for row in usage):.4f}")
+    if args.telemetry_output:
+        llm_telemetry.export(args.telemetry_output)
+
+    sys.exit(1 if throughput.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
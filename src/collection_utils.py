@@ -0,0 +1,189 @@
+""" A python file to organize the knowledge base into named collections and to keep the loaded vector databases in a bounded pool.
+    Every collection has its own knowledge base, processed documents, FAISS index, manifest and db details.
+    The builds of a collection are serialized across threads and processes by a lock file in its vector db directory.
+    The default collection keeps the original locations in the project root, other collections live under the collections directory.
+"""
+
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv, find_dotenv
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, where builds are only serialized within the process
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+KNOWLDGE_BASE_DIR = os.environ["KNOWLDGE_BASE_DIR"]  # Load Knowledge base directory name
+FAISS_DB_DIR = os.environ["FAISS_DB_DIR"]  # Load Vector database directory name
+COLLECTIONS_DIR = os.environ["COLLECTIONS_DIR"]  # Directory of the named collections other than the default one
+DEFAULT_COLLECTION = os.environ["DEFAULT_COLLECTION"]  # Name of the collection stored in the original locations
+DB_POOL_MAX_MB = int(os.environ["DB_POOL_MAX_MB"])  # Memory budget of the vector databases loaded at the same time
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+collections_path = f"{project_root}/{COLLECTIONS_DIR}"
+
+# Collection names are used as directory names
+collection_name_pattern = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+build_lock_file_name = ".build.lock"
+
+
+def validate_collection_name(collection: str) -> bool:
+    """ A function to check that a collection name is safe to use as a directory name.
+    """
+    return bool(collection_name_pattern.match(collection))
+
+
+def collection_paths(collection: str=DEFAULT_COLLECTION) -> dict:
+    """ A function to return the knowledge base, processed documents, vector db, db details and manifest paths of a collection.
+    """
+    if not validate_collection_name(collection):
+        raise ValueError(f"Invalid collection name: {collection}")
+    root = project_root if collection == DEFAULT_COLLECTION else os.path.join(collections_path, collection)
+    return {
+        "knowledge_base_path": f"{root}/{KNOWLDGE_BASE_DIR}",
+        "processed_dir_path": f"{root}/processed_documents",
+        "db_path": f"{root}/{FAISS_DB_DIR}",
+        "db_info_file_path": f"{root}/db_details.csv",
+        "manifest_path": f"{root}/db_manifest.json",
+    }
+
+
+def list_collections() -> list:
+    """ A function to list the default collection and every named collection created so far.
+    """
+    collections = [DEFAULT_COLLECTION]
+    if os.path.exists(collections_path):
+        collections.extend(sorted(name for name in os.listdir(collections_path)
+                                  if validate_collection_name(name) and os.path.isdir(os.path.join(collections_path, name))
+                                  and name != DEFAULT_COLLECTION))
+    return collections
+
+
+def create_collection(collection: str) -> None:
+    """ A function to create the directories of a collection.
+    """
+    paths = collection_paths(collection)
+    os.makedirs(paths["knowledge_base_path"], exist_ok=True)
+    os.makedirs(paths["db_path"], exist_ok=True)
+
+
+def delete_collection(collection: str) -> None:
+    """ A function to remove a named collection with all of its files. The default collection cannot be deleted.
+    """
+    if collection == DEFAULT_COLLECTION:
+        raise ValueError("The default collection cannot be deleted")
+    collection_paths(collection)
+    shutil.rmtree(os.path.join(collections_path, collection), ignore_errors=True)
+
+
+class BUILD_LOCK:
+    """ A class to serialize the builds of a vector db across the threads of a process and across processes, such as Streamlit workers and command line runs.
+        The lock is reentrant within a thread, so that a caller holding it can run builds that take it again.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.lock_path = os.path.join(db_path, build_lock_file_name)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+                self._file = open(self.lock_path, "a")
+                if fcntl is not None:
+                    fcntl.flock(self._file, fcntl.LOCK_EX)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            # Closing the file releases the lock of other processes
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+
+# Build locks of every vector db path, shared by the threads of the process
+build_locks = {}
+build_locks_lock = threading.Lock()
+
+
+def build_lock(db_path: str) -> BUILD_LOCK:
+    """ A function to return the build lock of a vector db path, created on first use.
+    """
+    with build_locks_lock:
+        return build_locks.setdefault(os.path.abspath(db_path), BUILD_LOCK(os.path.abspath(db_path)))
+
+
+class DB_POOL:
+    """ A class to share loaded vector databases between sessions, keyed by database path.
+        The pool is bounded by the estimated memory of its databases and evicts the least recently used ones once the budget is exceeded.
+        The most recently used database is always kept, even if it exceeds the budget on its own.
+    """
+
+    def __init__(self, max_bytes: int=DB_POOL_MAX_MB * 2**20) -> None:
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()  # (version stamp, db, size in bytes) of every db path, least recently used first
+        self.total_bytes = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, db_path: str, version):
+        """ A method to return the pooled db of a path if it matches the version stamp, otherwise None. The caller should hold the lock.
+        """
+        entry = self._entries.get(db_path)
+        if entry is None or entry[0] != version:
+            return None
+        self._entries.move_to_end(db_path)
+        return entry[1]
+
+    def put(self, db_path: str, version, db, size: int) -> None:
+        """ A method to add a db to the pool and evict the least recently used databases beyond the budget. The caller should hold the lock.
+        """
+        self.pop(db_path)
+        self._entries[db_path] = (version, db, size)
+        self.total_bytes += size
+        self.loads += 1
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            evicted_path, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.evictions += 1
+            print(f"Evicted vector database from memory: {evicted_path}")
+
+    def pop(self, db_path: str) -> None:
+        """ A method to drop the db of a path from the pool. The caller should hold the lock.
+        """
+        entry = self._entries.pop(db_path, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def stats(self) -> dict:
+        """ A method to return the pooled databases with their size, and the load and eviction counters.
+        """
+        return {
+            "databases": {db_path: size for db_path, (_, _, size) in self._entries.items()},
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
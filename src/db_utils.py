@@ -5,93 +5,230 @@
 import os
 import time
 import datetime
+import uuid
 import shutil
+import multiprocessing
 import pandas as pd
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from langchain.vectorstores import FAISS
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.document_loaders import TextLoader, PDFMinerLoader, UnstructuredWordDocumentLoader, UnstructuredExcelLoader
 from langchain.docstore.document import Document
 from langchain.document_loaders import YoutubeLoader
 from dotenv import load_dotenv, find_dotenv
+from cache_utils import EMBEDDING_CACHE, CACHED_EMBEDDINGS, YOUTUBE_CACHE
+from manifest_utils import SOURCE_MANIFEST
+from index_utils import FAISS_INDEX_BUILDER, FAISS_INDEX_TYPE, FAISS_NPROBE, HNSW_EF_SEARCH, FAISS_VECTOR_ENCODING, EXACT_VECTOR_STORE, set_search_params, describe_index, save_index_config, delete_chunks, vector_encoding
+from token_utils import num_tokens_from_string
+from sparse_index import BM25_INDEX, sparse_index_file_name
+from retriever_utils import MMR_RETRIEVER
+from dedup_utils import CHUNK_DEDUP_INDEX, DEDUP_ENABLED, dedup_index_file_name
+from collection_utils import DB_POOL, DEFAULT_COLLECTION, collection_paths, build_lock
+from trace_utils import tracer
 
 _ = load_dotenv(find_dotenv())  # read local .env file
 
 # Load Environment Variables
-KNOWLDGE_BASE_DIR = os.environ["KNOWLDGE_BASE_DIR"]  # Load Knowledge base directory name
-FAISS_DB_DIR = os.environ["FAISS_DB_DIR"]  # Load Vector database directory name
 CHUNK_SIZE = int(os.environ["CHUNK_SIZE"])  # Loading Text chunk size as integer variable
 CHUNK_OVERLAP = int(os.environ["CHUNK_OVERLAP"]) # Loading Text chunk overlap as integer variable
+EXTRACTION_WORKERS = int(os.environ["EXTRACTION_WORKERS"])  # Number of processes used to extract documents in parallel
+EMBEDDING_BATCH_SIZE = int(os.environ["EMBEDDING_BATCH_SIZE"])  # Number of chunks embedded and added to the vector db at a time
+EXACT_RERANK = os.environ["EXACT_RERANK"] == "True"  # Keep the exact vectors of compressed indexes on disk to re-rank search candidates
 
-# Get the absolute path to the project root directory
-project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# Process-wide pool of loaded vector databases of every collection
+db_pool = DB_POOL()
 
-knowledge_base_path = f"{project_root}/{KNOWLDGE_BASE_DIR}"
-processed_dir_path = f"{project_root}/processed_documents"
-faiss_db_path = f"{project_root}/{FAISS_DB_DIR}"
-current_db_info_file_path = f"{project_root}/db_details.csv"
+# Process-wide cache of YouTube transcripts and video metadata, shared by every session and persisted across restarts
+youtube_cache = YOUTUBE_CACHE()
+
+loader_mapping = {
+        '.pdf': PDFMinerLoader,
+        '.docx': UnstructuredWordDocumentLoader,
+        '.txt': TextLoader,
+        '.xlsx': UnstructuredExcelLoader,
+    }
+
+
+def _load_file(file_path: str) -> tuple:
+    """ A function to extract the contents of a single document. It is defined at module level so that it can run in a process pool.
+        Returns the file path, the extracted documents, the extraction time and an error message if the extraction failed.
+    """
+    start_time = time.time()
+    ext = "." + file_path.rsplit(".", 1)[-1].lower()  # Extensions are matched case-insensitively, like the command line file filter
+    try:
+        if ext not in loader_mapping:
+            raise ValueError(f"Unsupported file extension: {ext}")
+        loader_class = loader_mapping[ext]  # get the defined loader class for the given file type
+        loader = loader_class(file_path)  # define the loader for the file
+        document_contents = loader.load()  # extract the document contents using loader
+        return file_path, document_contents, time.time() - start_time, None
+    except Exception as e:
+        return file_path, [], time.time() - start_time, str(e)
+
+
+def _batched(iterable, batch_size: int):
+    """ A generator to group the items of an iterable into lists of at most the batch size.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
 
 
 class VECTOR_DB_UTILS:
-    """ A class to define various utilities for vector databases.
+    """ A class to define various utilities for vector databases. Every instance works on a single collection of the knowledge base.
     """
 
-    def __init__(self) -> None:
-        self.knowledge_base_path = knowledge_base_path
-        self.db_path = faiss_db_path
+    def __init__(self, collection: str=DEFAULT_COLLECTION) -> None:
+        paths = collection_paths(collection)
+        self.collection = collection
+        self.knowledge_base_path = paths["knowledge_base_path"]
+        self.processed_dir_path = paths["processed_dir_path"]
+        self.db_path = paths["db_path"]
+        self.db_info_file_path = paths["db_info_file_path"]
+        self.manifest_path = paths["manifest_path"]
         self.chunk_size = CHUNK_SIZE
         self.chunk_overlap = CHUNK_OVERLAP
+        self.extraction_workers = EXTRACTION_WORKERS
+        self.embedding_batch_size = EMBEDDING_BATCH_SIZE
+        self.index_type = FAISS_INDEX_TYPE
+        self.nprobe = FAISS_NPROBE
+        self.ef_search = HNSW_EF_SEARCH
+        self.extraction_report = []
+        self.stage_breakdown = []  # Totals of every stage of the last db build
+        self.embedding_cache = EMBEDDING_CACHE()
+        self.dedup_enabled = DEDUP_ENABLED
+        self.vector_encoding = FAISS_VECTOR_ENCODING
+        self.exact_rerank = EXACT_RERANK
 
-    def create_documents(self) -> list:
+    def create_documents(self, file_paths: list=None, num_workers: int=None) -> list:
         """ A method to extract the document contents from the documents that exist in a folder and returns the list of documents.
+            Only the given file paths are loaded if provided.
+        """
+        
+        if file_paths is None:
+            # Check if documents folder exist and not empty
+            if os.path.exists(self.knowledge_base_path) and os.listdir(self.knowledge_base_path):
+                file_paths = [os.path.join(self.knowledge_base_path, file_name) for file_name in os.listdir(self.knowledge_base_path)]
+            else:
+                return None
+
+        # Define empty documents list
+        documents = []
+        file_infos = []
+        for file_info, document_contents in self.iter_documents(file_paths=file_paths, num_workers=num_workers):
+            documents.extend(document_contents)  # Append the existing document list
+            file_infos.append(file_info)
+
+        df = pd.DataFrame(file_infos, columns=['Input_Type', 'File_Name', 'File_Type', 'Executed_Time'])
+    
+        return documents, df
+
+    def iter_documents(self, file_paths: list, num_workers: int=None, progress_callback=None):
+        """ A generator to lazily extract the document contents file by file and yield the file info with its documents.
+            Files are extracted in a process pool when more than one worker is configured, keeping only a bounded number of files in flight.
+            A file that fails to load is reported in the extraction report and left in the knowledge base.
         """
 
-        loader_mapping = {
-                '.pdf': PDFMinerLoader,
-                '.docx': UnstructuredWordDocumentLoader,
-                '.txt': TextLoader,
-                '.xlsx': UnstructuredExcelLoader,
+        # Sort the files so that the documents are returned in a deterministic order
+        file_paths = sorted(file_paths)
+        num_workers = self.extraction_workers if num_workers is None else num_workers
+        self.extraction_report = []
+        os.makedirs(self.processed_dir_path, exist_ok=True)
+
+        # Iterate over the extraction results in the order of the files
+        for file_path, document_contents, extraction_time, error in self._map_files(file_paths, num_workers):
+            file_name = os.path.basename(file_path)
+            ext = "." + file_path.rsplit(".", 1)[-1].lower()
+            self.extraction_report.append({
+                'File_Name': file_name,
+                'Status': "Failed" if error else "Success",
+                'Extraction_Time': extraction_time,
+                'Error': error,
+            })
+            if progress_callback is not None:
+                progress_callback("extracting", len(self.extraction_report), len(file_paths))
+            # Files are extracted in worker processes, so their spans are recorded with the time measured by the workers
+            tracer.record("extract", extraction_time, file_name=file_name, file_type=ext,
+                          bytes=os.path.getsize(file_path) if os.path.exists(file_path) else 0,
+                          documents=len(document_contents), **({"error": error} if error else {}))
+
+            if error:
+                print(f"Error while extracting {file_name}: {error}")
+                continue
+
+            file_info = {
+                'Input_Type': "Document",
+                'File_Name': file_name,
+                'File_Type': ext,  # Get the file extension
+                'Executed_Time': datetime.datetime.now()     # Get the current time
             }
-        
-        # Check if documents folder exist and not empty
-        if os.path.exists(self.knowledge_base_path) and os.listdir(self.knowledge_base_path):
-            # Define empty documents list
-            documents = []
-            df = pd.DataFrame(columns=['Input_Type', 'File_Name', 'File_Type', 'Executed_Time'])
-            os.makedirs(processed_dir_path, exist_ok=True)
-            # Iterate over files and extract the text from documents
-            for file_name in os.listdir(self.knowledge_base_path):
-                file_path = os.path.join(self.knowledge_base_path, file_name)
-                ext = "." + file_path.rsplit(".", 1)[-1]
-                
-                if ext in loader_mapping:
-                    loader_class = loader_mapping[ext]  # get the defined loader class for the given file type
-                    loader = loader_class(file_path)  # define the loader for the file
-                    document_contents = loader.load()  # extract the document contents using loader
-                    documents.extend(document_contents)  # Append the existing document list
-
-                    file_info = {
-                        'Input_Type': "Document",
-                        'File_Name': file_name,
-                        'File_Type': ext,  # Get the file extension
-                        'Executed_Time': datetime.datetime.now()     # Get the current time
-                    }
-                    print(file_info)
-                    temp_df = pd.DataFrame(file_info, index=[0])
-
-                    # Append the information to the DataFrame
-                    df = pd.concat([df, temp_df], ignore_index=True)
-
-                    # Move processed documents to processed folder
-                    shutil.move(file_path, os.path.join(processed_dir_path, os.path.basename(file_path)))   
-                else:
-                    raise ValueError(f"Unsupported file extension: {ext}")
-        
-            return documents, df
+            print(file_info)
+
+            yield file_info, document_contents
+
+            # Move processed documents to processed folder
+            self._move_to_processed([file_path])
+
+    def _map_files(self, file_paths: list, num_workers: int):
+        """ A generator to extract the files in order, with at most twice the number of workers submitted to the process pool at a time.
+            The workers are spawned rather than forked, since forking the threads of the app, such as the job workers, could copy held locks.
+        """
+        if num_workers > 1 and len(file_paths) > 1:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(file_paths)), mp_context=multiprocessing.get_context("spawn")) as executor:
+                pending = deque()
+                for file_path in file_paths:
+                    pending.append(executor.submit(_load_file, file_path))
+                    if len(pending) >= 2 * num_workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
         else:
-            return None
+            for file_path in file_paths:
+                yield _load_file(file_path)
+
+    def _move_to_processed(self, file_paths: list) -> None:
+        """ A method to move documents from the knowledge base into the processed documents folder.
+        """
+        os.makedirs(self.processed_dir_path, exist_ok=True)
+        for file_path in file_paths:
+            if os.path.dirname(os.path.abspath(file_path)) != os.path.abspath(self.processed_dir_path):
+                shutil.move(file_path, os.path.join(self.processed_dir_path, os.path.basename(file_path)))
+
+    def _scan_documents(self, manifest: SOURCE_MANIFEST):
+        """ A method to compare the documents against the manifest.
+            Knowledge base files and processed documents already recorded in the manifest are considered.
+            Returns the fingerprints of changed files keyed by file path, the unchanged knowledge base files and the deleted sources.
+        """
+        candidates = {}
+        if os.path.exists(self.processed_dir_path):
+            for file_name in os.listdir(self.processed_dir_path):
+                if file_name in manifest:
+                    candidates[file_name] = os.path.join(self.processed_dir_path, file_name)
+        if os.path.exists(self.knowledge_base_path):
+            for file_name in os.listdir(self.knowledge_base_path):
+                # Newly uploaded files take precedence over processed documents with the same name
+                candidates[file_name] = os.path.join(self.knowledge_base_path, file_name)
+
+        changed_files = {}
+        unchanged_files = []
+        for file_name, file_path in candidates.items():
+            fingerprint = manifest.file_changed(file_name, file_path)
+            if fingerprint is not None:
+                changed_files[file_path] = fingerprint
+            elif os.path.dirname(file_path) == self.knowledge_base_path:
+                unchanged_files.append(file_path)
+
+        deleted_sources = [source for source in manifest.list_sources(input_type="Document") if source not in candidates]
+
+        return changed_files, unchanged_files, deleted_sources
         
     def _get_video_info(self, yt_url) -> dict:
-        """Get important video information.
+        """Get important video information, cached by video id.
 
         Components are:
             - title
@@ -101,6 +238,13 @@ class VECTOR_DB_UTILS:
             - channel_author
             - and more.
         """
+        video_id = YoutubeLoader.extract_video_id(yt_url)
+        return youtube_cache.get_or_fetch(video_id, "info", lambda: self._fetch_video_info(video_id))
+
+    @staticmethod
+    def _fetch_video_info(video_id) -> dict:
+        """ A method to download the information of a video from YouTube.
+        """
         try:
             from pytube import YouTube
 
@@ -109,7 +253,7 @@ class VECTOR_DB_UTILS:
                 "Could not import pytube python package. "
                 "Please it install it with `pip install pytube`."
             )
-        yt = YouTube(yt_url)
+        yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
         video_info = {
             "title": yt.title,
             "description": yt.description,
@@ -123,12 +267,15 @@ class VECTOR_DB_UTILS:
         
     def youtube_transcript(self, yt_url):
         """ A method to extract transcriptions from Youtube video and create
+            The transcript and the video information are cached by video id, and the information is fetched once for both the metadata and the file info.
         """
         try:
-            loader = YoutubeLoader.from_youtube_url(youtube_url=yt_url, add_video_info=True)
-            yt_transcript = loader.load()
+            video_id = YoutubeLoader.extract_video_id(yt_url)
+            transcripts = youtube_cache.get_or_fetch(video_id, "transcript",
+                                                     lambda: [document.page_content for document in YoutubeLoader(video_id).load()])
             # Access Video Info
             yt_info = self._get_video_info(yt_url)
+            yt_transcript = [Document(page_content=transcript, metadata={"source": video_id, **yt_info}) for transcript in transcripts]
             file_info = {
                 'Input_Type': "YouTube Video",
                 'File_Name': f"{yt_info['title']}({yt_url})",
@@ -153,78 +300,336 @@ class VECTOR_DB_UTILS:
             print("No new document to process")
             return None
         else:
-            text_chunks = text_splitter.split_documents(documents)
+            text_chunks = self._count_tokens(text_splitter.split_documents(documents))
         
         return text_chunks
 
-    def run_db_build(self, input_type, embeddings, page_content="", source_url= "", merge_with_existing_db: bool=False, **kwargs):
+    @staticmethod
+    def _count_tokens(chunks: list) -> list:
+        """ A method to store the token count of every chunk in its metadata, so that it is computed only once at ingestion.
+        """
+        for chunk in chunks:
+            chunk.metadata["num_tokens"] = num_tokens_from_string(chunk.page_content)
+        return chunks
+
+    def iter_chunks(self, documents):
+        """ A generator to split the documents into chunks one document at a time.
+        """
+
+        # Define the text splitter configurations
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+        for document in documents:
+            with tracer.span("split", source=document.metadata.get("source"), bytes=len(document.page_content.encode("utf-8"))) as span:
+                chunks = self._count_tokens(text_splitter.split_documents([document]))
+                span.set(chunks=len(chunks), tokens=sum(chunk.metadata["num_tokens"] for chunk in chunks))
+            # The span is closed before yielding, since the consumer of the chunks runs its own stages in between
+            yield from chunks
+
+    def add_chunks(self, db, chunks, embeddings, batch_size: int=None, progress_callback=None, sparse_index: BM25_INDEX=None,
+                   dedup_index: CHUNK_DEDUP_INDEX=None, exact_store: EXACT_VECTOR_STORE=None, source_key=None):
+        """ A method to embed the chunks in fixed-size batches and add every batch to the vector db, so that only one batch of vectors is held in memory.
+            A new vector db of the configured index type is created if no db is given. The chunks are also added to the sparse index if one is given.
+            If a dedup index is given, duplicates and near-duplicates of recorded chunks are skipped before they are embedded,
+            and recorded as dependents of their originals under the manifest key returned by source_key for their source.
+            If an exact vector store is given, the uncompressed vectors are also written to disk.
+            Returns the vector db and the ids of the added chunks grouped by their source.
+        """
+        batch_size = self.embedding_batch_size if batch_size is None else batch_size
+        builder = FAISS_INDEX_BUILDER(embeddings=embeddings, db=db, index_type=self.index_type, nprobe=self.nprobe, ef_search=self.ef_search,
+                                      encoding=self.vector_encoding, exact_store=exact_store)
+        source_chunk_ids = {}
+        num_chunks = 0
+
+        def identify_chunks():
+            for chunk in chunks:
+                chunk_id = str(uuid.uuid4())
+                source = chunk.metadata.get("source")
+                if dedup_index is None or dedup_index.add(chunk_id, chunk.page_content, source=source,
+                                                          source_key=source_key(source) if source_key is not None else None):
+                    yield chunk_id, chunk
+
+        for batch in _batched(identify_chunks(), batch_size):
+            chunk_ids = [chunk_id for chunk_id, _ in batch]
+            texts = [chunk.page_content for _, chunk in batch]
+            metadatas = [chunk.metadata for _, chunk in batch]
+            batch_attributes = {"chunks": len(batch), "tokens": sum(metadata.get("num_tokens", 0) for metadata in metadatas)}
+            with tracer.span("embed", bytes=sum(len(text.encode("utf-8")) for text in texts), **batch_attributes):
+                vectors = embeddings.embed_documents(texts)
+
+            with tracer.span("index_add", **batch_attributes):
+                builder.add(texts=texts, vectors=vectors, metadatas=metadatas, ids=chunk_ids)
+                if sparse_index is not None:
+                    sparse_index.add(chunk_ids, texts)
+                if exact_store is not None:
+                    exact_store.add(chunk_ids, vectors)
+
+            for chunk_id, metadata in zip(chunk_ids, metadatas):
+                source_chunk_ids.setdefault(metadata.get("source"), []).append(chunk_id)
+
+            num_chunks += len(batch)
+            if progress_callback is not None:
+                progress_callback("embedding", num_chunks, None)
+
+        with tracer.span("index_finish", chunks=num_chunks):
+            db = builder.finish()
+        return db, source_chunk_ids
+
+    def run_db_build(self, input_type, embeddings, page_content="", source_url= "", merge_with_existing_db: bool=False, progress_callback=None,
+                     pages=None, **kwargs):
         """ A method to build the vector db and store in the defined database path.
+            Documents are loaded, split, embedded and added to the db as a stream, so that memory stays bounded by the batch size.
+            The web_pages input type ingests the results of a crawl, such as WEB_CRAWLER.crawl, as they are yielded.
+            While merging, sources recorded in the manifest are skipped if unchanged, re-embedded if modified
+            and their vectors are dropped if the source was deleted.
+            The optional progress callback is called with the stage name, the completed count and the total count if known.
+            Every stage is traced, and the totals of the stages of the build are kept in stage_breakdown.
+            Builds of the same collection wait for each other, including the builds of other processes.
         """
+        with build_lock(self.db_path), \
+                tracer.span("run_db_build", collection=self.collection, input_type=input_type, merge=merge_with_existing_db) as span:
+            final_db, build_time = self._run_db_build(input_type, embeddings, page_content, source_url, merge_with_existing_db, progress_callback, pages)
+            span.set(succeeded=final_db is not None, index_size=final_db.index.ntotal if final_db is not None else 0)
+        self.stage_breakdown = tracer.stage_breakdown(span.trace_id)
+        return final_db, build_time
+
+    def _run_db_build(self, input_type, embeddings, page_content, source_url, merge_with_existing_db, progress_callback, pages):
         try:
             start_time = time.time()
             os.makedirs(self.db_path, exist_ok=True)
 
+            manifest = SOURCE_MANIFEST(self.manifest_path)
+            # Load a private copy of the existing db since it is modified in place
+            exist_db = None
+            if merge_with_existing_db:
+                with tracer.span("load_existing_db") as span:
+                    exist_db = self.load_local_db(embeddings, use_cache=False)
+                    span.set(index_size=exist_db.index.ntotal if exist_db is not None else 0)
+            if exist_db is None:
+                # Nothing to compare against, so every source is ingested from scratch
+                manifest.reset()
+
+            dedup_index = None
+            if self.dedup_enabled:
+                dedup_index = self._load_dedup_index(exist_db) if exist_db is not None else CHUNK_DEDUP_INDEX()
+            elif os.path.exists(os.path.join(self.db_path, dedup_index_file_name)):
+                # The saved signatures would go stale, so they are rebuilt from the db once dedup is enabled again
+                os.remove(os.path.join(self.db_path, dedup_index_file_name))
+
+            fingerprints = {}  # Fingerprints of the new or modified sources to ingest
+            deleted_sources = []  # Sources that no longer exist
+            file_infos = []  # Information of the extracted sources for the db details
+
             # Get extracted documents content
             if input_type == "documents":
-                documents, doc_df = self.create_documents()
+                if exist_db is not None:
+                    with tracer.span("scan_documents") as span:
+                        changed_files, unchanged_files, deleted_sources = self._scan_documents(manifest)
+                        span.set(changed=len(changed_files), unchanged=len(unchanged_files), deleted=len(deleted_sources))
+                    print(f"Unchanged: {len(unchanged_files)}, Changed: {len(changed_files)}, Deleted: {len(deleted_sources)}")
+                    self._move_to_processed(unchanged_files)
+                else:
+                    file_paths = [os.path.join(self.knowledge_base_path, file_name) for file_name in os.listdir(self.knowledge_base_path)] if os.path.exists(self.knowledge_base_path) else []
+                    changed_files = {file_path: manifest.file_fingerprint(file_path) for file_path in file_paths}
+
+                file_fingerprints = {os.path.basename(file_path): fingerprint for file_path, fingerprint in changed_files.items()}
+
+                def stream_documents():
+                    for file_info, document_contents in self.iter_documents(file_paths=list(changed_files), progress_callback=progress_callback):
+                        file_infos.append(file_info)
+                        # Only the files that were extracted successfully are recorded in the manifest
+                        fingerprints[file_info['File_Name']] = file_fingerprints[file_info['File_Name']]
+                        if dedup_index is not None:
+                            dedup_index.ignored_ids.update(manifest.get_chunk_ids(file_info['File_Name']))
+                            dedup_index.forget_sources([file_info['File_Name']])
+                        yield from document_contents
+
+                documents = stream_documents()
             elif input_type == "web_url":
                 documents = [Document(page_content=page_content, metadata={"source": source_url})]
-                file_info = {
+                file_infos.append({
                     'Input_Type': "Web Page",
                     'File_Name': f"{source_url}",
                     'File_Type': None,  # Get the file extension
                     'Executed_Time': datetime.datetime.now()     # Get the current time
-                }
-                doc_df = pd.DataFrame(file_info, index=[0])
+                })
+                fingerprints[source_url] = manifest.text_changed(source_url, page_content)
+
+            elif input_type == "web_pages":
+                def stream_pages():
+                    self.extraction_report = []
+                    for page in pages:
+                        self.extraction_report.append({
+                            'File_Name': page["url"],
+                            'Status': "Failed" if page["error"] else "Success",
+                            'Extraction_Time': page["fetch_time"] + page["extraction_time"],
+                            'Error': page["error"],
+                        })
+                        # Pages are downloaded and extracted by the crawler, so their spans are recorded with the time it measured
+                        tracer.record("crawl_page", page["fetch_time"] + page["extraction_time"], source=page["url"], bytes=page["bytes"],
+                                      from_cache=page["from_cache"], **({"error": page["error"]} if page["error"] else {}))
+                        if page["error"]:
+                            print(f"Error while crawling {page['url']}: {page['error']}")
+                            continue
+
+                        fingerprint = manifest.text_changed(page["url"], page["text"])
+                        if fingerprint is None:
+                            continue  # The page is unchanged
+                        fingerprints[page["url"]] = fingerprint
+                        if dedup_index is not None:
+                            dedup_index.ignored_ids.update(manifest.get_chunk_ids(page["url"]))
+                            dedup_index.forget_sources([page["url"]])
+                        file_infos.append({
+                            'Input_Type': "Web Page",
+                            'File_Name': page["url"],
+                            'File_Type': None,
+                            'Executed_Time': datetime.datetime.now()     # Get the current time
+                        })
+                        yield Document(page_content=page["text"], metadata={"source": page["url"]})
+
+                documents = stream_pages()
 
             elif input_type == "yt_url":
-                documents, doc_df = self.youtube_transcript(yt_url=source_url)
+                with tracer.span("youtube_transcript", source=source_url):
+                    documents, doc_df = self.youtube_transcript(yt_url=source_url)
+                file_infos.extend(doc_df.to_dict("records"))
+                fingerprints[source_url] = manifest.text_changed(source_url, "".join(document.page_content for document in documents))
 
-            # Get the text chunks
-            if documents is not None:
-                processed_documents = self.process_documents(documents=documents)
-            else:
-                print("No document content is provided.")                
+            if input_type in ["web_url", "yt_url"] and fingerprints[source_url] is None:
+                print(f"Source is unchanged: {source_url}")
+                documents, file_infos, fingerprints = [], [], {}
 
-            # Build vector db
-            new_db = FAISS.from_documents(documents=processed_documents, embedding=embeddings)
+            # The BM25 index of the existing db is updated in place with the same chunk ids
+            sparse_index = exist_db.sparse_index if exist_db is not None else BM25_INDEX()
 
-            if merge_with_existing_db:
-                exist_db = self.load_local_db(embeddings)
-                # print(f"Exist_DB:{exist_db.docstore.__dict__}")
-                if exist_db is not None:
-                    print("Merging new db into existing. . .")
-                    exist_db.merge_from(new_db)
-                    # Save the new merged database
-                    exist_db.save_local(self.db_path)
-                    final_db = exist_db
-                    # print(f"Merged_DB:{final_db.docstore.__dict__}")
-                    if os.path.exists(current_db_info_file_path):
-                        exist_df = pd.read_csv(current_db_info_file_path)
+            if dedup_index is not None:
+                # Chunks of the sources that are about to be replaced must not count as originals of their new chunks,
+                # and the duplicates skipped by the previous version of a source are recorded again as it is ingested.
+                # The files and pages are only known to be re-ingested as they stream, so they are handled as each one arrives
+                replaced_sources = deleted_sources + ([] if input_type in ["documents", "web_pages"] else list(fingerprints))
+                dedup_index.ignored_ids.update(chunk_id for source in replaced_sources for chunk_id in manifest.get_chunk_ids(source))
+                dedup_index.forget_sources(replaced_sources)
+
+            # Exact vectors are only kept for compressed indexes, and only extended if they cover the existing db.
+            # A float32 db may be built or converted into a compressed index by this build, so a new store is started for it
+            exact_store = None
+            if self.exact_rerank:
+                if exist_db is not None and exist_db.exact_store is not None:
+                    exact_store = exist_db.exact_store
+                elif (self.vector_encoding != "float32" or self.index_type == "IVFPQ") and (exist_db is None or vector_encoding(exist_db.index) == "float32"):
+                    exact_store = EXACT_VECTOR_STORE(self.db_path)
+            new_exact_store = exact_store is not None and (exist_db is None or exact_store is not exist_db.exact_store)
+
+            # The manifest records documents by file name, and a web page or video by the URL it was ingested from
+            def source_key(source):
+                return os.path.basename(source) if input_type == "documents" else source if input_type == "web_pages" else source_url
+
+            # Split, embed and add the chunks to the vector db in batches, sending only the chunks missing from the embedding cache to the embeddings model
+            cached_embeddings = CACHED_EMBEDDINGS(embeddings=embeddings, cache=self.embedding_cache)
+            final_db, chunk_ids = self.add_chunks(db=exist_db,
+                                                  chunks=self.iter_chunks(documents),
+                                                  embeddings=cached_embeddings,
+                                                  progress_callback=progress_callback,
+                                                  sparse_index=sparse_index,
+                                                  dedup_index=dedup_index,
+                                                  exact_store=exact_store,
+                                                  source_key=source_key)
+            print(f"Embedding cache: {self.embedding_cache.stats()}")
+            if dedup_index is not None:
+                print(f"Dedup index: {dedup_index.stats()}")
+
+            if final_db is None:
+                print("No document content is provided.")
+                return None, 0.00
+            if new_exact_store and vector_encoding(final_db.index) == "float32":
+                # The index fell back to, or stayed, an uncompressed flat index whose vectors are already exact
+                exact_store.discard()
+                exact_store = None
+            final_db.sparse_index = sparse_index
+            final_db.exact_store = exact_store
+
+            # Group the chunk ids by the source key of the manifest
+            source_chunk_ids = {source: [] for source in fingerprints}
+            for source, ids in chunk_ids.items():
+                source_chunk_ids.setdefault(source_key(source), []).extend(ids)
+
+            doc_df = pd.DataFrame(file_infos, columns=['Input_Type', 'File_Name', 'File_Type', 'Executed_Time'])
+            # Deleted sources and sources that were re-ingested replace their previous vectors
+            stale_sources = deleted_sources + [source for source in fingerprints if source in manifest]
+            handed_over_ids = {}  # Stale chunks kept for the sources that skipped their duplicates
+
+            if exist_db is not None:
+                print("Merging new chunks into existing. . .")
+                stale_ids = set(final_db.index_to_docstore_id.values()).intersection(
+                    chunk_id for source in stale_sources for chunk_id in manifest.get_chunk_ids(source))
+                if dedup_index is not None:
+                    for chunk_id in list(stale_ids):
+                        owner = dedup_index.hand_over(chunk_id)
+                        if owner is not None:
+                            final_db.docstore.search(chunk_id).metadata["source"] = owner[1]
+                            handed_over_ids.setdefault(owner[0], []).append(chunk_id)
+                            stale_ids.discard(chunk_id)
+                    if handed_over_ids:
+                        print(f"Keeping {sum(map(len, handed_over_ids.values()))} chunks for the sources of their duplicates. . .")
+                if stale_ids:
+                    print(f"Dropping {len(stale_ids)} stale chunks. . .")
+                    with tracer.span("delete_stale", chunks=len(stale_ids)):
+                        delete_chunks(final_db, list(stale_ids))
+                        sparse_index.remove(stale_ids)
+                        if dedup_index is not None:
+                            dedup_index.remove(stale_ids)
+                        if exact_store is not None:
+                            exact_store.remove(stale_ids)
+                # Save the new merged database
+                if stale_ids or chunk_ids or handed_over_ids:
+                    with tracer.span("save_local", index_size=final_db.index.ntotal):
+                        final_db.save_local(self.db_path)
+                    with tracer.span("save_side_indexes"):
+                        sparse_index.save(self.db_path)
+                        if dedup_index is not None:
+                            dedup_index.save(self.db_path)
+                        if exact_store is not None:
+                            exact_store.save()
+                        save_index_config(self.db_path, describe_index(final_db.index))
+                    self._cache_db(final_db)
+                with tracer.span("write_db_details") as span:
+                    if os.path.exists(self.db_info_file_path):
+                        exist_df = pd.read_csv(self.db_info_file_path)
+                        exist_df = exist_df[~exist_df['File_Name'].isin(stale_sources)]
                     else:
                         exist_df = pd.DataFrame(columns=['Input_Type', 'File_Name', 'File_Type', 'Executed_Time'])
                     
                     merge_df = pd.concat([exist_df, doc_df], ignore_index=True)
-                    merge_df.to_csv(current_db_info_file_path, index=False)
-                else:
-                    print("No db exists. . .")
-                    new_db.save_local(self.db_path)
-                    final_db = new_db
-                    # print(f"New_DB:{final_db.docstore.__dict__}")
-                    doc_df.to_csv(current_db_info_file_path, index=False)
+                    merge_df.to_csv(self.db_info_file_path, index=False)
+                    span.set(rows=len(merge_df))
             else:
                 print("Overwriting existing database. . .")
-                new_db.save_local(self.db_path)
-                final_db = new_db
-                # print(f"New_DB:{final_db.docstore.__dict__}")
-                doc_df.to_csv(current_db_info_file_path, index=False)
+                with tracer.span("save_local", index_size=final_db.index.ntotal):
+                    final_db.save_local(self.db_path)
+                with tracer.span("save_side_indexes"):
+                    sparse_index.save(self.db_path)
+                    if dedup_index is not None:
+                        dedup_index.save(self.db_path)
+                    if exact_store is not None:
+                        exact_store.save()
+                    else:
+                        EXACT_VECTOR_STORE.clear(self.db_path)
+                    save_index_config(self.db_path, describe_index(final_db.index))
+                self._cache_db(final_db)
+                with tracer.span("write_db_details", rows=len(doc_df)):
+                    doc_df.to_csv(self.db_info_file_path, index=False)
 
-            # if merge_with_existing_db:
-            #     new_db.save_local(self.db_path)
-            # else:
-            #     new_db.save_local(self.db_path)
+            # Record the ingested sources in the manifest
+            input_type_labels = {"documents": "Document", "web_url": "Web Page", "web_pages": "Web Page", "yt_url": "YouTube Video"}
+            with tracer.span("save_manifest", sources=len(fingerprints)):
+                for source in stale_sources:
+                    manifest.remove(source)
+                for source, fingerprint in fingerprints.items():
+                    manifest.update(source, input_type_labels[input_type], fingerprint, source_chunk_ids.get(source, []))
+                for source, ids in handed_over_ids.items():
+                    manifest.add_chunk_ids(source, ids)
+                manifest.save()
 
-            
             end_time = time.time()
 
             return final_db, end_time-start_time
@@ -234,10 +639,115 @@ class VECTOR_DB_UTILS:
             print(error_msg)
             return None, 0.00
 
-    def load_local_db(self, embeddings):
-        """ A simple method to load locally saved vector database.
+    def get_db_version(self):
+        """ A method to return the version stamp of the locally saved vector database, derived from the modification time and size of its files.
+            Returns None if no database exists.
         """
-        if os.path.exists(self.db_path) and os.path.isfile(os.path.join(self.db_path, "index.faiss")):
-            return FAISS.load_local(self.db_path, embeddings)
-        else:
+        try:
+            version = []
+            for file_name in ["index.faiss", "index.pkl"]:
+                stat = os.stat(os.path.join(self.db_path, file_name))
+                version.extend([stat.st_mtime_ns, stat.st_size])
+            return tuple(version)
+        except FileNotFoundError:
+            return None
+
+    def _estimate_db_bytes(self, db) -> int:
+        """ A method to estimate the memory held by a loaded vector database from the size of its saved files and its MMR embedding matrix.
+            The exact vectors are excluded since they are memory-mapped.
+        """
+        num_bytes = 0
+        for file_name in ["index.faiss", "index.pkl", sparse_index_file_name]:
+            file_path = os.path.join(self.db_path, file_name)
+            if os.path.exists(file_path):
+                num_bytes += os.path.getsize(file_path)
+        mmr_retriever = getattr(db, "mmr_retriever", None)
+        if mmr_retriever is not None and mmr_retriever.vectors is not None:
+            num_bytes += mmr_retriever.vectors.nbytes
+        return num_bytes
+
+    def _cache_db(self, db) -> None:
+        """ A method to share a freshly saved vector database with every session of the process.
+        """
+        db.mmr_retriever = MMR_RETRIEVER.from_db(db)
+        db.version = self.get_db_version()
+        db.collection = self.collection
+        with db_pool.lock:
+            db_pool.put(self.db_path, db.version, db, self._estimate_db_bytes(db))
+
+    def load_local_db(self, embeddings, use_cache: bool=True):
+        """ A simple method to load locally saved vector database of the collection.
+            By default a process-wide copy is shared between sessions. It is loaded on the first query, reloaded from disk when the version stamp changes
+            and evicted from the pool when other collections need the memory.
+            The returned object uses the given embeddings but shares the index and docstore of the pooled copy, so it must not be modified.
+        """
+        version = self.get_db_version()
+        if version is None:
+            with db_pool.lock:
+                db_pool.pop(self.db_path)
             return None
+
+        if not use_cache:
+            db = FAISS.load_local(self.db_path, embeddings)
+            self.set_search_params(db)
+            self._load_sparse_index(db)
+            self._load_exact_store(db)
+            db.collection = self.collection
+            return db
+
+        with db_pool.lock:
+            db = db_pool.get(self.db_path, version)
+            if db is None:
+                print(f"Loading vector database of collection {self.collection} from disk. . .")
+                db = FAISS.load_local(self.db_path, embeddings)
+                self.set_search_params(db)
+                self._load_sparse_index(db)
+                self._load_exact_store(db)
+                db.mmr_retriever = MMR_RETRIEVER.from_db(db)
+                db.version = version
+                db.collection = self.collection
+                db_pool.put(self.db_path, version, db, self._estimate_db_bytes(db))
+
+        local_db = FAISS(embeddings, db.index, db.docstore, db.index_to_docstore_id)
+        local_db.sparse_index = db.sparse_index
+        local_db.exact_store = db.exact_store
+        local_db.mmr_retriever = db.mmr_retriever
+        local_db.version = db.version
+        local_db.collection = db.collection
+        return local_db
+
+    def _load_dedup_index(self, db) -> CHUNK_DEDUP_INDEX:
+        """ A method to load the chunk signatures saved next to the FAISS index.
+            Databases saved without a dedup index get one recorded from their docstore.
+        """
+        dedup_index = CHUNK_DEDUP_INDEX.load(self.db_path)
+        if dedup_index is None:
+            print("Building dedup index from the vector database. . .")
+            dedup_index = CHUNK_DEDUP_INDEX.from_db(db)
+        return dedup_index
+
+    def _load_exact_store(self, db) -> None:
+        """ A method to attach the exact vectors saved next to a compressed FAISS index to the vector db, if exact re-ranking is enabled.
+        """
+        db.exact_store = None
+        if self.exact_rerank and vector_encoding(db.index) != "float32":
+            db.exact_store = EXACT_VECTOR_STORE.load(self.db_path)
+
+    def _load_sparse_index(self, db) -> None:
+        """ A method to attach the BM25 index saved next to the FAISS index to the vector db.
+            Databases saved without a sparse index get one built from their docstore.
+        """
+        sparse_index = BM25_INDEX.load(self.db_path)
+        if sparse_index is None:
+            print("Building sparse index from the vector database. . .")
+            sparse_index = BM25_INDEX.from_db(db)
+            sparse_index.save(self.db_path)
+        db.sparse_index = sparse_index
+
+    def set_search_params(self, db, nprobe: int=None, ef_search: int=None) -> None:
+        """ A method to set the search-time parameters of the vector db index, such as nprobe for IVF and efSearch for HNSW indexes.
+            The configured values are used if no values are given.
+        """
+        set_search_params(db.index,
+                          nprobe=self.nprobe if nprobe is None else nprobe,
+                          ef_search=self.ef_search if ef_search is None else ef_search)
@@ -0,0 +1,219 @@
+""" A python file to detect duplicate and near-duplicate chunks before they are embedded.
+    Every chunk of the vector database is recorded with an exact hash of its normalized text and a 64-bit SimHash of its word shingles.
+    The signatures are kept in a side index next to the FAISS index, so that new chunks are checked against the existing corpus.
+    The sources that skipped a chunk as a duplicate are recorded with the original chunk, so that its content is kept when its own source is removed.
+"""
+
+import os
+import re
+import pickle
+import hashlib
+import numpy as np
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+DEDUP_ENABLED = os.environ["DEDUP_ENABLED"] == "True"  # Skip duplicate and near-duplicate chunks at ingestion
+DEDUP_MAX_DISTANCE = int(os.environ["DEDUP_MAX_DISTANCE"])  # Maximum number of differing SimHash bits of a near-duplicate chunk
+
+dedup_index_file_name = "dedup_index.pkl"
+
+# Number of words per shingle of the SimHash
+shingle_size = 3
+
+simhash_bits = 64
+bit_positions = np.arange(simhash_bits, dtype=np.uint64)
+
+
+def normalize_text(text: str) -> str:
+    """ A function to lower case a text and collapse its whitespace, so that formatting differences do not hide duplicates.
+    """
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def exact_hash(normalized_text: str) -> str:
+    """ A function to hash the normalized text of a chunk.
+    """
+    return hashlib.sha1(normalized_text.encode("utf-8")).hexdigest()
+
+
+def simhash(normalized_text: str) -> int:
+    """ A function to calculate the 64-bit SimHash of the word shingles of a normalized text.
+        Texts that share most of their shingles get hashes that differ in only a few bits.
+    """
+    words = normalized_text.split(" ")
+    shingles = {" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") for shingle in shingles],
+                      dtype=np.uint64)
+
+    # Every bit of the SimHash is the majority vote of that bit over the shingle hashes
+    bits = ((hashes[:, None] >> bit_positions) & np.uint64(1)).astype(np.int32)
+    votes = (2 * bits - 1).sum(axis=0)
+    return int(sum(1 << i for i in np.flatnonzero(votes > 0)))
+
+
+class CHUNK_DEDUP_INDEX:
+    """ A class to record the signatures of the chunks of the vector db and detect duplicates of new chunks.
+        Near-duplicates are found through band tables: the SimHash is split into max_distance + 1 bands,
+        so that two hashes within the maximum distance share at least one band exactly.
+    """
+
+    def __init__(self, max_distance: int=DEDUP_MAX_DISTANCE) -> None:
+        self.max_distance = max_distance
+        num_bands = max_distance + 1
+        self.band_edges = [simhash_bits * i // num_bands for i in range(num_bands + 1)]
+        self.exact_hashes = {}  # Chunk id of every exact hash
+        self.signatures = {}  # Exact hash and SimHash of every chunk, keyed by chunk id
+        self.bands = [{} for _ in range(num_bands)]  # Chunk ids of every band value, one table per band
+        self.ignored_ids = set()  # Chunks that are about to be replaced and must not count as originals
+        self.dependents = {}  # Sources of the skipped duplicates of every original chunk, as a dict of source key to source
+        self.source_originals = {}  # Original chunks of the skipped duplicates of every source key
+        self.num_exact_duplicates = 0
+        self.num_near_duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def _band_values(self, hash_value: int) -> list:
+        return [(hash_value >> start) & ((1 << (end - start)) - 1) for start, end in zip(self.band_edges, self.band_edges[1:])]
+
+    def find_duplicate(self, text: str):
+        """ A method to return the chunk id of an exact or near-duplicate of the text, or None.
+        """
+        normalized_text = normalize_text(text)
+        return self._find_duplicate(exact_hash(normalized_text), simhash(normalized_text))
+
+    def _find_duplicate(self, text_hash: str, hash_value: int):
+        chunk_id = self.exact_hashes.get(text_hash)
+        if chunk_id is not None and chunk_id not in self.ignored_ids:
+            return chunk_id
+
+        for band, band_value in zip(self.bands, self._band_values(hash_value)):
+            for chunk_id in band.get(band_value, ()):
+                if chunk_id not in self.ignored_ids and bin(self.signatures[chunk_id][1] ^ hash_value).count("1") <= self.max_distance:
+                    return chunk_id
+        return None
+
+    def add(self, chunk_id: str, text: str, source: str=None, source_key: str=None) -> bool:
+        """ A method to record a chunk unless it duplicates a recorded chunk.
+            If the source of the chunk is given, a duplicate is recorded as a dependent of its original under the source key, which defaults to the source.
+            Returns True if the chunk was recorded, False if it is a duplicate and should be skipped.
+        """
+        normalized_text = normalize_text(text)
+        text_hash, hash_value = exact_hash(normalized_text), simhash(normalized_text)
+        duplicate_id = self._find_duplicate(text_hash, hash_value)
+        if duplicate_id is not None:
+            if self.signatures[duplicate_id][0] == text_hash:
+                self.num_exact_duplicates += 1
+            else:
+                self.num_near_duplicates += 1
+            if source is not None:
+                self._add_dependent(duplicate_id, source_key if source_key is not None else source, source)
+            return False
+
+        self.exact_hashes[text_hash] = chunk_id
+        self.signatures[chunk_id] = (text_hash, hash_value)
+        for band, band_value in zip(self.bands, self._band_values(hash_value)):
+            band.setdefault(band_value, set()).add(chunk_id)
+        return True
+
+    def _add_dependent(self, chunk_id: str, source_key: str, source: str) -> None:
+        self.dependents.setdefault(chunk_id, {})[source_key] = source
+        self.source_originals.setdefault(source_key, set()).add(chunk_id)
+
+    def _remove_dependent(self, chunk_id: str, source_key: str) -> None:
+        dependents = self.dependents.get(chunk_id, {})
+        dependents.pop(source_key, None)
+        if not dependents:
+            self.dependents.pop(chunk_id, None)
+        originals = self.source_originals.get(source_key, set())
+        originals.discard(chunk_id)
+        if not originals:
+            self.source_originals.pop(source_key, None)
+
+    def forget_sources(self, source_keys: list) -> None:
+        """ A method to forget the duplicates skipped by sources that are deleted or about to be re-ingested.
+        """
+        for source_key in source_keys:
+            for chunk_id in list(self.source_originals.get(source_key, ())):
+                self._remove_dependent(chunk_id, source_key)
+
+    def hand_over(self, chunk_id: str):
+        """ A method to hand a chunk over to one of the sources that skipped a duplicate of it, so that the chunk is kept when its own source is removed.
+            Returns the source key and source of the new owner of the chunk, or None if no source depends on it.
+        """
+        dependents = self.dependents.get(chunk_id)
+        if not dependents:
+            return None
+        source_key = min(dependents)
+        source = dependents[source_key]
+        self._remove_dependent(chunk_id, source_key)
+        self.ignored_ids.discard(chunk_id)
+        return source_key, source
+
+    def remove(self, chunk_ids: list) -> None:
+        """ A method to forget the signatures of deleted chunks. Unknown chunk ids are ignored.
+        """
+        for chunk_id in chunk_ids:
+            for source_key in list(self.dependents.get(chunk_id, ())):
+                self._remove_dependent(chunk_id, source_key)
+            signature = self.signatures.pop(chunk_id, None)
+            if signature is None:
+                continue
+            text_hash, hash_value = signature
+            if self.exact_hashes.get(text_hash) == chunk_id:
+                del self.exact_hashes[text_hash]
+            for band, band_value in zip(self.bands, self._band_values(hash_value)):
+                band_ids = band[band_value]
+                band_ids.discard(chunk_id)
+                if not band_ids:
+                    del band[band_value]
+        self.ignored_ids.difference_update(chunk_ids)
+
+    def stats(self) -> dict:
+        """ A method to return the number of recorded chunks and skipped duplicates.
+        """
+        return {
+            "chunks": len(self.signatures),
+            "exact_duplicates": self.num_exact_duplicates,
+            "near_duplicates": self.num_near_duplicates,
+        }
+
+    def save(self, db_path: str) -> None:
+        """ A method to persist the signatures next to the FAISS index.
+        """
+        temp_path = os.path.join(db_path, f"{dedup_index_file_name}.tmp")
+        with open(temp_path, "wb") as f:
+            pickle.dump({"max_distance": self.max_distance, "signatures": self.signatures, "dependents": self.dependents}, f)
+        os.replace(temp_path, os.path.join(db_path, dedup_index_file_name))
+
+    @classmethod
+    def load(cls, db_path: str):
+        """ A method to load the signatures saved next to the FAISS index. Returns None if none are saved.
+        """
+        file_path = os.path.join(db_path, dedup_index_file_name)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "rb") as f:
+            data = pickle.load(f)
+        index = cls(max_distance=data["max_distance"])
+        for chunk_id, (text_hash, hash_value) in data["signatures"].items():
+            index.exact_hashes[text_hash] = chunk_id
+            index.signatures[chunk_id] = (text_hash, hash_value)
+            for band, band_value in zip(index.bands, index._band_values(hash_value)):
+                band.setdefault(band_value, set()).add(chunk_id)
+        for chunk_id, dependents in data["dependents"].items():
+            for source_key, source in dependents.items():
+                index._add_dependent(chunk_id, source_key, source)
+        return index
+
+    @classmethod
+    def from_db(cls, db):
+        """ A method to record the chunks of a vector db, for databases saved without a dedup index.
+            Duplicates that are already stored are all kept in the db, and only the first of them is recorded.
+        """
+        index = cls()
+        for chunk_id in db.index_to_docstore_id.values():
+            index.add(chunk_id, db.docstore.search(chunk_id).page_content)
+        return index
@@ -1,12 +1,17 @@
 """This file to define basic functionalities using Open AI's GPT models. """
 
 import os
+import time
+import hashlib
 import openai  # Importing Open AI library
-import tiktoken  # Importing tiktoken library to calculate the number of tokens
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import RetrievalQA
 from dotenv import load_dotenv, find_dotenv
+from async_gpt_utils import ASYNC_OPENAI_CLIENT, ASYNC_OPENAI_EMBEDDINGS
+from cache_utils import RESPONSE_CACHE, SEMANTIC_QUERY_CACHE
+from token_utils import num_tokens_from_string, num_tokens_from_messages, CONTEXT_PACKER
+from sparse_index import hybrid_search
+from db_utils import VECTOR_DB_UTILS
+from collection_utils import DEFAULT_COLLECTION
+from telemetry_utils import llm_telemetry
 
 _ = load_dotenv(find_dotenv())  # read local .env file
 
@@ -17,19 +22,82 @@ default_model = os.environ["DEFAULT_MODEL"]  # Default gpt model for use - gpt-3
 large_context_model = os.environ[
     "LARGE_CONTEXT_MODEL"
 ]  # Large context gpt model for large amount of tokens - gpt-3.5-turbo-16k
+response_cache_enabled = os.environ["RESPONSE_CACHE_ENABLED"] == "True"  # Cache GPT responses of repeated requests
+semantic_cache_enabled = os.environ["SEMANTIC_CACHE_ENABLED"] == "True"  # Reuse answers of semantically similar queries
+default_model_max_tokens = int(os.environ["DEFAULT_MODEL_MAX_TOKENS"])  # Prompt and completion tokens above which the large context model is selected
+QA_PROMPT_TOKENS = int(os.environ["QA_PROMPT_TOKENS"])  # Target prompt token budget of retrieval QA, including the packed context
+QA_FETCH_K = int(os.environ["QA_FETCH_K"])  # Number of ranked chunks retrieved as candidates for context packing
+MMR_LAMBDA_MULT = float(os.environ["MMR_LAMBDA_MULT"])  # Trade-off between relevance (1) and diversity (0) of MMR search
+tail_latency_mode = os.environ["TAIL_LATENCY_MODE"] == "True"  # Hedge completions and fall back to the large context model after a deadline
+
+# Process-wide semantic cache of answers, shared by every session since GPT_UTILS is created on each page load
+semantic_cache = SEMANTIC_QUERY_CACHE()
+
+class COMPLETION_STREAM:
+    """A class to iterate over the content of a streamed completion as it arrives.
+    Time to first token and total time are measured from the start time of the request, and the token usage
+    is available once the stream is consumed. Tokens spent on earlier requests of the same task can be added with extra_tokens."""
+
+    def __init__(self, chunks, model, prompt_tokens=0, usage=None, extra_tokens=0, start_time=None, on_complete=None) -> None:
+        self.chunks = chunks
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.usage = usage
+        self.extra_tokens = extra_tokens
+        self.start_time = start_time if start_time is not None else time.time()
+        self.on_complete = on_complete
+        self.content = ""
+        self.time_to_first_token = None
+        self.total_time = None
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            if self.time_to_first_token is None:
+                self.time_to_first_token = time.time() - self.start_time
+            self.content += chunk
+            yield chunk
+
+        self.total_time = time.time() - self.start_time
+        if self.usage is None:
+            # Streamed responses do not report usage, so the completion tokens are counted from the content
+            completion_tokens = num_tokens_from_string(self.content, self.model)
+            self.usage = {
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": self.prompt_tokens + completion_tokens,
+            }
+        if self.on_complete is not None:
+            self.on_complete(self)
+
+    @property
+    def total_tokens(self) -> int:
+        """Returns the tokens used by the streamed completion and the earlier requests, or None before the stream is consumed."""
+        return self.usage["total_tokens"] + self.extra_tokens if self.usage is not None else None
+
+    def to_response(self) -> dict:
+        """Returns the consumed stream in the format of a completion response, so that it can be cached."""
+        return {
+            "model": self.model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.content}, "finish_reason": "stop"}],
+            "usage": dict(self.usage),
+        }
+
 
 class GPT_UTILS:
     """A class to define various utilities for GPT usage"""
 
-    def __init__(self, api_key) -> None:
+    def __init__(self, api_key, use_response_cache: bool=response_cache_enabled, use_semantic_cache: bool=semantic_cache_enabled,
+                 tail_latency_mode: bool=tail_latency_mode) -> None:
         self.api_key = api_key
         self.default_model = default_model
         self.large_context_model = large_context_model
-        self.embeddings = OpenAIEmbeddings(openai_api_key=self.api_key)
-        self.langchain_llm = ChatOpenAI(openai_api_key=self.api_key,
-                                        model=self.default_model,
-                                        temperature=0.5,
-                                        max_tokens=512)
+        self.async_client = ASYNC_OPENAI_CLIENT(api_key=self.api_key)
+        self.embeddings = ASYNC_OPENAI_EMBEDDINGS(client=self.async_client)
+        self.response_cache = RESPONSE_CACHE() if use_response_cache else None
+        self.semantic_cache = semantic_cache if use_semantic_cache else None
+        self.tail_latency_mode = tail_latency_mode
 
     def validate_key(self) -> bool:
         """A function to validate the Open AI API Key"""
@@ -54,74 +122,249 @@ class GPT_UTILS:
     def num_tokens_from_string(self, string: str) -> int:
         """Returns the number of tokens in a text string."""
 
-        try:
-            encoding = tiktoken.encoding_for_model(
-                self.default_model
-            )  # Loading the correct encoding for default model
-            num_tokens = len(
-                encoding.encode(string)
-            )  # Calculating the length of the tokens
-            return num_tokens
-        except KeyError:
-            print("Warning: model not found.")  # Terminal Error message for debugging
-            return None
-        
+        return num_tokens_from_string(string, self.default_model)  # Encoding of the default model is loaded once and cached
+
     def select_model(self, messages, max_tokens):
         """A function to decide the model choice between regular or large context."""
         
-        num_tokens = self.num_tokens_from_string(
-            str(messages)
-        )  # Get number of prompt tokens
+        num_tokens = num_tokens_from_messages(
+            messages, self.default_model
+        )  # Get number of prompt tokens as counted by the chat format
 
         total_tokens = num_tokens + max_tokens
 
-        if total_tokens is not None and total_tokens < 3750:
+        if total_tokens < default_model_max_tokens:
             model = (
                 self.default_model
-            )  # Select default model if prompt tokens are less than 3500
+            )  # Select default model if prompt and completion tokens fit into its context
         else:
             model = (
                 self.large_context_model
-            )  # Select large context model if prompt tokens are more than 3500
+            )  # Select large context model otherwise
 
+        llm_telemetry.record_selection(escalated=model != self.default_model)
         return model
 
     def get_completion_from_messages(self, messages, functions=[], temperature=0.5, max_tokens=1750):
-        """A function to get completion from provided messages using GPT models."""
+        """A function to get completion from provided messages using GPT models.
+        Repeated requests are answered from the response cache if it is enabled.
+        In tail latency mode, a slow request is hedged with a duplicate and a request of the default model that misses the deadline
+        falls back to the large context model, which also fits its prompt."""
         
-        openai.api_key = self.api_key
-        if len(functions) > 0:
-            response = openai.ChatCompletion.create(
-                model=self.select_model(messages=messages, max_tokens=max_tokens),
+        model = self.select_model(messages=messages, max_tokens=max_tokens)
+
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(model, messages, temperature, max_tokens, functions)
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                llm_telemetry.record_cache_hit("completion", model)
+                return cached_response
+
+        if self.tail_latency_mode:
+            function_arguments = {"functions": functions, "function_call": "auto"} if len(functions) > 0 else {}
+            fallback_model = self.large_context_model if model == self.default_model else None
+            response = self.async_client.hedged_completion(
+                model=model,
                 messages=messages,
-                functions=functions,
-                function_call="auto",
+                fallback_model=fallback_model,
                 temperature=temperature,
                 max_tokens=max_tokens,
-            )
-        else:
+                **function_arguments,
+            )  # Every attempt is recorded in the telemetry by the async client
+            if cache_key is not None:
+                # The answer of the fallback model is cached under its own key, so that it is not served for the selected model.
+                # Responses report a dated version such as gpt-3.5-turbo-16k-0613, so the longest requested name it starts with is the model that answered
+                answered_model = max((name for name in [model, fallback_model] if name and response.get("model", model).startswith(name)), key=len, default=model)
+                self.response_cache.set(self.response_cache.make_key(answered_model, messages, temperature, max_tokens, functions), response)
+            return response
+
+        openai.api_key = self.api_key
+        start_time = time.time()
+        try:
+            if len(functions) > 0:
+                response = openai.ChatCompletion.create(
+                    model=model,
+                    messages=messages,
+                    functions=functions,
+                    function_call="auto",
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
+            else:
+                response = openai.ChatCompletion.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
+        except Exception as error:
+            llm_telemetry.record_request("completion", model, time.time() - start_time, error=error)
+            raise
+        llm_telemetry.record_request("completion", model, time.time() - start_time, usage=response.get("usage"))
+
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response)
+
+        return response
+
+    def stream_completion_from_messages(self, messages, temperature=0.5, max_tokens=1750, extra_tokens=0, start_time=None):
+        """A function to stream the completion of the provided messages using GPT models.
+        Returns a COMPLETION_STREAM that yields the content as it arrives. Cached responses are yielded at once,
+        and completed streams are added to the response cache if it is enabled."""
+
+        start_time = start_time if start_time is not None else time.time()
+        model = self.select_model(messages=messages, max_tokens=max_tokens)
+
+        on_complete = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(model, messages, temperature, max_tokens)
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                llm_telemetry.record_cache_hit("stream", model)
+                return COMPLETION_STREAM([cached_response.choices[0].message["content"]], model=model, usage=dict(cached_response.usage),
+                                         extra_tokens=extra_tokens, start_time=start_time)
+            on_complete = lambda stream: self.response_cache.set(cache_key, stream.to_response())
+
+        # The stream is consumed after the caller's block, so the feature and start of the request are captured now
+        feature = llm_telemetry.current_feature()
+        request_time = time.time()
+        cache_response = on_complete
+
+        def on_complete(stream):
+            llm_telemetry.record_request("stream", model, time.time() - request_time, usage=stream.usage, feature=feature)
+            if cache_response is not None:
+                cache_response(stream)
+
+        openai.api_key = self.api_key
+        try:
             response = openai.ChatCompletion.create(
-                model=self.select_model(messages=messages, max_tokens=max_tokens),
+                model=model,
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
+                stream=True,
             )
+        except Exception as error:
+            llm_telemetry.record_request("stream", model, time.time() - request_time, error=error)
+            raise
+        chunks = (chunk.choices[0].delta.get("content", "") for chunk in response if chunk.choices)
 
-        return response
+        return COMPLETION_STREAM(chunks, model=model, prompt_tokens=num_tokens_from_messages(messages, model), extra_tokens=extra_tokens,
+                                 start_time=start_time, on_complete=on_complete)
+
+    def get_completions_from_messages_batch(self, messages_list, temperature=0.5, max_tokens=1750):
+        """A function to get completions for a batch of messages concurrently within the rate limits.
+        Returns the responses in the order of the messages, with the exception in place of a request that failed."""
+
+        responses = [None] * len(messages_list)
+        requests = []
+        request_positions = []
+        cache_keys = {}
+        for i, messages in enumerate(messages_list):
+            model = self.select_model(messages=messages, max_tokens=max_tokens)
+            if self.response_cache is not None:
+                cache_keys[i] = self.response_cache.make_key(model, messages, temperature, max_tokens)
+                responses[i] = self.response_cache.get(cache_keys[i])
+                if responses[i] is not None:
+                    llm_telemetry.record_cache_hit("completion", model)
+                    continue
+
+            requests.append({
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "estimated_tokens": num_tokens_from_messages(messages, self.default_model) + max_tokens,
+            })
+            request_positions.append(i)
+
+        # Send only the requests that are not cached
+        for i, response in zip(request_positions, self.async_client.completions(requests) if requests else []):
+            responses[i] = response
+            if i in cache_keys and not isinstance(response, Exception):
+                self.response_cache.set(cache_keys[i], response)
+
+        return responses
     
-    def retrieval_qa(self, query, prompt, db, return_source_documents: bool=True):
-        """A function to use retrivers from vectorstores and generate completions with GPT models. """
+    def retrieval_qa(self, query, prompt, db=None, return_source_documents: bool=True, prompt_tokens: int=QA_PROMPT_TOKENS, fetch_k: int=QA_FETCH_K,
+                     lambda_mult: float=MMR_LAMBDA_MULT, stream: bool=False, collection: str=None):
+        """A function to use retrivers from vectorstores and generate completions with GPT models.
+        The vector db of the named collection is loaded from the shared pool if no db is given.
+        The ranked chunks are packed into the context up to the prompt token budget, so the default model is selected whenever possible.
+        With stream enabled, the answer is returned as a COMPLETION_STREAM under 'stream' instead of 'result' and 'tokens_used'.
+        Answers are reused for semantically similar queries against the same collection and version of the vector db, flagged with 'cached'."""
 
         try:
-            retriever = db.as_retriever(search_type="mmr", search_kwargs={'k': 6})
-            retriever_qa_chain = RetrievalQA.from_chain_type(llm=self.langchain_llm,
-                                                            retriever=retriever,
-                                                            chain_type="stuff",
-                                                            return_source_documents=return_source_documents,
-                                                            chain_type_kwargs={"prompt": prompt})
-            result = retriever_qa_chain({'query': query})
+            start_time = time.time()
+            feature = llm_telemetry.current_feature()
+
+            if db is None:
+                db = VECTOR_DB_UTILS(collection=collection or DEFAULT_COLLECTION).load_local_db(embeddings=self.embeddings)
+                if db is None:
+                    print(f"No vector database exists for collection {collection or DEFAULT_COLLECTION}")
+                    return None
+
+            # Look up the answer of a similar query asked to the same collection with the same prompt and retrieval parameters
+            query_vector = db._embed_query(query)
+            db_version = getattr(db, "version", None)
+            db_collection = getattr(db, "collection", None)
+            namespace = hashlib.sha256(f"{prompt.template}\x00{prompt_tokens}\x00{fetch_k}\x00{lambda_mult}".encode("utf-8")).hexdigest()
+            use_semantic_cache = self.semantic_cache is not None and db_version is not None
+            cached_answer = self.semantic_cache.get(db_version, namespace, query_vector, collection=db_collection) if use_semantic_cache else None
+            if cached_answer is not None:
+                llm_telemetry.record_cache_hit("retrieval_qa", cached_answer['model'])
+                result = {'query': query, 'cached': True}
+                if stream:
+                    result['stream'] = COMPLETION_STREAM([cached_answer['result']], model=cached_answer['model'], usage=dict(cached_answer['usage']),
+                                                         start_time=start_time)
+                else:
+                    result['result'] = cached_answer['result']
+                    result['tokens_used'] = cached_answer['usage']['total_tokens']
+                if return_source_documents:
+                    result['source_documents'] = cached_answer['source_documents']
+                return result
+
+            # Budget left for the context once the prompt template and the question are counted
+            empty_prompt = [{"role": "user", "content": prompt.format(context="", question=query)}]
+            context_budget = prompt_tokens - num_tokens_from_messages(empty_prompt, self.default_model)
+
+            # Fuse the vector ranking with the BM25 ranking so that exact terms such as names and codes are found
+            ranked_documents = hybrid_search(db, query, k=fetch_k, fetch_k=max(20, 2 * fetch_k), lambda_mult=lambda_mult, query_vector=query_vector)
+            source_documents = CONTEXT_PACKER(budget_tokens=context_budget, model=self.default_model).pack(ranked_documents)
+            context = "\n\n".join(document.page_content for document in source_documents)
+            messages = [{"role": "user", "content": prompt.format(context=context, question=query)}]
+
+            def cache_answer(model, content, usage, latency):
+                if use_semantic_cache:
+                    self.semantic_cache.set(db_version, namespace, query_vector, {
+                        'model': model, 'result': content, 'usage': dict(usage), 'latency': latency, 'source_documents': source_documents,
+                    }, collection=db_collection)
+
+            result = {'query': query, 'cached': False}
+            if stream:
+                response_stream = self.stream_completion_from_messages(messages=messages, temperature=0.5, max_tokens=512, start_time=start_time)
+                cache_response = response_stream.on_complete
+
+                def on_complete(completed_stream):
+                    if cache_response is not None:
+                        cache_response(completed_stream)
+                    cache_answer(completed_stream.model, completed_stream.content, completed_stream.usage, completed_stream.total_time)
+                    llm_telemetry.record_request("retrieval_qa", completed_stream.model, completed_stream.total_time, feature=feature)
+
+                response_stream.on_complete = on_complete
+                result['stream'] = response_stream
+            else:
+                response = self.get_completion_from_messages(messages=messages, temperature=0.5, max_tokens=512)
+                result['result'] = response.choices[0].message["content"]
+                result['tokens_used'] = response.usage.total_tokens
+                cache_answer(response.get("model", self.default_model), result['result'], response.usage, time.time() - start_time)
+                llm_telemetry.record_request("retrieval_qa", response.get("model", self.default_model), time.time() - start_time)
+            if return_source_documents:
+                result['source_documents'] = source_documents
 
             return result
         except Exception as e:
             print(f"Error retrieving response: {e}")
+            llm_telemetry.record_request("retrieval_qa", self.default_model, time.time() - start_time, error=e)
             return None
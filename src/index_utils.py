@@ -0,0 +1,372 @@
+""" A python file to build the FAISS index of the vector database with a configurable index type.
+    Supported index types are Flat, IVFFlat, IVFPQ and HNSW. IVF indexes are trained once enough vectors are available.
+    Flat, IVFFlat and HNSW indexes can store vectors as float32, or compressed with fp16 or int8 scalar quantization,
+    in which case the exact vectors can be kept on disk for re-ranking.
+"""
+
+import os
+import glob
+import json
+import uuid
+import pickle
+import faiss
+import numpy as np
+from langchain.vectorstores import FAISS
+from langchain.docstore.in_memory import InMemoryDocstore
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+FAISS_INDEX_TYPE = os.environ["FAISS_INDEX_TYPE"]  # Index type of the vector database - Flat, IVFFlat, IVFPQ or HNSW
+IVF_NLIST = int(os.environ["IVF_NLIST"])  # Number of inverted lists of IVF indexes
+PQ_M = int(os.environ["PQ_M"])  # Number of sub-quantizers of IVFPQ indexes, must divide the embedding dimension
+HNSW_M = int(os.environ["HNSW_M"])  # Number of neighbours per node of HNSW indexes
+FAISS_NPROBE = int(os.environ["FAISS_NPROBE"])  # Number of inverted lists visited per search of IVF indexes
+HNSW_EF_SEARCH = int(os.environ["HNSW_EF_SEARCH"])  # Size of the candidate list per search of HNSW indexes
+FAISS_VECTOR_ENCODING = os.environ["FAISS_VECTOR_ENCODING"]  # Storage of the vectors of Flat, IVFFlat and HNSW indexes - float32, fp16 or int8
+
+index_config_file_name = "index_config.json"
+exact_vectors_file_name = "exact_vectors.pkl"
+
+# Minimum number of training points per inverted list recommended by FAISS
+min_points_per_list = 39
+
+# Bits per sub-quantizer code of IVFPQ indexes, whose codebooks need a training point per centroid
+pq_nbits = 8
+
+# Number of vectors buffered to train the value ranges of int8 scalar quantization
+min_scalar_quantizer_training_size = 10000
+
+# Scalar quantizer of every compressed vector encoding
+scalar_quantizers = {"fp16": "SQfp16", "int8": "SQ8"}
+
+
+def index_factory_string(index_type: str, nlist: int=IVF_NLIST, pq_m: int=PQ_M, hnsw_m: int=HNSW_M, encoding: str=FAISS_VECTOR_ENCODING) -> str:
+    """ A function to translate the index type and vector encoding into a FAISS index factory string.
+        IVFPQ indexes compress vectors with product quantization, so the encoding does not apply to them.
+    """
+    if encoding != "float32" and encoding not in scalar_quantizers:
+        raise ValueError(f"Unsupported vector encoding: {encoding}")
+    quantizer = scalar_quantizers.get(encoding)
+
+    factory_strings = {
+        "Flat": quantizer or "Flat",
+        "IVFFlat": f"IVF{nlist},{quantizer or 'Flat'}",
+        "IVFPQ": f"IVF{nlist},PQ{pq_m}",
+        "HNSW": f"HNSW{hnsw_m}_{quantizer}" if quantizer else f"HNSW{hnsw_m},Flat",
+    }
+    if index_type not in factory_strings:
+        raise ValueError(f"Unsupported index type: {index_type}")
+    return factory_strings[index_type]
+
+
+def vector_encoding(index) -> str:
+    """ A function to return how an index stores its vectors - float32, fp16, int8 or pq.
+    """
+    index = faiss.downcast_index(index)
+    if hasattr(index, "storage"):
+        index = faiss.downcast_index(index.storage)
+    if hasattr(index, "sq"):
+        return {faiss.ScalarQuantizer.QT_fp16: "fp16", faiss.ScalarQuantizer.QT_8bit: "int8"}.get(index.sq.qtype, "sq")
+    if hasattr(index, "pq"):
+        return "pq"
+    return "float32"
+
+
+def set_search_params(index, nprobe: int=FAISS_NPROBE, ef_search: int=HNSW_EF_SEARCH) -> None:
+    """ A function to set the search-time parameters of an index. Parameters that do not apply to the index type are ignored.
+    """
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None:
+        # A direct map is required to reconstruct vectors for MMR search
+        if ivf_index.direct_map.type == faiss.DirectMap.NoMap:
+            ivf_index.make_direct_map()
+        if nprobe:
+            ivf_index.nprobe = nprobe
+
+    index = faiss.downcast_index(index)
+    if hasattr(index, "hnsw") and ef_search:
+        index.hnsw.efSearch = ef_search
+
+
+def describe_index(index) -> dict:
+    """ A function to describe the type and search-time parameters of an index.
+    """
+    index_types = {"IndexFlat": "Flat", "IndexFlatL2": "Flat", "IndexScalarQuantizer": "Flat", "IndexIVFFlat": "IVFFlat",
+                   "IndexIVFScalarQuantizer": "IVFFlat", "IndexIVFPQ": "IVFPQ", "IndexHNSWFlat": "HNSW", "IndexHNSWSQ": "HNSW"}
+    index = faiss.downcast_index(index)
+    index_config = {
+        "index_type": index_types.get(type(index).__name__, type(index).__name__),
+        "vector_encoding": vector_encoding(index),
+        "dimension": index.d,
+        "num_vectors": index.ntotal,
+    }
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None:
+        index_config.update({"nlist": ivf_index.nlist, "nprobe": ivf_index.nprobe})
+    if hasattr(index, "hnsw"):
+        index_config.update({"ef_search": index.hnsw.efSearch})
+    return index_config
+
+
+def save_index_config(db_path: str, index_config: dict) -> None:
+    """ A function to persist the index configuration next to the FAISS index.
+    """
+    with open(os.path.join(db_path, index_config_file_name), "w") as f:
+        json.dump(index_config, f, indent=2)
+
+
+def delete_chunks(db: FAISS, ids: list) -> None:
+    """ A function to delete chunks from the vector db.
+        Only flat indexes, including scalar quantized ones, support removal with compact positions, so other index types are rebuilt
+        from their remaining vectors. IVF indexes keep their trained centroids, and compressed vectors are re-added from their reconstruction.
+    """
+    if isinstance(faiss.downcast_index(db.index), faiss.IndexFlatCodes):
+        db.delete(ids)
+        return
+
+    ids_to_delete = set(ids)
+    kept_positions = [i for i, chunk_id in sorted(db.index_to_docstore_id.items()) if chunk_id not in ids_to_delete]
+    vectors = np.array([db.index.reconstruct(i) for i in kept_positions], dtype=np.float32).reshape(-1, db.index.d)
+    kept_ids = [db.index_to_docstore_id[i] for i in kept_positions]
+
+    db.index.reset()
+    set_search_params(db.index, nprobe=None, ef_search=None)
+    if len(vectors):
+        db.index.add(vectors)
+    db.docstore.delete(list(ids_to_delete))
+    db.index_to_docstore_id = {i: chunk_id for i, chunk_id in enumerate(kept_ids)}
+
+
+class FAISS_INDEX_BUILDER:
+    """ A class to build a vector db of the configured index type and vector encoding from batches of embeddings.
+        Batches are buffered until an IVF index has enough vectors to be trained. If the stream ends before that,
+        a flat index is built instead. Batches are also buffered to train the value ranges of int8 quantization,
+        which is trained on the vectors available if the stream ends earlier.
+        When merging into a flat db while an IVF index type is configured, batches are buffered in the same way,
+        and the db is converted to the IVF index type once it holds enough vectors to train it.
+    """
+
+    def __init__(self, embeddings, db: FAISS=None, index_type: str=FAISS_INDEX_TYPE, nlist: int=IVF_NLIST, pq_m: int=PQ_M, hnsw_m: int=HNSW_M,
+                 nprobe: int=FAISS_NPROBE, ef_search: int=HNSW_EF_SEARCH, encoding: str=FAISS_VECTOR_ENCODING, exact_store=None) -> None:
+        self.embeddings = embeddings
+        self.db = db
+        self.exact_store = exact_store  # Receives the exact vectors of a float32 flat db before it is converted to a compressed index
+        self.index_type = index_type
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.encoding = encoding
+        self.min_training_size = min_points_per_list * nlist if index_type in ["IVFFlat", "IVFPQ"] else 1
+        if index_type == "IVFPQ":
+            self.min_training_size = max(self.min_training_size, 2 ** pq_nbits)
+        if encoding == "int8" and index_type != "IVFPQ":
+            self.min_training_size = max(self.min_training_size, min_scalar_quantizer_training_size)
+        self._pending = []
+        self._pending_count = 0
+        # A flat db that was built before enough vectors were available is converted once the merge provides them
+        self._convert_db = db is not None and index_type in ["IVFFlat", "IVFPQ"] and isinstance(faiss.downcast_index(db.index), faiss.IndexFlatCodes)
+
+        # Validate the index type and vector encoding early
+        index_factory_string(self.index_type, self.nlist, self.pq_m, self.hnsw_m, self.encoding)
+
+    def add(self, texts: list, vectors: list, metadatas: list, ids: list) -> None:
+        """ A method to add a batch of embedded chunks to the vector db.
+        """
+        if self.db is not None and not self._convert_db:
+            self.db.add_embeddings(text_embeddings=list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+            return
+
+        self._pending.append((texts, vectors, metadatas, ids))
+        self._pending_count += len(texts)
+        if self.db is None and self._pending_count >= self.min_training_size:
+            self._create_db(self.index_type)
+        elif self.db is not None and self.db.index.ntotal + self._pending_count >= self.min_training_size:
+            self._convert_flat_db()
+
+    def finish(self) -> FAISS:
+        """ A method to flush the buffered batches and return the vector db, or None if nothing was added.
+        """
+        if self.db is not None and self._pending:
+            # The merged db is still too small to train the IVF index, so it stays flat
+            self._add_pending()
+        elif self.db is None and self._pending:
+            if self.index_type in ["IVFFlat", "IVFPQ"]:
+                print(f"Only {self._pending_count} vectors are available to train a {self.index_type} index. Building a Flat index instead.")
+                self._create_db("Flat")
+            else:
+                self._create_db(self.index_type)
+        return self.db
+
+    def _train_index(self, index_type: str, vectors: np.ndarray):
+        """ A method to create an index of the index type and train it on the vectors if required.
+        """
+        index = faiss.index_factory(vectors.shape[1], index_factory_string(index_type, self.nlist, self.pq_m, self.hnsw_m, self.encoding))
+        if not index.is_trained:
+            print(f"Training {index_type} index on {len(vectors)} vectors. . .")
+            index.train(vectors)
+        set_search_params(index, nprobe=self.nprobe, ef_search=self.ef_search)
+        return index
+
+    def _pending_vectors(self) -> np.ndarray:
+        return np.array([vector for _, batch_vectors, _, _ in self._pending for vector in batch_vectors], dtype=np.float32)
+
+    def _add_pending(self) -> None:
+        """ A method to add the buffered batches to the vector db.
+        """
+        for texts, batch_vectors, metadatas, ids in self._pending:
+            self.db.add_embeddings(text_embeddings=list(zip(texts, batch_vectors)), metadatas=metadatas, ids=ids)
+        self._pending = []
+        self._pending_count = 0
+
+    def _create_db(self, index_type: str) -> None:
+        """ A method to create and train the index from the buffered batches and add them to a new vector db.
+        """
+        index = self._train_index(index_type, self._pending_vectors())
+        self.index_type = index_type
+        self.db = FAISS(self.embeddings, index, InMemoryDocstore(), {})
+        self._add_pending()
+
+    def _convert_flat_db(self) -> None:
+        """ A method to replace the flat index of the merged db by an index of the configured IVF type, trained on its vectors and the buffered batches.
+            The vectors keep their positions, so the docstore mapping of the db is unchanged.
+        """
+        existing_vectors = self.db.index.reconstruct_n(0, self.db.index.ntotal)
+        print(f"Converting Flat index of {len(existing_vectors)} vectors to {self.index_type}. . .")
+        if self.exact_store is not None and vector_encoding(self.db.index) == "float32":
+            # The vectors of a float32 index are exact, and are only lost once it is compressed
+            self.exact_store.add([self.db.index_to_docstore_id[i] for i in range(len(existing_vectors))], existing_vectors)
+        index = self._train_index(self.index_type, np.concatenate([existing_vectors, self._pending_vectors()]))
+        index.add(existing_vectors)
+        self.db.index = index
+        self._convert_db = False
+        self._add_pending()
+
+
+class EXACT_VECTOR_STORE:
+    """ A class to keep the exact float32 vectors of a compressed index on disk, keyed by chunk id, and read them through a memory map.
+        Vectors are appended to a data file and deleted vectors are only dropped from the row map,
+        so the data file is rewritten once more than half of its rows are unused.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self.dimension = None
+        self.row_of = {}  # Row of every chunk id in the data file
+        self.data_file_name = f"exact_vectors-{uuid.uuid4().hex}.f32"
+        self._memmap = None
+
+    def __len__(self) -> int:
+        return len(self.row_of)
+
+    @property
+    def data_path(self) -> str:
+        return os.path.join(self.db_path, self.data_file_name)
+
+    def _num_rows(self) -> int:
+        """ A method to count the rows of the data file, including rows appended by a build that did not complete.
+        """
+        return os.path.getsize(self.data_path) // (4 * self.dimension) if os.path.exists(self.data_path) else 0
+
+    def add(self, ids: list, vectors: list) -> None:
+        """ A method to append the vectors of chunks to the data file.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.dimension = self.dimension or vectors.shape[1]
+        first_row = self._num_rows()
+        with open(self.data_path, "ab") as f:
+            f.write(vectors.tobytes())
+        self.row_of.update({chunk_id: first_row + i for i, chunk_id in enumerate(ids)})
+        self._memmap = None
+
+    def remove(self, ids: list) -> None:
+        """ A method to drop the vectors of deleted chunks. Unknown chunk ids are ignored.
+        """
+        for chunk_id in ids:
+            self.row_of.pop(chunk_id, None)
+
+    def _open(self) -> None:
+        """ A method to map the data file. An open map keeps reading the file after a later build removes it.
+        """
+        num_rows = self._num_rows()
+        if num_rows:
+            self._memmap = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(num_rows, self.dimension))
+        else:
+            self._memmap = np.empty((0, self.dimension), dtype=np.float32)
+
+    def get(self, ids: list) -> np.ndarray:
+        """ A method to read the exact vectors of chunks, in the order of the ids.
+        """
+        if self._memmap is None:
+            self._open()
+        return self._memmap[[self.row_of[chunk_id] for chunk_id in ids]]
+
+    def save(self) -> None:
+        """ A method to persist the row map next to the FAISS index, compacting the data file first if required.
+            Data files of earlier builds are removed once the new row map is in place.
+        """
+        if self.dimension is None:
+            return
+        if len(self.row_of) < self._num_rows() / 2:
+            print("Compacting exact vectors. . .")
+            old_vectors = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(self._num_rows(), self.dimension))
+            ids = list(self.row_of)
+            rows = [self.row_of[chunk_id] for chunk_id in ids]
+            self.data_file_name = f"exact_vectors-{uuid.uuid4().hex}.f32"
+            self.row_of = {}
+            # Copy the used rows in slices to keep memory bounded
+            for start in range(0, len(ids), 10000):
+                self.add(ids[start:start + 10000], old_vectors[rows[start:start + 10000]])
+            del old_vectors
+
+        temp_path = os.path.join(self.db_path, f"{exact_vectors_file_name}.tmp")
+        with open(temp_path, "wb") as f:
+            pickle.dump({"dimension": self.dimension, "data_file_name": self.data_file_name, "row_of": self.row_of}, f)
+        os.replace(temp_path, os.path.join(self.db_path, exact_vectors_file_name))
+
+        # Stores map their data file when they are loaded, so pooled databases keep reading a removed file until they are evicted
+        for data_path in glob.glob(os.path.join(self.db_path, "exact_vectors-*.f32")):
+            if os.path.basename(data_path) != self.data_file_name:
+                try:
+                    os.remove(data_path)
+                except OSError as e:
+                    print(f"Unable to remove exact vectors {data_path}, it is removed by a later build: {e}")
+
+    def discard(self) -> None:
+        """ A method to remove the data file of a store that is not saved, such as one written for an index that ended up uncompressed.
+        """
+        self._memmap = None
+        if os.path.exists(self.data_path):
+            os.remove(self.data_path)
+
+    @classmethod
+    def load(cls, db_path: str):
+        """ A method to load the row map saved next to the FAISS index and map its data file. Returns None if no exact vectors are saved.
+            The row map is read again if a concurrent build replaced the data file before it was mapped.
+        """
+        file_path = os.path.join(db_path, exact_vectors_file_name)
+        for attempt in range(3):
+            if not os.path.exists(file_path):
+                return None
+            with open(file_path, "rb") as f:
+                data = pickle.load(f)
+            store = cls(db_path)
+            store.dimension = data["dimension"]
+            store.data_file_name = data["data_file_name"]
+            store.row_of = data["row_of"]
+            try:
+                store._open()
+                return store
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    @staticmethod
+    def clear(db_path: str) -> None:
+        """ A method to remove the exact vectors saved next to the FAISS index.
+        """
+        for file_path in glob.glob(os.path.join(db_path, "exact_vectors*")):
+            os.remove(file_path)
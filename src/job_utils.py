@@ -0,0 +1,284 @@
+""" A python file to run ingestion jobs in the background with a pool of worker threads.
+    Every job stages its files in its own directory, so that concurrent uploads never consume each other's documents.
+    The state of every job is persisted as JSON next to its staging directory, so that it can be polled by any session and survives restarts.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv, find_dotenv
+from db_utils import VECTOR_DB_UTILS
+from collection_utils import collection_paths, build_lock
+from cache_utils import EMBEDDING_CACHE
+from url_utils import extract_text_url, is_sitemap_url, WEB_CRAWLER
+from trace_utils import tracer
+from telemetry_utils import llm_telemetry
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+INGESTION_JOBS_DIR = os.environ["INGESTION_JOBS_DIR"]  # Directory of the staging files and state of the ingestion jobs
+INGESTION_WORKERS = int(os.environ["INGESTION_WORKERS"])  # Number of ingestion jobs run at the same time
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+ingestion_jobs_path = f"{project_root}/{INGESTION_JOBS_DIR}"
+job_file_name = "job.json"
+
+# Minimum number of seconds between two writes of the progress of a job
+progress_save_interval = 0.5
+
+active_statuses = ["queued", "running"]
+
+
+def _process_alive(pid: int) -> bool:
+    """ A function to check whether a process of this host is still running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # The process exists but belongs to another user
+    return True
+
+
+class INGESTION_JOB_QUEUE:
+    """ A class to queue ingestion jobs and run them on a pool of worker threads.
+        Jobs of different collections run in parallel, while jobs of the same collection run one after the other
+        since they update the same vector db and manifest.
+    """
+
+    def __init__(self, jobs_dir: str=ingestion_jobs_path, num_workers: int=INGESTION_WORKERS) -> None:
+        self.jobs_dir = jobs_dir
+        self.num_workers = num_workers
+        self.jobs = {}  # State of every job, keyed by job id
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="ingestion")
+        # A single embedding cache is shared by the workers so that they do not compete for the sqlite database
+        self.embedding_cache = EMBEDDING_CACHE()
+        self._recover()
+
+    def _recover(self) -> None:
+        """ A method to load the persisted jobs. Jobs that were queued or running in a process that stopped are marked as failed,
+            and their remaining staged files are kept so that they can be submitted again.
+            Jobs of processes that are still running, such as another Streamlit worker or a command line run, are left to them.
+        """
+        if not os.path.exists(self.jobs_dir):
+            return
+        for job_id in os.listdir(self.jobs_dir):
+            job_path = os.path.join(self.jobs_dir, job_id, job_file_name)
+            if not os.path.isfile(job_path):
+                continue
+            with open(job_path, "r") as f:
+                job = json.load(f)
+            self.jobs[job_id] = job
+            self._fail_if_orphaned(job_id)
+
+    @staticmethod
+    def _is_orphaned(job: dict) -> bool:
+        """ A method to check whether an active job, not submitted by this process, belongs to a process that is no longer running.
+            A job recorded with the pid of this process was run by an earlier process with the same pid, as after a container restart.
+        """
+        if job["status"] not in active_statuses:
+            return False
+        # Jobs saved without an owner predate owner tracking
+        owner_pid = job.get("owner_pid")
+        return owner_pid is None or owner_pid == os.getpid() or not _process_alive(owner_pid)
+
+    def _fail_if_orphaned(self, job_id: str) -> None:
+        """ A method to mark a job that is not run by this process as failed if its process stopped.
+        """
+        if self._is_orphaned(self.jobs[job_id]):
+            self._update(job_id, status="failed", error="Interrupted by a restart before completion", finished_time=time.time())
+
+    def staging_path(self, job_id: str) -> str:
+        """ A method to return the directory where the files of a job are staged before it is submitted.
+        """
+        return os.path.join(self.jobs_dir, job_id, "staging")
+
+    def create_staging_dir(self) -> tuple:
+        """ A method to reserve a new job id with an empty staging directory. Returns the job id and the staging directory.
+        """
+        job_id = uuid.uuid4().hex
+        staging_path = self.staging_path(job_id)
+        os.makedirs(staging_path, exist_ok=True)
+        return job_id, staging_path
+
+    def submit(self, job_id: str, input_type: str, embeddings, collection: str, merge_with_existing_db: bool=False, source_url: str="") -> dict:
+        """ A method to queue an ingestion job of documents staged for the job id, a web page, a YouTube video,
+            or a crawl of the pages of a sitemap or of a whitespace separated list of URLs.
+            Returns the state of the queued job.
+        """
+        os.makedirs(self.staging_path(job_id), exist_ok=True)
+        job = {
+            "job_id": job_id,
+            "collection": collection,
+            "input_type": input_type,
+            "source": source_url or ", ".join(sorted(os.listdir(self.staging_path(job_id)))),
+            "merge_with_existing_db": merge_with_existing_db,
+            "status": "queued",
+            "stages": {},
+            "created_time": time.time(),
+            "started_time": None,
+            "finished_time": None,
+            "build_time": None,
+            "extraction_report": [],
+            "stage_breakdown": [],
+            "error": None,
+            "owner_pid": os.getpid(),  # Process running the job, so that other processes only recover it once that process stops
+        }
+        with self._lock:
+            self.jobs[job_id] = job
+        self._save(job_id)
+        self._executor.submit(self._run, job_id, embeddings)
+        return dict(job)
+
+    def _update(self, job_id: str, **fields) -> None:
+        """ A method to update and persist the state of a job.
+        """
+        with self._lock:
+            self.jobs[job_id].update(fields)
+        self._save(job_id)
+
+    def _save(self, job_id: str) -> None:
+        """ A method to write the state of a job atomically.
+        """
+        with self._lock:
+            job = json.dumps(self.jobs[job_id], default=str)
+        job_path = os.path.join(self.jobs_dir, job_id, job_file_name)
+        os.makedirs(os.path.dirname(job_path), exist_ok=True)
+        temp_path = f"{job_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(job)
+        os.replace(temp_path, job_path)
+
+    def _run(self, job_id: str, embeddings) -> None:
+        """ A method to run an ingestion job on a worker thread, recording the progress of every stage.
+        """
+        job = self.get_job(job_id)
+        last_save = {"time": 0.0}
+
+        def update_progress(stage, completed, total):
+            with self._lock:
+                self.jobs[job_id]["stages"][stage] = {"completed": completed, "total": total}
+            if time.time() - last_save["time"] >= progress_save_interval or completed == total:
+                last_save["time"] = time.time()
+                self._save(job_id)
+
+        # Jobs wait for the builds of the collection by other workers and processes before they are marked as running
+        with build_lock(collection_paths(job["collection"])["db_path"]):
+            self._update(job_id, status="running", started_time=time.time())
+            # The stages of the job are traced under a single root span, so that the wait for the collection lock is left out
+            with tracer.span("ingestion_job", job_id=job_id, collection=job["collection"], input_type=job["input_type"]) as span, \
+                    llm_telemetry.feature("ingestion"):
+                self._execute(job_id, job, embeddings, update_progress)
+            self._update(job_id, stage_breakdown=tracer.stage_breakdown(span.trace_id))
+
+    def _execute(self, job_id: str, job: dict, embeddings, update_progress) -> None:
+        """ A method to extract the content of a job and build its collection, recording the outcome in the state of the job.
+        """
+        try:
+            vector_db = VECTOR_DB_UTILS(collection=job["collection"])
+            vector_db.knowledge_base_path = self.staging_path(job_id)
+            vector_db.embedding_cache = self.embedding_cache
+
+            page_content = ""
+            pages = None
+            if job["input_type"] == "web_crawl":
+                crawler = WEB_CRAWLER()
+                urls = job["source"].split()
+                if len(urls) == 1 and is_sitemap_url(urls[0]):
+                    with tracer.span("read_sitemap", source=urls[0]) as span:
+                        urls = crawler.sitemap_urls(urls[0])
+                        span.set(pages=len(urls))
+                    if not urls:
+                        raise ValueError("No pages were found in this sitemap")
+
+                def crawl_pages():
+                    update_progress("crawling", 0, len(urls))
+                    for completed, page in enumerate(crawler.crawl(urls), 1):
+                        update_progress("crawling", completed, len(urls))
+                        yield page
+
+                pages = crawl_pages()
+            elif job["input_type"] == "web_url":
+                update_progress("extracting", 0, 1)
+                with tracer.span("extract_url", source=job["source"]) as span:
+                    page_content = extract_text_url(job["source"])
+                    span.set(bytes=len(page_content.encode("utf-8")) if page_content else 0)
+                if not page_content:
+                    raise ValueError("Unable to extract text content from this URL")
+                update_progress("extracting", 1, 1)
+
+            db, build_time = vector_db.run_db_build(input_type="web_pages" if job["input_type"] == "web_crawl" else job["input_type"],
+                                                    embeddings=embeddings,
+                                                    page_content=page_content,
+                                                    source_url=job["source"] if job["input_type"] in ["web_url", "yt_url"] else "",
+                                                    merge_with_existing_db=job["merge_with_existing_db"],
+                                                    progress_callback=update_progress,
+                                                    pages=pages)
+            extraction_report = [{**report, "Extraction_Time": float(report["Extraction_Time"])} for report in vector_db.extraction_report]
+            if db is None:
+                self._update(job_id, status="failed", error="No content was added to the vector database", extraction_report=extraction_report,
+                             finished_time=time.time())
+            else:
+                self._update(job_id, status="done", build_time=build_time, extraction_report=extraction_report, finished_time=time.time())
+        except Exception as e:
+            print(f"Ingestion job {job_id} failed: {e}")
+            self._update(job_id, status="failed", error=str(e), finished_time=time.time())
+
+        # Files that were ingested have been moved to the processed documents, so only failed files are left in staging
+        staging_path = self.staging_path(job_id)
+        if os.path.exists(staging_path) and not os.listdir(staging_path):
+            os.rmdir(staging_path)
+
+    def get_job(self, job_id: str) -> dict:
+        """ A method to return a copy of the state of a job, or None if the job is unknown.
+            The state of an active job run by another process is read again from disk, so that its progress is visible to every process.
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is not None and job["status"] in active_statuses and job.get("owner_pid") != os.getpid():
+            try:
+                with open(os.path.join(self.jobs_dir, job_id, job_file_name), "r") as f:
+                    job = json.load(f)
+                with self._lock:
+                    self.jobs[job_id] = job
+                self._fail_if_orphaned(job_id)
+            except (OSError, ValueError):
+                pass  # The job file is being replaced or was cleared, so the last known state is returned
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job, default=str)) if job is not None else None
+
+    def list_jobs(self, collection: str=None) -> list:
+        """ A method to return the state of the jobs, optionally of a single collection, most recent first.
+        """
+        with self._lock:
+            job_ids = [job_id for job_id, job in self.jobs.items() if collection is None or job["collection"] == collection]
+        jobs = [self.get_job(job_id) for job_id in job_ids]
+        return sorted(jobs, key=lambda job: job["created_time"], reverse=True)
+
+    def has_active_jobs(self, collection: str=None) -> bool:
+        """ A method to check whether any job, optionally of a single collection, is queued or running.
+        """
+        return any(job["status"] in active_statuses for job in self.list_jobs(collection))
+
+    def clear_finished(self, collection: str=None) -> None:
+        """ A method to remove the state and the staged files of the finished jobs, optionally of a single collection.
+        """
+        for job in self.list_jobs(collection):
+            if job["status"] not in active_statuses:
+                with self._lock:
+                    del self.jobs[job["job_id"]]
+                shutil.rmtree(os.path.join(self.jobs_dir, job["job_id"]), ignore_errors=True)
+
+
+# Process-wide queue shared by every session
+ingestion_queue = INGESTION_JOB_QUEUE()
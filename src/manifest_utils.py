@@ -0,0 +1,117 @@
+""" A python file to keep track of the sources stored in the vector database.
+    The manifest records a content hash, size, modification time and the produced chunk ids for every source,
+    so that a rebuild only has to embed the sources that changed.
+"""
+
+import os
+import json
+import hashlib
+import datetime
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+db_manifest_file_path = f"{project_root}/db_manifest.json"
+
+
+class SOURCE_MANIFEST:
+    """ A class to persist the fingerprints and chunk ids of the sources ingested into the vector database.
+    """
+
+    def __init__(self, manifest_path: str=db_manifest_file_path) -> None:
+        self.manifest_path = manifest_path
+        self.sources = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.sources = json.load(f)
+
+    def __contains__(self, source: str) -> bool:
+        return source in self.sources
+
+    @staticmethod
+    def file_fingerprint(file_path: str) -> dict:
+        """ A method to calculate the content hash, size and modification time of a file.
+        """
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+        stat = os.stat(file_path)
+        return {"hash": sha256.hexdigest(), "size": stat.st_size, "mtime": stat.st_mtime}
+
+    @staticmethod
+    def text_fingerprint(text: str) -> dict:
+        """ A method to calculate the content hash and size of extracted text such as web pages or transcripts.
+        """
+        encoded_text = text.encode("utf-8")
+        return {"hash": hashlib.sha256(encoded_text).hexdigest(), "size": len(encoded_text), "mtime": None}
+
+    def file_changed(self, source: str, file_path: str):
+        """ A method to check whether a file differs from its manifest entry.
+            Returns None if the file is unchanged, otherwise the new fingerprint of the file.
+            Files with an unchanged size and modification time are not hashed again.
+        """
+        entry = self.sources.get(source)
+        if entry is not None:
+            stat = os.stat(file_path)
+            if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                return None
+
+        fingerprint = self.file_fingerprint(file_path)
+        if entry is not None and entry["hash"] == fingerprint["hash"]:
+            return None
+        return fingerprint
+
+    def text_changed(self, source: str, text: str):
+        """ A method to check whether extracted text differs from its manifest entry.
+            Returns None if the text is unchanged, otherwise the new fingerprint of the text.
+        """
+        fingerprint = self.text_fingerprint(text)
+        entry = self.sources.get(source)
+        if entry is not None and entry["hash"] == fingerprint["hash"]:
+            return None
+        return fingerprint
+
+    def list_sources(self, input_type: str=None) -> list:
+        """ A method to list the sources in the manifest, optionally filtered by input type.
+        """
+        return [source for source, entry in self.sources.items() if input_type is None or entry["input_type"] == input_type]
+
+    def get_chunk_ids(self, source: str) -> list:
+        """ A method to return the chunk ids produced for a source.
+        """
+        return self.sources.get(source, {}).get("chunk_ids", [])
+
+    def update(self, source: str, input_type: str, fingerprint: dict, chunk_ids: list) -> None:
+        """ A method to add or replace the manifest entry of a source.
+        """
+        self.sources[source] = {
+            "input_type": input_type,
+            **fingerprint,
+            "chunk_ids": chunk_ids,
+            "updated_time": datetime.datetime.now().isoformat(),
+        }
+
+    def add_chunk_ids(self, source: str, chunk_ids: list) -> None:
+        """ A method to record chunks handed over to a source that is already in the manifest.
+        """
+        if source in self.sources:
+            self.sources[source]["chunk_ids"] = self.sources[source]["chunk_ids"] + list(chunk_ids)
+
+    def remove(self, source: str) -> list:
+        """ A method to remove a source from the manifest and return its chunk ids.
+        """
+        return self.sources.pop(source, {}).get("chunk_ids", [])
+
+    def reset(self) -> None:
+        """ A method to remove every entry from the manifest.
+        """
+        self.sources = {}
+
+    def save(self) -> None:
+        """ A method to write the manifest to disk.
+        """
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.sources, f, indent=2)
+        os.replace(temp_path, self.manifest_path)
@@ -17,6 +17,23 @@ def summarize_text(text_input: str, word_limit: int=250):
 
     return messages
 
+def combine_summaries(summaries: list, word_limit: int=250):
+    """A prompt template to combine the partial summaries of consecutive parts of a text into one summary."""
+    delimitter = "####"
+    system_message = f"""You are an helpful assistant and follows given instructions. \
+        You are given summaries of consecutive parts of a longer text, each provided in between {delimitter} characters. \
+        Combine them into a single coherent summary of the whole text. \
+        Summarized content should be not more than {word_limit} words. \
+        Summarized content must has key points present in the provided summaries.
+        """
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": "\n".join(f"{delimitter}{summary}{delimitter}" for summary in summaries)},
+        {"role": "assistant", "content": "Helpful Summarized content:\n"}
+    ]
+
+    return messages
+
 def prompt_doc_qa():
     """A prompt template to define a prompt template for Question and Answering of a document."""
 
@@ -0,0 +1,130 @@
+""" A python file to re-rank vector search candidates with maximal marginal relevance using vectorized NumPy operations.
+    The embeddings of the vector db are held once as a contiguous matrix of L2-normalized rows, so that the candidates
+    of a batch of queries are gathered and re-ranked with a few matrix products instead of per-candidate reconstruction.
+    Indexes with compressed vectors are not expanded in memory. Their candidates are read from the exact vectors on disk if available,
+    which also re-ranks a larger candidate set by exact distance, or decoded from the index otherwise.
+"""
+
+import os
+import numpy as np
+from index_utils import vector_encoding
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+MMR_LAMBDA_MULT = float(os.environ["MMR_LAMBDA_MULT"])  # Trade-off between relevance (1) and diversity (0) of MMR search
+RERANK_FACTOR = int(os.environ["RERANK_FACTOR"])  # Candidates fetched from a compressed index per candidate kept after exact re-ranking
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    """ A function to return a contiguous float32 copy of the vectors scaled to unit L2 norm. Zero vectors are left as they are.
+    """
+    vectors = np.array(vectors, dtype=np.float32, order="C", ndmin=2)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors /= norms
+    return vectors
+
+
+def mmr_rerank(query_vectors: np.ndarray, candidate_vectors: np.ndarray, k: int, lambda_mult: float=MMR_LAMBDA_MULT, valid: np.ndarray=None) -> np.ndarray:
+    """ A function to select k candidates per query with maximal marginal relevance.
+        query_vectors has the shape (queries, dimension) and candidate_vectors (queries, candidates, dimension), both L2-normalized.
+        The optional valid mask of shape (queries, candidates) excludes padded candidates.
+        Returns the selected candidate positions with the shape (queries, k), padded with -1 if fewer candidates are valid.
+    """
+    num_queries, num_candidates, _ = candidate_vectors.shape
+    k = min(k, num_candidates)
+    rows = np.arange(num_queries)
+
+    # Cosine similarities of every candidate to its query and to the other candidates of the same query
+    query_similarity = np.matmul(candidate_vectors, query_vectors[:, :, None])[:, :, 0]
+    pairwise_similarity = np.matmul(candidate_vectors, candidate_vectors.transpose(0, 2, 1))
+
+    available = np.ones((num_queries, num_candidates), dtype=bool) if valid is None else valid.copy()
+    max_selected_similarity = np.full((num_queries, num_candidates), -np.inf, dtype=np.float32)
+    selected = np.full((num_queries, k), -1, dtype=np.int64)
+
+    # The first pick is the most similar candidate, later picks trade relevance against similarity to the selected candidates
+    scores = query_similarity
+    for step in range(k):
+        choice = np.where(available, scores, -np.inf).argmax(axis=1)
+        has_choice = available[rows, choice]
+        selected[:, step] = np.where(has_choice, choice, -1)
+        available[rows, choice] = False
+        np.maximum(max_selected_similarity, pairwise_similarity[rows, choice], out=max_selected_similarity)
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * max_selected_similarity
+
+    return selected
+
+
+class MMR_RETRIEVER:
+    """ A class to run MMR search over a vector db with vectorized re-ranking.
+        Candidates are fetched from the FAISS index for the whole batch of queries at once and re-ranked on the normalized embedding matrix.
+    """
+
+    def __init__(self, index, index_to_docstore_id: dict, docstore, exact_store=None, rerank_factor: int=RERANK_FACTOR) -> None:
+        self.index = index
+        self.index_to_docstore_id = index_to_docstore_id
+        self.docstore = docstore
+        self.rerank_factor = rerank_factor
+        self.vectors = None
+        self.exact_store = None
+        if vector_encoding(index) == "float32":
+            self.vectors = normalize_rows(index.reconstruct_n(0, index.ntotal)) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+        elif exact_store is not None and len(exact_store) == index.ntotal:
+            # Exact vectors are only used if they cover every chunk of the index
+            self.exact_store = exact_store
+
+    @classmethod
+    def from_db(cls, db):
+        """ A method to build the retriever from the index, docstore and exact vectors of a vector db.
+        """
+        return cls(db.index, db.index_to_docstore_id, db.docstore, exact_store=getattr(db, "exact_store", None))
+
+    def _gather(self, query_vectors: np.ndarray, candidate_positions: np.ndarray, valid: np.ndarray, fetch_k: int) -> tuple:
+        """ A method to gather the normalized vectors of the candidates with the shape (queries, candidates, dimension).
+            With exact vectors, the candidates are re-ranked by exact L2 distance and only the best fetch_k are kept.
+            Returns the candidate positions, their valid mask and their vectors.
+        """
+        safe_positions = np.where(valid, candidate_positions, 0)
+        if self.vectors is not None:
+            return candidate_positions, valid, self.vectors[safe_positions]
+
+        flat_positions = safe_positions.ravel()
+        if self.exact_store is not None:
+            vectors = self.exact_store.get([self.index_to_docstore_id[position] for position in flat_positions])
+        else:
+            vectors = self.index.reconstruct_batch(flat_positions)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(*safe_positions.shape, -1)
+
+        if self.exact_store is not None:
+            distances = ((vectors - query_vectors[:, None, :]) ** 2).sum(axis=2)
+            distances[~valid] = np.inf
+            order = np.argsort(distances, axis=1, kind="stable")[:, :fetch_k]
+            candidate_positions = np.take_along_axis(candidate_positions, order, axis=1)
+            valid = np.take_along_axis(valid, order, axis=1)
+            vectors = np.take_along_axis(vectors, order[:, :, None], axis=1)
+
+        return candidate_positions, valid, normalize_rows(vectors)
+
+    def search_positions(self, query_vectors, k: int=6, fetch_k: int=20, lambda_mult: float=MMR_LAMBDA_MULT) -> np.ndarray:
+        """ A method to return the index positions selected by MMR for every query, with the shape (queries, k) padded with -1.
+        """
+        query_vectors = np.array(query_vectors, dtype=np.float32, ndmin=2)
+        _, candidate_positions = self.index.search(query_vectors, fetch_k * self.rerank_factor if self.exact_store is not None else fetch_k)
+        candidate_positions, valid, candidate_vectors = self._gather(query_vectors, candidate_positions, candidate_positions != -1, fetch_k)
+
+        selected = mmr_rerank(normalize_rows(query_vectors), candidate_vectors, k=k, lambda_mult=lambda_mult, valid=valid)
+        return np.where(selected >= 0, np.take_along_axis(candidate_positions, np.maximum(selected, 0), axis=1), -1)
+
+    def search_by_vectors(self, query_vectors, k: int=6, fetch_k: int=20, lambda_mult: float=MMR_LAMBDA_MULT) -> list:
+        """ A method to return the documents selected by MMR for every query vector.
+        """
+        return [[self.docstore.search(self.index_to_docstore_id[position]) for position in positions if position != -1]
+                for positions in self.search_positions(query_vectors, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)]
+
+    def search(self, embeddings, queries: list, k: int=6, fetch_k: int=20, lambda_mult: float=MMR_LAMBDA_MULT) -> list:
+        """ A method to embed a batch of queries in a single request and return the documents selected by MMR for every query.
+        """
+        return self.search_by_vectors(embeddings.embed_documents(queries), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
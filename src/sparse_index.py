@@ -0,0 +1,183 @@
+""" A python file to define a BM25 inverted index over the chunks of the vector database and the hybrid retrieval that fuses it with vector search.
+    The inverted index is saved next to the FAISS index and updated incrementally with the chunk ids of the vector db.
+"""
+
+import os
+import re
+import math
+import heapq
+import pickle
+from retriever_utils import MMR_LAMBDA_MULT
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+HYBRID_SPARSE_WEIGHT = float(os.environ["HYBRID_SPARSE_WEIGHT"])  # Weight of BM25 ranks in the fusion with vector ranks, between 0 and 1
+
+sparse_index_file_name = "sparse_index.pkl"
+
+# Rank constant of reciprocal rank fusion
+rrf_k = 60
+
+# Words joined by hyphens or dots are kept together so that part numbers, versions and error codes match as a whole
+token_pattern = re.compile(r"\w+(?:[-.]\w+)*")
+
+
+def tokenize(text: str) -> list:
+    """ A function to split a text into lower case terms.
+    """
+    return token_pattern.findall(text.lower())
+
+
+def reciprocal_rank_fusion(ranked_lists: list, weights: list, k: int=rrf_k) -> list:
+    """ A function to fuse several ranked lists of keys. Every key scores the weighted sum of 1 / (k + rank) over the lists it appears in.
+        Returns the keys ordered by their fused score.
+    """
+    scores = {}
+    for ranked_keys, weight in zip(ranked_lists, weights):
+        for rank, key in enumerate(ranked_keys, start=1):
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class BM25_INDEX:
+    """ A class to score chunks against a query with Okapi BM25 using an inverted index of term frequencies.
+    """
+
+    def __init__(self, k1: float=1.5, b: float=0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.doc_terms = {}  # Term frequencies of every chunk, keyed by chunk id
+        self.doc_lengths = {}  # Number of terms of every chunk, keyed by chunk id
+        self.postings = {}  # Term frequency of every chunk containing a term, keyed by term
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+    def add(self, chunk_ids: list, texts: list) -> None:
+        """ A method to index the texts of chunks. A chunk that is already indexed is replaced.
+        """
+        for chunk_id, text in zip(chunk_ids, texts):
+            if chunk_id in self.doc_terms:
+                self.remove([chunk_id])
+            term_frequencies = {}
+            for term in tokenize(text):
+                term_frequencies[term] = term_frequencies.get(term, 0) + 1
+            self._add_terms(chunk_id, term_frequencies)
+
+    def _add_terms(self, chunk_id: str, term_frequencies: dict) -> None:
+        """ A method to add the term frequencies of a chunk to the postings.
+        """
+        self.doc_terms[chunk_id] = term_frequencies
+        self.doc_lengths[chunk_id] = sum(term_frequencies.values())
+        self.total_length += self.doc_lengths[chunk_id]
+        for term, frequency in term_frequencies.items():
+            self.postings.setdefault(term, {})[chunk_id] = frequency
+
+    def remove(self, chunk_ids: list) -> None:
+        """ A method to remove chunks from the index. Unknown chunk ids are ignored.
+        """
+        for chunk_id in chunk_ids:
+            term_frequencies = self.doc_terms.pop(chunk_id, None)
+            if term_frequencies is None:
+                continue
+            self.total_length -= self.doc_lengths.pop(chunk_id)
+            for term in term_frequencies:
+                posting = self.postings[term]
+                del posting[chunk_id]
+                if not posting:
+                    del self.postings[term]
+
+    def merge_from(self, other: "BM25_INDEX") -> None:
+        """ A method to add every chunk of another index, the counterpart of FAISS.merge_from for the vector db.
+        """
+        for chunk_id, term_frequencies in other.doc_terms.items():
+            if chunk_id in self.doc_terms:
+                self.remove([chunk_id])
+            self._add_terms(chunk_id, dict(term_frequencies))
+
+    def search(self, query: str, k: int=10) -> list:
+        """ A method to return up to k (chunk id, score) pairs with the highest BM25 scores for the query.
+        """
+        num_docs = len(self.doc_terms)
+        if num_docs == 0:
+            return []
+        avg_length = self.total_length / num_docs
+
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (num_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, frequency in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, db_path: str) -> None:
+        """ A method to persist the index next to the FAISS index.
+        """
+        temp_path = os.path.join(db_path, f"{sparse_index_file_name}.tmp")
+        with open(temp_path, "wb") as f:
+            pickle.dump({"k1": self.k1, "b": self.b, "doc_terms": self.doc_terms}, f)
+        os.replace(temp_path, os.path.join(db_path, sparse_index_file_name))
+
+    @classmethod
+    def load(cls, db_path: str):
+        """ A method to load the index saved next to the FAISS index. Returns None if no index is saved.
+        """
+        file_path = os.path.join(db_path, sparse_index_file_name)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "rb") as f:
+            data = pickle.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        for chunk_id, term_frequencies in data["doc_terms"].items():
+            index._add_terms(chunk_id, term_frequencies)
+        return index
+
+    @classmethod
+    def from_db(cls, db):
+        """ A method to build the index from the chunks of a vector db, for databases saved without a sparse index.
+        """
+        index = cls()
+        chunk_ids = list(db.index_to_docstore_id.values())
+        index.add(chunk_ids, [db.docstore.search(chunk_id).page_content for chunk_id in chunk_ids])
+        return index
+
+
+def hybrid_search(db, query: str, k: int=6, fetch_k: int=20, lambda_mult: float=MMR_LAMBDA_MULT, sparse_weight: float=HYBRID_SPARSE_WEIGHT,
+                  query_vector: list=None) -> list:
+    """ A function to retrieve chunks by fusing the MMR ranking of the vector db with the BM25 ranking of its sparse index.
+        The vectorized MMR retriever of the db is used if available. Falls back to MMR search only if the db has no sparse index or the sparse weight is 0.
+        The query is embedded unless its embedding is given.
+    """
+    query_vector = db._embed_query(query) if query_vector is None else query_vector
+    mmr_retriever = getattr(db, "mmr_retriever", None)
+    if mmr_retriever is not None:
+        dense_documents = mmr_retriever.search_by_vectors([query_vector], k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)[0]
+    else:
+        dense_documents = db.max_marginal_relevance_search_by_vector(query_vector, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
+    sparse_index = getattr(db, "sparse_index", None)
+    if sparse_index is None or sparse_weight <= 0:
+        return dense_documents
+
+    sparse_documents = [db.docstore.search(chunk_id) for chunk_id, _ in sparse_index.search(query, k=k)]
+
+    # Chunks are matched between both rankings by their source and content
+    documents = {}
+    ranked_lists = []
+    for ranked_documents in [dense_documents, sparse_documents]:
+        ranked_keys = []
+        for document in ranked_documents:
+            key = (document.metadata.get("source"), document.page_content)
+            documents.setdefault(key, document)
+            ranked_keys.append(key)
+        ranked_lists.append(ranked_keys)
+
+    fused_keys = reciprocal_rank_fusion(ranked_lists, [1 - sparse_weight, sparse_weight])
+    return [documents[key] for key in fused_keys[:k]]
@@ -0,0 +1,107 @@
+""" A python file to summarize texts of any length with GPT models using a map-reduce approach.
+    The text is split into token-budgeted chunks that are summarized concurrently through the rate-limited asyncio client,
+    and the partial summaries are combined recursively until they fit into a single prompt.
+"""
+
+import os
+import time
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from prompts import summarize_text, combine_summaries
+from token_utils import num_tokens_from_string
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+SUMMARY_CHUNK_TOKENS = int(os.environ["SUMMARY_CHUNK_TOKENS"])  # Maximum number of text tokens sent in a single summarization prompt
+
+
+class SUMMARY_UTILS:
+    """ A class to summarize long texts with a hierarchical map-reduce approach on top of GPT_UTILS.
+    """
+
+    def __init__(self, gpt, chunk_tokens: int=SUMMARY_CHUNK_TOKENS) -> None:
+        self.gpt = gpt
+        self.chunk_tokens = chunk_tokens
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_tokens,
+                                                            chunk_overlap=chunk_tokens // 20,
+                                                            length_function=lambda text: num_tokens_from_string(text, gpt.default_model))
+
+    @staticmethod
+    def _max_tokens(word_limit: int) -> int:
+        """ A method to calculate the completion token budget for a word limit, assuming up to 1.5 tokens per word.
+        """
+        return int(word_limit * 1.5) + 50
+
+    def _complete(self, messages: list, max_tokens: int) -> tuple:
+        """ A method to get a single completion and return its content and total tokens used.
+        """
+        response = self.gpt.get_completion_from_messages(messages=messages, max_tokens=max_tokens)
+        return response.choices[0].message["content"], response.usage.total_tokens
+
+    def _complete_all(self, prompts: list, max_tokens: int) -> tuple:
+        """ A method to get the completions of several prompts concurrently.
+            Returns the contents in the order of the prompts and the total tokens used.
+        """
+        responses = self.gpt.get_completions_from_messages_batch(messages_list=prompts, max_tokens=max_tokens)
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        return [response.choices[0].message["content"] for response in responses], sum(response.usage.total_tokens for response in responses)
+
+    def _group_summaries(self, summaries: list) -> list:
+        """ A method to pack consecutive summaries into groups that fit into the token budget of a prompt.
+            Every group holds at least two summaries so that each reduce step shrinks the number of summaries.
+        """
+        groups = []
+        group_tokens = 0
+        for summary in summaries:
+            num_tokens = num_tokens_from_string(summary, self.gpt.default_model)
+            if groups and (group_tokens + num_tokens <= self.chunk_tokens or len(groups[-1]) < 2):
+                groups[-1].append(summary)
+                group_tokens += num_tokens
+            else:
+                groups.append([summary])
+                group_tokens = num_tokens
+        return groups
+
+    def _map_reduce(self, text_input: str, word_limit: int) -> tuple:
+        """ A method to summarize the chunks of a text and combine the partial summaries until they fit into a single prompt.
+            Returns the messages of the final prompt, its completion token budget and the tokens used so far.
+        """
+        chunks = self.text_splitter.split_text(text_input)
+        if len(chunks) <= 1:
+            return summarize_text(text_input=text_input, word_limit=word_limit), self._max_tokens(word_limit), 0
+
+        # Map: summarize every chunk concurrently
+        partial_word_limit = max(100, word_limit // 2)
+        summaries, tokens_used = self._complete_all([summarize_text(text_input=chunk, word_limit=partial_word_limit) for chunk in chunks],
+                                                    self._max_tokens(partial_word_limit))
+
+        # Reduce: combine the partial summaries until they fit into a single prompt
+        groups = self._group_summaries(summaries)
+        while len(groups) > 1:
+            summaries, reduce_tokens = self._complete_all([combine_summaries(summaries=group, word_limit=partial_word_limit) for group in groups],
+                                                          self._max_tokens(partial_word_limit))
+            tokens_used += reduce_tokens
+            groups = self._group_summaries(summaries)
+
+        return combine_summaries(summaries=groups[0], word_limit=word_limit), self._max_tokens(word_limit), tokens_used
+
+    def summarize(self, text_input: str, word_limit: int=250) -> tuple:
+        """ A method to summarize a text of any length within the word limit.
+            Returns the summary and the total tokens used.
+        """
+        messages, max_tokens, tokens_used = self._map_reduce(text_input, word_limit)
+        summary, final_tokens = self._complete(messages, max_tokens)
+
+        return summary, tokens_used + final_tokens
+
+    def summarize_stream(self, text_input: str, word_limit: int=250):
+        """ A method to summarize a text of any length within the word limit, streaming the final summary.
+            Returns a COMPLETION_STREAM whose timings start with the map-reduce steps and whose token usage includes them.
+        """
+        start_time = time.time()
+        messages, max_tokens, tokens_used = self._map_reduce(text_input, word_limit)
+
+        return self.gpt.stream_completion_from_messages(messages=messages, max_tokens=max_tokens, extra_tokens=tokens_used, start_time=start_time)
@@ -0,0 +1,268 @@
+""" A python file to collect telemetry of the requests to the Open AI models: latency, tokens, cost, model escalations, errors and retries.
+    Every request is tagged with the feature it serves, which callers set for a block of code, so that usage can be broken down by feature.
+    Totals are kept since the process started, latency percentiles over a rolling window, and both are exported in the Prometheus text format and as JSON.
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from collections import deque
+import numpy as np
+from dotenv import load_dotenv, find_dotenv
+from trace_utils import HISTOGRAM, format_labels, metrics_collectors
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+TELEMETRY_WINDOW_MINUTES = int(os.environ["TELEMETRY_WINDOW_MINUTES"])  # Window of the rolling latency percentiles
+
+# Prices in dollars per 1000 prompt and completion tokens, matched by the longest model name prefix
+model_prices = {
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4": (0.03, 0.06),
+    "text-embedding-ada-002": (0.0001, 0.0),
+}
+
+# Upper bounds in seconds of the buckets of the latency histograms
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120]
+
+# Maximum number of requests kept for the rolling percentiles
+max_window_events = 100000
+
+default_feature = "other"
+current_feature = contextvars.ContextVar("llm_feature", default=default_feature)
+
+
+def model_price(model: str) -> tuple:
+    """ A function to return the prices per 1000 prompt and completion tokens of a model, or zero for unknown models.
+    """
+    for prefix in sorted(model_prices, key=len, reverse=True):
+        if model.startswith(prefix):
+            return model_prices[prefix]
+    return 0.0, 0.0
+
+
+class LLM_TELEMETRY:
+    """ A class to record the requests to the models, keyed by operation, model and feature.
+        Operations are completion, stream, embedding and retrieval_qa, the last covering a whole question answered from the vector db.
+        Tokens and cost are only counted on the requests to the models, so retrieval_qa records latency without counting its completion twice.
+    """
+
+    def __init__(self, window_minutes: int=TELEMETRY_WINDOW_MINUTES) -> None:
+        self.window_seconds = window_minutes * 60
+        self.series = {}  # Totals and latency histogram keyed by (operation, model, feature)
+        self.selections = {}  # Model selections and escalations to the large context model keyed by feature
+        self.tail_events = {}  # Counts of hedged requests, hedges that won, timeouts and fallbacks keyed by (event, model, feature)
+        self.window = deque(maxlen=max_window_events)  # (time, operation, model, feature, latency) of the recent successful requests
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def feature(name: str):
+        """ A context manager to tag the requests made in a block of code, including its asyncio tasks, with a feature.
+        """
+        token = current_feature.set(name)
+        try:
+            yield
+        finally:
+            current_feature.reset(token)
+
+    @staticmethod
+    def current_feature() -> str:
+        return current_feature.get()
+
+    def _series(self, operation: str, model: str, feature: str) -> dict:
+        key = (operation, model, feature or current_feature.get())
+        if key not in self.series:
+            self.series[key] = {"requests": 0, "errors": {}, "retries": 0, "cache_hits": 0, "cancelled": 0, "prompt_tokens": 0,
+                                "completion_tokens": 0, "cost": 0.0, "histogram": HISTOGRAM(latency_buckets)}
+        return self.series[key]
+
+    def record_request(self, operation: str, model: str, latency: float, usage: dict=None, error: Exception=None, feature: str=None) -> None:
+        """ A method to record a request that succeeded with its token usage, or failed with an error.
+            The feature defaults to the one of the calling context, but requests completed later, such as streams, pass the feature they started with.
+        """
+        feature = feature or current_feature.get()
+        with self._lock:
+            series = self._series(operation, model, feature)
+            if error is not None:
+                error_type = type(error).__name__
+                series["errors"][error_type] = series["errors"].get(error_type, 0) + 1
+                return
+            usage = usage or {}
+            prompt_tokens = usage.get("prompt_tokens", 0) or 0
+            completion_tokens = usage.get("completion_tokens", 0) or 0
+            prompt_price, completion_price = model_price(model)
+            series["requests"] += 1
+            series["prompt_tokens"] += prompt_tokens
+            series["completion_tokens"] += completion_tokens
+            series["cost"] += (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+            series["histogram"].observe(latency)
+            self.window.append((time.time(), operation, model, feature, latency))
+
+    def record_cancelled(self, operation: str, model: str, latency: float, feature: str=None) -> None:
+        """ A method to record a request that was cancelled, such as the slower one of a hedged pair.
+            Its latency is kept in the rolling window as a lower bound, so that hedging does not hide the slow requests it cancels.
+        """
+        feature = feature or current_feature.get()
+        with self._lock:
+            self._series(operation, model, feature)["cancelled"] += 1
+            self.window.append((time.time(), operation, model, feature, latency))
+
+    def record_tail_event(self, event: str, model: str, feature: str=None) -> None:
+        """ A method to count an event of the tail latency mode: hedged, hedge_won, timeout or fallback.
+        """
+        key = (event, model, feature or current_feature.get())
+        with self._lock:
+            self.tail_events[key] = self.tail_events.get(key, 0) + 1
+
+    def latency_percentile(self, operation: str, model: str, q: float, min_samples: int=1):
+        """ A method to return a percentile of the latencies of an operation and model over the rolling window, across features.
+            Returns None if fewer than the minimum number of requests are in the window.
+        """
+        with self._lock:
+            window_latencies = self._window_latencies()
+        latencies = [latency for (window_operation, window_model, _), values in window_latencies.items()
+                     if window_operation == operation and window_model == model for latency in values]
+        return float(np.percentile(latencies, q)) if len(latencies) >= max(min_samples, 1) else None
+
+    def record_retry(self, operation: str, model: str, feature: str=None) -> None:
+        with self._lock:
+            self._series(operation, model, feature)["retries"] += 1
+
+    def record_cache_hit(self, operation: str, model: str, feature: str=None) -> None:
+        """ A method to record a request answered from the response or semantic cache without calling the model.
+        """
+        with self._lock:
+            self._series(operation, model, feature)["cache_hits"] += 1
+
+    def record_selection(self, escalated: bool, feature: str=None) -> None:
+        """ A method to record a choice of the model, escalated if the large context model was selected.
+        """
+        with self._lock:
+            selections = self.selections.setdefault(feature or current_feature.get(), {"selections": 0, "escalations": 0})
+            selections["selections"] += 1
+            selections["escalations"] += escalated
+
+    def _window_latencies(self) -> dict:
+        """ A method to group the latencies of the rolling window by series, dropping the requests that fell out of it. The caller holds the lock.
+        """
+        cutoff = time.time() - self.window_seconds
+        while self.window and self.window[0][0] < cutoff:
+            self.window.popleft()
+        latencies = {}
+        for _, operation, model, feature, latency in self.window:
+            latencies.setdefault((operation, model, feature), []).append(latency)
+        return latencies
+
+    def summary(self) -> list:
+        """ A method to return the totals of every operation, model and feature, with the latency percentiles of the rolling window.
+        """
+        with self._lock:
+            latencies = self._window_latencies()
+            rows = []
+            for (operation, model, feature), series in sorted(self.series.items()):
+                errors = sum(series["errors"].values())
+                window = np.array(latencies.get((operation, model, feature), []))
+                rows.append({
+                    "Operation": operation,
+                    "Model": model,
+                    "Feature": feature,
+                    "Requests": series["requests"],
+                    "Errors": errors,
+                    "Error_Rate": errors / (series["requests"] + errors) if series["requests"] + errors else 0.0,
+                    "Retries": series["retries"],
+                    "Cache_Hits": series["cache_hits"],
+                    "Cancelled": series["cancelled"],
+                    "Prompt_Tokens": series["prompt_tokens"],
+                    "Completion_Tokens": series["completion_tokens"],
+                    "Cost": round(series["cost"], 6),
+                    "P50": float(np.percentile(window, 50)) if len(window) else None,
+                    "P95": float(np.percentile(window, 95)) if len(window) else None,
+                    "P99": float(np.percentile(window, 99)) if len(window) else None,
+                })
+        return rows
+
+    def escalation_rates(self) -> dict:
+        """ A method to return how often the large context model was selected, by feature.
+        """
+        with self._lock:
+            return {feature: {**selections, "rate": selections["escalations"] / selections["selections"] if selections["selections"] else 0.0}
+                    for feature, selections in self.selections.items()}
+
+    def to_json(self) -> str:
+        """ A method to export the totals, rolling percentiles and escalation rates as JSON.
+        """
+        with self._lock:
+            errors = {"|".join(key): dict(series["errors"]) for key, series in self.series.items() if series["errors"]}
+            tail_events = dict(self.tail_events)
+        return json.dumps({
+            "start_time": self.start_time,
+            "export_time": time.time(),
+            "window_minutes": self.window_seconds / 60,
+            "series": self.summary(),
+            "errors": errors,
+            "escalations": self.escalation_rates(),
+            "tail_events": [{"event": event, "model": model, "feature": feature, "count": count} for (event, model, feature), count in tail_events.items()],
+        }, indent=2)
+
+    def export(self, file_path: str) -> None:
+        """ A method to write the JSON export to a file, for example at the end of a command line run.
+        """
+        with open(file_path, "w") as f:
+            f.write(self.to_json())
+
+    def to_prometheus(self) -> str:
+        """ A method to export the latency histograms and the counters in the Prometheus text format.
+        """
+        with self._lock:
+            series = {key: {**values, "errors": dict(values["errors"])} for key, values in self.series.items()}
+            lines = ["# HELP llm_request_duration_seconds Latency of the successful requests to the models",
+                     "# TYPE llm_request_duration_seconds histogram"]
+            for (operation, model, feature), values in series.items():
+                lines.extend(values["histogram"].prometheus_lines("llm_request_duration_seconds",
+                                                                 {"operation": operation, "model": model, "feature": feature}))
+            selections = {feature: dict(values) for feature, values in self.selections.items()}
+            tail_events = dict(self.tail_events)
+
+        counters = {
+            "requests": "Successful requests to the models",
+            "retries": "Retries of failed requests",
+            "cache_hits": "Requests answered from the response or semantic cache",
+            "cancelled": "Requests cancelled before they completed, such as the slower one of a hedged pair",
+            "prompt_tokens": "Prompt tokens sent to the models",
+            "completion_tokens": "Completion tokens generated by the models",
+            "cost": "Estimated cost of the tokens in dollars",
+        }
+        for counter, help_text in counters.items():
+            lines.append(f"# HELP llm_{counter}_total {help_text}")
+            lines.append(f"# TYPE llm_{counter}_total counter")
+            lines.extend(f"llm_{counter}_total{format_labels({'operation': operation, 'model': model, 'feature': feature})} {values[counter]}"
+                         for (operation, model, feature), values in series.items())
+
+        lines.extend(["# HELP llm_errors_total Failed requests to the models by error type", "# TYPE llm_errors_total counter"])
+        for (operation, model, feature), values in series.items():
+            lines.extend(f"llm_errors_total{format_labels({'operation': operation, 'model': model, 'feature': feature, 'error_type': error_type})} {count}"
+                         for error_type, count in values["errors"].items())
+
+        for counter, help_text in {"selections": "Model selections", "escalations": "Selections of the large context model"}.items():
+            lines.append(f"# HELP llm_model_{counter}_total {help_text}")
+            lines.append(f"# TYPE llm_model_{counter}_total counter")
+            lines.extend(f"llm_model_{counter}_total{format_labels({'feature': feature})} {values[counter]}" for feature, values in selections.items())
+
+        lines.extend(["# HELP llm_tail_events_total Hedged requests, hedges that won, timeouts and fallbacks of the tail latency mode",
+                      "# TYPE llm_tail_events_total counter"])
+        lines.extend(f"llm_tail_events_total{format_labels({'event': event, 'model': model, 'feature': feature})} {count}"
+                     for (event, model, feature), count in tail_events.items())
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide telemetry shared by every session, served with the ingestion metrics
+llm_telemetry = LLM_TELEMETRY()
+metrics_collectors.append(llm_telemetry.to_prometheus)
@@ -0,0 +1,80 @@
+""" A python file to count tokens with cached encoders and to pack ranked chunks into a prompt token budget.
+"""
+
+import os
+from functools import lru_cache
+import tiktoken  # Importing tiktoken library to calculate the number of tokens
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+default_model = os.environ["DEFAULT_MODEL"]  # Default gpt model whose encoding is used to count tokens
+
+# Tokens added by the chat format, see https://github.com/openai/openai-cookbook
+tokens_per_message = 3
+tokens_per_name = 1
+tokens_per_reply = 3
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str=default_model):
+    """ A function to load the encoding of a model once and reuse it afterwards.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print(f"Warning: model {model} not found. Using cl100k_base encoding.")  # Terminal Error message for debugging
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_string(string: str, model: str=default_model) -> int:
+    """ A function to return the number of tokens in a text string.
+    """
+    return len(get_encoding(model).encode(string))
+
+
+def num_tokens_from_messages(messages: list, model: str=default_model) -> int:
+    """ A function to return the number of prompt tokens of chat messages, including the tokens added by the chat format.
+    """
+    num_tokens = tokens_per_reply
+    for message in messages:
+        num_tokens += tokens_per_message
+        for key, value in message.items():
+            num_tokens += num_tokens_from_string(str(value), model)
+            if key == "name":
+                num_tokens += tokens_per_name
+    return num_tokens
+
+
+def document_num_tokens(document, model: str=default_model) -> int:
+    """ A function to return the number of tokens of a document, using the count stored in its metadata at ingestion if available.
+    """
+    num_tokens = document.metadata.get("num_tokens")
+    if num_tokens is None:
+        num_tokens = num_tokens_from_string(document.page_content, model)
+    return num_tokens
+
+
+class CONTEXT_PACKER:
+    """ A class to fill a prompt context up to a token budget from ranked chunks.
+    """
+
+    def __init__(self, budget_tokens: int, separator: str="\n\n", model: str=default_model) -> None:
+        self.budget_tokens = budget_tokens
+        self.separator = separator
+        self.model = model
+        self.separator_tokens = num_tokens_from_string(separator, model)
+
+    def pack(self, documents: list) -> list:
+        """ A method to select chunks in rank order while they fit into the budget. Chunks that do not fit are skipped
+            so that smaller, lower ranked chunks can still use the remaining budget.
+        """
+        packed_documents = []
+        used_tokens = 0
+        for document in documents:
+            num_tokens = document_num_tokens(document, self.model) + (self.separator_tokens if packed_documents else 0)
+            if used_tokens + num_tokens <= self.budget_tokens:
+                packed_documents.append(document)
+                used_tokens += num_tokens
+        return packed_documents
@@ -0,0 +1,311 @@
+""" A python file to trace the stages of ingestion with timed spans.
+    Every span records its duration and attributes such as the bytes, chunks and tokens it handled, and belongs to the trace of a build.
+    Finished spans are appended to a JSON lines file and aggregated per stage, and the aggregates are served in the Prometheus text format.
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+from bisect import bisect_left
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+TRACE_ENABLED = os.environ["TRACE_ENABLED"] == "True"  # Record the spans of the ingestion stages
+TRACE_DIR = os.environ["TRACE_DIR"]  # Directory of the JSON lines file of the finished spans
+TRACE_MAX_MB = float(os.environ["TRACE_MAX_MB"])  # Size of the spans file above which it is rotated
+METRICS_PORT = int(os.environ["METRICS_PORT"])  # Port of the Prometheus text endpoint, 0 disables it
+METRICS_HOST = os.environ["METRICS_HOST"]  # Interface of the Prometheus text endpoint, only the local machine by default
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+trace_file_path = f"{project_root}/{TRACE_DIR}/spans.jsonl"
+
+# Upper bounds in seconds of the buckets of the duration histograms
+duration_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# Span attributes that are summed per stage
+counted_attributes = ["bytes", "chunks", "tokens"]
+
+
+def format_labels(labels: dict) -> str:
+    """ A function to format the labels of a Prometheus sample, escaping their values.
+    """
+    escaped = {key: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for key, value in labels.items()}
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}" if labels else ""
+
+
+class HISTOGRAM:
+    """ A class to count observations in cumulative buckets like a Prometheus histogram, and to estimate their percentiles.
+    """
+
+    def __init__(self, buckets: list=duration_buckets) -> None:
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last bucket counts the observations above every bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        """ A method to estimate a quantile by linear interpolation inside its bucket. Returns None if nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def prometheus_lines(self, name: str, labels: dict) -> list:
+        lines = []
+        cumulative = 0
+        for upper, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': upper})} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+class SPAN:
+    """ A class to hold a timed stage of a trace and its attributes.
+    """
+
+    def __init__(self, name: str, trace_id: str, parent_id: str, attributes: dict) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.duration = None
+        self.status = "ok"
+
+    def set(self, **attributes) -> None:
+        """ A method to add attributes that are only known at the end of the stage.
+        """
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class SPAN_TRACER:
+    """ A class to record nested spans per thread. A span without an open parent on its thread starts a new trace.
+        The totals of every stage are kept for the whole process and for the most recent traces.
+    """
+
+    def __init__(self, trace_file_path: str=trace_file_path, enabled: bool=TRACE_ENABLED, max_bytes: int=int(TRACE_MAX_MB * 2**20),
+                 max_traces: int=100) -> None:
+        self.trace_file_path = trace_file_path
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.max_traces = max_traces
+        self.stages = {}  # Totals and duration histogram of every stage
+        self.traces = OrderedDict()  # Totals of every stage of the most recent traces, oldest first
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _new_span(self, name: str, attributes: dict) -> SPAN:
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        return SPAN(name, parent.trace_id if parent else uuid.uuid4().hex[:16], parent.span_id if parent else None, attributes)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """ A context manager to time a stage as a child of the open span of the thread. Yields the span to set more attributes.
+            Do not yield from a generator while the span is open, since the span would stay open until the generator resumes.
+        """
+        span = self._new_span(name, attributes)
+        stack = self._stack()
+        stack.append(span)
+        start_time = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.status = "error"
+            span.set(error=str(e))
+            raise
+        finally:
+            span.duration = time.perf_counter() - start_time
+            stack.pop()
+            self._finish(span)
+
+    def record(self, name: str, duration: float, **attributes) -> SPAN:
+        """ A method to record a stage that was timed elsewhere, such as in a worker process, as a child of the open span of the thread.
+            Stages that ran in parallel can add up to more than the duration of their parent.
+        """
+        span = self._new_span(name, attributes)
+        span.start_time -= duration
+        span.duration = duration
+        if "error" in attributes:
+            span.status = "error"
+        self._finish(span)
+        return span
+
+    @staticmethod
+    def _new_totals() -> dict:
+        return {"spans": 0, "errors": 0, "seconds": 0.0, **{attribute: 0 for attribute in counted_attributes}}
+
+    @staticmethod
+    def _add_totals(totals: dict, span: SPAN) -> None:
+        totals["spans"] += 1
+        totals["errors"] += span.status == "error"
+        totals["seconds"] += span.duration
+        for attribute in counted_attributes:
+            value = span.attributes.get(attribute)
+            if isinstance(value, (int, float)):
+                totals[attribute] += value
+
+    def _finish(self, span: SPAN) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            stage = self.stages.setdefault(span.name, {**self._new_totals(), "histogram": HISTOGRAM()})
+            self._add_totals(stage, span)
+            stage["histogram"].observe(span.duration)
+
+            trace = self.traces.setdefault(span.trace_id, OrderedDict())
+            self.traces.move_to_end(span.trace_id)
+            if span.parent_id is None:
+                trace["__root__"] = span.name
+            self._add_totals(trace.setdefault(span.name, self._new_totals()), span)
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+
+            self._write(span)
+
+    def _write(self, span: SPAN) -> None:
+        """ A method to append a finished span to the JSON lines file, rotating the file once it exceeds the maximum size. The caller holds the lock.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.trace_file_path), exist_ok=True)
+            if os.path.exists(self.trace_file_path) and os.path.getsize(self.trace_file_path) > self.max_bytes:
+                os.replace(self.trace_file_path, f"{self.trace_file_path}.1")
+            with open(self.trace_file_path, "a") as f:
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+        except OSError as e:
+            print(f"Unable to write span {span.name}: {e}")
+
+    @staticmethod
+    def _breakdown(stages: dict, root_seconds: float) -> list:
+        return [{
+            "Stage": name,
+            "Spans": totals["spans"],
+            "Seconds": round(totals["seconds"], 4),
+            "Share": round(totals["seconds"] / root_seconds, 4) if root_seconds else 0.0,
+            "Bytes": totals["bytes"],
+            "Chunks": totals["chunks"],
+            "Tokens": totals["tokens"],
+            "Errors": totals["errors"],
+        } for name, totals in stages.items()]
+
+    def stage_breakdown(self, trace_id: str) -> list:
+        """ A method to return the totals of every stage of a recent trace, in the order the stages first finished.
+            The share of every stage is relative to the duration of the root span. Returns an empty list for an unknown trace.
+        """
+        with self._lock:
+            trace = self.traces.get(trace_id)
+            if trace is None:
+                return []
+            root = trace.get("__root__")
+            stages = {name: dict(totals) for name, totals in trace.items() if name != "__root__"}
+        root_seconds = stages[root]["seconds"] if root in stages else sum(totals["seconds"] for totals in stages.values())
+        return self._breakdown(stages, root_seconds)
+
+    def stage_totals(self, root: str="run_db_build") -> list:
+        """ A method to return the totals of every stage since the process started, with shares relative to the total duration of the root stage.
+        """
+        with self._lock:
+            stages = {name: {key: value for key, value in stage.items() if key != "histogram"} for name, stage in self.stages.items()}
+        return self._breakdown(stages, stages[root]["seconds"] if root in stages else 0.0)
+
+    def to_prometheus(self) -> str:
+        """ A method to export the totals and duration histograms of every stage in the Prometheus text format.
+        """
+        with self._lock:
+            stages = {name: {**stage, "histogram": stage["histogram"]} for name, stage in self.stages.items()}
+            lines = ["# HELP ingestion_stage_duration_seconds Duration of the spans of every ingestion stage",
+                     "# TYPE ingestion_stage_duration_seconds histogram"]
+            for name, stage in stages.items():
+                lines.extend(stage["histogram"].prometheus_lines("ingestion_stage_duration_seconds", {"stage": name}))
+        for counter in ["errors"] + counted_attributes:
+            lines.append(f"# HELP ingestion_stage_{counter}_total Total {counter} of the spans of every ingestion stage")
+            lines.append(f"# TYPE ingestion_stage_{counter}_total counter")
+            lines.extend(f"ingestion_stage_{counter}_total{format_labels({'stage': name})} {stage[counter]}" for name, stage in stages.items())
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide tracer shared by every ingestion
+tracer = SPAN_TRACER()
+
+# Functions whose Prometheus text is concatenated by the metrics endpoint
+metrics_collectors = [tracer.to_prometheus]
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+class METRICS_HANDLER(BaseHTTPRequestHandler):
+    """ A class to serve the Prometheus text of every metrics collector on /metrics.
+    """
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = "".join(collector() for collector in metrics_collectors).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def start_metrics_server(port: int=METRICS_PORT, host: str=METRICS_HOST):
+    """ A function to serve the metrics endpoint from a background thread, once per process.
+        Returns the server, or None if the port is 0 or cannot be bound.
+    """
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is None and port:
+            try:
+                _metrics_server = ThreadingHTTPServer((host, port), METRICS_HANDLER)
+                threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()
+                print(f"Serving metrics on {host}:{port}")
+            except OSError as e:
+                print(f"Unable to serve metrics on {host}:{port}: {e}")
+        return _metrics_server
@@ -1,7 +1,47 @@
-""" A python file to define various utilities with url text extraction."""
+""" A python file to define various utilities with url text extraction.
+    It also provides a crawler that fetches many pages or the pages of a sitemap concurrently, with per-host politeness limits
+    and an on-disk HTTP cache, and streams the extracted text as pages complete.
+"""
+import os
+import io
+import gzip
+import json
+import time
+import hashlib
+import threading
+import contextlib
+import multiprocessing
+import xml.etree.ElementTree as ET
+from urllib.parse import urlparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import requests
+from requests.adapters import HTTPAdapter
 import trafilatura
 from trafilatura.settings import use_config
 from courlan import validate_url, check_url
+from dotenv import load_dotenv, find_dotenv
+
+_ = load_dotenv(find_dotenv())  # read local .env file
+
+# Load Environment Variables
+CRAWLER_CACHE_DIR = os.environ["CRAWLER_CACHE_DIR"]  # Directory of the HTTP cache of the crawled pages
+CRAWLER_MAX_CONNECTIONS = int(os.environ["CRAWLER_MAX_CONNECTIONS"])  # Number of pages downloaded at the same time
+CRAWLER_HOST_CONNECTIONS = int(os.environ["CRAWLER_HOST_CONNECTIONS"])  # Number of pages downloaded at the same time from a single host
+CRAWLER_HOST_DELAY = float(os.environ["CRAWLER_HOST_DELAY"])  # Minimum seconds between the start of two requests to a single host
+CRAWLER_EXTRACTION_WORKERS = int(os.environ["CRAWLER_EXTRACTION_WORKERS"])  # Number of processes extracting the text of downloaded pages
+CRAWLER_TIMEOUT = float(os.environ["CRAWLER_TIMEOUT"])  # Seconds to wait for a page to download
+
+# Get the absolute path to the project root directory
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+http_cache_path = f"{project_root}/{CRAWLER_CACHE_DIR}"
+
+# Instantiate the config for trafilatura once, since reading it is slow
+trafilatura_config = use_config()
+trafilatura_config.set("DEFAULT", "EXTRACTION_TIMEOUT", "0")
+
+user_agent = "Mozilla/5.0 (compatible; document-summarization-and-qna crawler)"
 
 def validate_input_url(url):
     """A simple function to validate the url"""
@@ -10,7 +50,10 @@ def validate_input_url(url):
 def validate_youtube_url(url):
     """A simple function to validate Youtube urls"""
     if validate_url(url)[0]:
-        domain = check_url(url)[1]
+        checked_url = check_url(url)
+        if checked_url is None:
+            return False
+        domain = checked_url[1]
         if domain == "youtube.com" or domain == "youtu.be":
             return True
         else:
@@ -18,19 +61,231 @@ def validate_youtube_url(url):
     else:
         return False
 
+def is_sitemap_url(url):
+    """A simple function to check whether a URL points to an XML sitemap"""
+    return urlparse(url).path.lower().endswith((".xml", ".xml.gz"))
+
 def extract_text_url(url):
     """A function to extract the text content from given URL"""
 
-    # Instantiate config for trafilatura
-    config = use_config()
-
-    # Setting the default configuration
-    config.set("DEFAULT", "EXTRACTION_TIMEOUT", "0")
-
     # Download the Web content from the URL
     download_web = trafilatura.fetch_url(url)
 
     # Extract the main text content from the download web content
-    extracted_text = trafilatura.extract(download_web, config=config)
+    extracted_text = trafilatura.extract(download_web, config=trafilatura_config)
+
+    return extracted_text
+
+def _extract_html(content: bytes) -> tuple:
+    """ A function to extract the main text content of a downloaded page and return it with the extraction time.
+        It is defined at module level so that it can run in a process pool.
+    """
+    start_time = time.perf_counter()
+    extracted_text = trafilatura.extract(content, config=trafilatura_config)
+    return extracted_text, time.perf_counter() - start_time
+
+
+class HTTP_CACHE:
+    """ A class to keep the downloaded pages on disk with their validators, so that pages are only downloaded again if they changed.
+        Every page is stored as a gzip file of its body next to a JSON file of its ETag and Last-Modified headers.
+    """
+
+    def __init__(self, cache_dir: str=http_cache_path) -> None:
+        self.cache_dir = cache_dir  # Entry directories are created as pages are stored
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, url: str) -> dict:
+        """ A method to return the cached validators and body of a URL, or None if it is not cached.
+        """
+        path = self._path(url)
+        try:
+            with open(f"{path}.json", "r") as f:
+                entry = json.load(f)
+            with gzip.open(f"{path}.gz", "rb") as f:
+                entry["content"] = f.read()
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url: str, content: bytes, etag: str=None, last_modified: str=None) -> None:
+        """ A method to store the body of a URL with its validators. Files are replaced atomically so that readers never see a partial entry.
+        """
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_suffix = f".{threading.get_ident()}.tmp"
+        with gzip.open(f"{path}.gz{temp_suffix}", "wb", compresslevel=5) as f:
+            f.write(content)
+        with open(f"{path}.json{temp_suffix}", "w") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "fetched_time": time.time()}, f)
+        os.replace(f"{path}.gz{temp_suffix}", f"{path}.gz")
+        os.replace(f"{path}.json{temp_suffix}", f"{path}.json")
+
+
+class HOST_LIMITER:
+    """ A class to limit the number of concurrent requests to every host and to space out the start of its requests.
+    """
+
+    def __init__(self, max_connections: int=CRAWLER_HOST_CONNECTIONS, min_interval: float=CRAWLER_HOST_DELAY) -> None:
+        self.max_connections = max_connections
+        self.min_interval = min_interval
+        self._semaphores = {}
+        self._next_times = {}  # Earliest start time of the next request of every host
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self, host: str):
+        """ A context manager to wait for a free connection of the host and for its next start time.
+        """
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.BoundedSemaphore(self.max_connections))
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                start_time = max(now, self._next_times.get(host, now))
+                self._next_times[host] = start_time + self.min_interval
+            time.sleep(start_time - now)
+            yield
+
+
+class WEB_CRAWLER:
+    """ A class to download and extract many web pages concurrently over pooled connections.
+        Downloads run on a pool of threads within the per-host limits, and revalidate cached pages with conditional requests.
+        The text of the downloaded pages is extracted in a pool of processes, and results are yielded as soon as they are ready.
+    """
+
+    def __init__(self, max_connections: int=CRAWLER_MAX_CONNECTIONS, extraction_workers: int=CRAWLER_EXTRACTION_WORKERS,
+                 host_limiter: HOST_LIMITER=None, cache: HTTP_CACHE=None, timeout: float=CRAWLER_TIMEOUT) -> None:
+        self.max_connections = max_connections
+        self.extraction_workers = extraction_workers
+        self.host_limiter = host_limiter if host_limiter is not None else HOST_LIMITER()
+        self.cache = cache if cache is not None else HTTP_CACHE()
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = user_agent
+        self.stats = {"downloaded": 0, "not_modified": 0, "failed": 0, "bytes": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, **counts) -> None:
+        with self._lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def fetch(self, url: str) -> dict:
+        """ A method to download a page, or reuse its cached body if the server reports that it is not modified.
+            Returns the body and whether it came from the cache. Raises an exception if the download fails.
+        """
+        cached = self.cache.get(url)
+        headers = {}
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self.host_limiter.slot(urlparse(url).netloc):
+            start_time = time.perf_counter()
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            fetch_time = time.perf_counter() - start_time
+
+        if response.status_code == 304 and cached is not None:
+            self._count(not_modified=1)
+            return {"content": cached["content"], "from_cache": True, "fetch_time": fetch_time}
+        response.raise_for_status()
+        content = response.content
+        self.cache.put(url, content, etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+        self._count(downloaded=1, bytes=len(content))
+        return {"content": content, "from_cache": False, "fetch_time": fetch_time}
+
+    def sitemap_urls(self, sitemap_url: str, max_urls: int=None) -> list:
+        """ A method to list the page URLs of a sitemap, following nested sitemap indexes. Gzipped sitemaps are supported.
+        """
+        urls = OrderedDict()
+        pending = [sitemap_url]
+        visited = set()
+        while pending and (max_urls is None or len(urls) < max_urls):
+            url = pending.pop(0)
+            if url in visited:
+                continue
+            visited.add(url)
+            try:
+                content = self.fetch(url)["content"]
+                if content[:2] == b"\x1f\x8b":
+                    content = gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+                root = ET.fromstring(content)
+            except Exception as e:
+                print(f"Unable to read sitemap {url}: {e}")
+                continue
+            # Sitemap tags are namespaced, so they are matched by their local name
+            is_index = root.tag.rsplit("}", 1)[-1] == "sitemapindex"
+            for element in root.iter():
+                if element.tag.rsplit("}", 1)[-1] == "loc" and element.text:
+                    location = element.text.strip()
+                    if is_index:
+                        pending.append(location)
+                    else:
+                        urls[location] = None
+        return list(urls)[:max_urls]
+
+    def crawl(self, urls, max_in_flight: int=None):
+        """ A generator to download and extract the pages of the URLs, yielding a result for every page in the order they complete.
+            Every result has the url, the extracted text, whether the page came from the cache, its size and timings, and an error message if it failed.
+            At most max_in_flight pages are downloaded or extracted at a time, so that memory stays bounded for large sites.
+        """
+        max_in_flight = max_in_flight or 4 * self.max_connections
+        url_iterator = iter(dict.fromkeys(urls))
+        fetches = {}
+        extractions = {}
+
+        with contextlib.ExitStack() as stack:
+            fetch_pool = stack.enter_context(ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix="crawler"))
+            # Extraction runs in-thread with a single worker, since a process pool would only add overhead.
+            # The pool is spawned rather than forked, since the download threads may hold the locks of the connection pool
+            extract_pool = stack.enter_context(ProcessPoolExecutor(max_workers=self.extraction_workers, mp_context=multiprocessing.get_context("spawn"))) \
+                if self.extraction_workers > 1 else None
+
+            def fill():
+                while len(fetches) + len(extractions) < max_in_flight:
+                    url = next(url_iterator, None)
+                    if url is None:
+                        return
+                    fetches[fetch_pool.submit(self.fetch, url)] = url
+
+            fill()
+            while fetches or extractions:
+                done, _ = wait(list(fetches) + list(extractions), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in fetches:
+                        url = fetches.pop(future)
+                        try:
+                            page = future.result()
+                        except Exception as e:
+                            self._count(failed=1)
+                            yield {"url": url, "text": None, "from_cache": False, "bytes": 0, "fetch_time": 0.0, "extraction_time": 0.0,
+                                   "error": f"Download failed: {e}"}
+                            continue
+                        if extract_pool is not None:
+                            extractions[extract_pool.submit(_extract_html, page["content"])] = (url, page)
+                        else:
+                            yield self._result(url, page, lambda: _extract_html(page["content"]))
+                    else:
+                        url, page = extractions.pop(future)
+                        yield self._result(url, page, future.result)
+                fill()
 
-    return extracted_text
\ No newline at end of file
+    @staticmethod
+    def _result(url: str, page: dict, extract) -> dict:
+        """ A method to run or collect the extraction of a downloaded page and build its result.
+        """
+        try:
+            text, extraction_time = extract()
+            error = None if text else "Unable to extract text content"
+        except Exception as e:
+            text, extraction_time, error = None, 0.0, f"Extraction failed: {e}"
+        return {"url": url, "text": text, "from_cache": page["from_cache"], "bytes": len(page["content"]), "fetch_time": page["fetch_time"],
+                "extraction_time": extraction_time, "error": error}
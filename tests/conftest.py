@@ -0,0 +1,8 @@
+""" Shared setup of the tests. The modules of src and the offline backends of the benchmarks are imported by name, as the app and the benchmarks do.
+"""
+
+import os
+import sys
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path[:0] = [os.path.join(project_root, "src"), os.path.join(project_root, "benchmarks")]
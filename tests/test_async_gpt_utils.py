@@ -0,0 +1,147 @@
+""" Tests of the retries, rate limits, hedging and deadlines of the asyncio Open AI client, run against a local stub of the chat completions.
+"""
+
+import time
+import uuid
+import asyncio
+import openai
+import pytest
+import async_gpt_utils
+from async_gpt_utils import ASYNC_OPENAI_CLIENT, TOKEN_BUCKET
+from telemetry_utils import llm_telemetry
+from offline_backends import STUB_LLM
+
+messages = [{"role": "user", "content": "What is in the documents?"}]
+
+
+class SCRIPTED_LLM(STUB_LLM):
+    """ A stub whose successive requests follow a script of latencies in seconds or exceptions to raise.
+        Requests beyond the script use the last step, and cancelled requests are counted.
+    """
+
+    def __init__(self, steps: list) -> None:
+        super().__init__()
+        self.steps = steps
+        self.models = []
+        self.num_cancelled = 0
+
+    async def acreate(self, model: str, messages: list, max_tokens: int=None, **kwargs):
+        step = self.steps[min(self.num_requests, len(self.steps) - 1)]
+        self.num_requests += 1
+        self.models.append(model)
+        if isinstance(step, Exception):
+            raise step
+        try:
+            await asyncio.sleep(step)
+        except asyncio.CancelledError:
+            self.num_cancelled += 1
+            raise
+        return openai.util.convert_to_openai_object(self._response(model, messages, max_tokens))
+
+
+def make_client(**kwargs) -> ASYNC_OPENAI_CLIENT:
+    """ A function to create a client with rate limits of its own, since the buckets are shared by api key.
+    """
+    client = ASYNC_OPENAI_CLIENT(api_key=f"test-{uuid.uuid4().hex}", **{"rpm_limit": 10000, "tpm_limit": 10**7, **kwargs})
+    client.hedge_min_samples = 10**9  # Always hedge after the default delay
+    client.hedge_default_delay = 0.05
+    return client
+
+
+def tail_events(event: str, model: str) -> int:
+    return sum(count for (name, event_model, _), count in llm_telemetry.tail_events.items() if name == event and event_model == model)
+
+
+def rate_limit_error() -> openai.error.RateLimitError:
+    return openai.error.RateLimitError("Rate limit reached", http_status=429)
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(async_gpt_utils, "base_backoff", 0.01)
+
+
+def test_rate_limited_request_is_retried():
+    stub = SCRIPTED_LLM([rate_limit_error(), rate_limit_error(), 0.0])
+    client = make_client(max_retries=3)
+    with stub.installed():
+        response = asyncio.run(client.acompletion(model="gpt-3.5-turbo", messages=messages, estimated_tokens=10))
+    assert response["choices"][0]["message"]["content"]
+    assert stub.num_requests == 3
+    assert client.retry_count == 2
+
+
+def test_rate_limited_request_fails_after_max_retries():
+    stub = SCRIPTED_LLM([rate_limit_error()])
+    client = make_client(max_retries=2)
+    with stub.installed(), pytest.raises(openai.error.RateLimitError):
+        asyncio.run(client.acompletion(model="gpt-3.5-turbo", messages=messages, estimated_tokens=10))
+    assert stub.num_requests == 3
+
+
+def test_invalid_request_is_not_retried():
+    stub = SCRIPTED_LLM([openai.error.InvalidRequestError("Bad request", param=None, http_status=400)])
+    client = make_client(max_retries=3)
+    with stub.installed(), pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(client.acompletion(model="gpt-3.5-turbo", messages=messages, estimated_tokens=10))
+    assert stub.num_requests == 1
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TOKEN_BUCKET(capacity_per_minute=6000)  # Refills 100 per second
+
+    async def drain_and_acquire():
+        await bucket.acquire(6000)
+        start_time = time.monotonic()
+        await bucket.acquire(20)
+        return time.monotonic() - start_time
+
+    assert asyncio.run(drain_and_acquire()) >= 0.15
+
+
+def test_token_bucket_caps_amount_and_refunds():
+    bucket = TOKEN_BUCKET(capacity_per_minute=60)
+    asyncio.run(bucket.acquire(1000))  # Capped to the capacity instead of waiting forever
+    assert bucket.available < 1
+    bucket.refund(30)
+    assert bucket._try_acquire(30) == 0.0
+
+
+def test_clients_of_an_api_key_share_rate_limits():
+    first, second = ASYNC_OPENAI_CLIENT(api_key="test-shared"), ASYNC_OPENAI_CLIENT(api_key="test-shared")
+    assert first.request_bucket is second.request_bucket and first.token_bucket is second.token_bucket
+    assert make_client().token_bucket is not first.token_bucket
+
+
+def test_hedge_wins_and_slow_request_is_cancelled():
+    stub = SCRIPTED_LLM([1.0, 0.0])
+    client = make_client()
+    model = "test-hedge-model"
+    with stub.installed():
+        response = asyncio.run(client.ahedged_completion(model=model, messages=messages, deadline=0.5, estimated_tokens=10))
+    assert response["model"] == model
+    assert stub.num_requests == 2
+    assert stub.num_cancelled == 1
+    assert tail_events("hedge_won", model) == 1
+
+
+def test_deadline_falls_back_to_other_model():
+    stub = SCRIPTED_LLM([1.0, 1.0, 0.0])
+    client = make_client()
+    model, fallback_model = "test-deadline-model", "test-fallback-model"
+    start_time = time.monotonic()
+    with stub.installed():
+        response = asyncio.run(client.ahedged_completion(model=model, messages=messages, fallback_model=fallback_model, deadline=0.2, estimated_tokens=10))
+    assert time.monotonic() - start_time < 0.8
+    assert response["model"] == fallback_model
+    assert stub.models == [model, model, fallback_model]
+    assert stub.num_cancelled == 2
+    assert tail_events("timeout", model) == 1 and tail_events("fallback", fallback_model) == 1
+
+
+def test_deadline_without_fallback_raises_timeout():
+    stub = SCRIPTED_LLM([1.0])
+    client = make_client()
+    with stub.installed(), pytest.raises(openai.error.Timeout):
+        asyncio.run(client.ahedged_completion(model="test-timeout-model", messages=messages, deadline=0.2, estimated_tokens=10))
+    assert stub.num_cancelled == 2
@@ -0,0 +1,48 @@
+""" Tests of the build lock that serializes the builds of a collection across threads and processes.
+"""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+import pytest
+import collection_utils
+from collection_utils import build_lock
+
+src_path = os.path.dirname(collection_utils.__file__)
+
+
+@pytest.mark.skipif(collection_utils.fcntl is None, reason="Builds are only serialized within the process without fcntl")
+def test_build_lock_waits_for_other_process(tmp_path):
+    db_path = str(tmp_path / "db")
+    holder = subprocess.Popen([sys.executable, "-c", "import sys, time\n"
+                               f"sys.path.insert(0, {src_path!r})\n"
+                               "from collection_utils import build_lock\n"
+                               f"with build_lock({db_path!r}):\n"
+                               "    print('locked', flush=True)\n"
+                               "    time.sleep(0.5)\n"],
+                              stdout=subprocess.PIPE, text=True)
+    assert holder.stdout.readline().strip() == "locked"
+    start_time = time.monotonic()
+    with build_lock(db_path):
+        waited = time.monotonic() - start_time
+    holder.wait()
+    assert waited >= 0.3
+
+
+def test_build_lock_is_reentrant_and_excludes_other_threads(tmp_path):
+    db_path = str(tmp_path / "db")
+    acquired = threading.Event()
+
+    def acquire():
+        with build_lock(db_path):
+            acquired.set()
+
+    with build_lock(db_path):
+        with build_lock(db_path):
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            assert not acquired.wait(0.2)
+    thread.join(timeout=5)
+    assert acquired.is_set()
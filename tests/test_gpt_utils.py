@@ -0,0 +1,61 @@
+""" Tests of the streamed completions of the GPT utilities.
+"""
+
+import uuid
+import asyncio
+import pytest
+from openai.util import convert_to_openai_object
+from gpt_utils import COMPLETION_STREAM, GPT_UTILS
+from cache_utils import RESPONSE_CACHE
+from offline_backends import STUB_LLM
+
+
+class MODEL_LATENCY_LLM(STUB_LLM):
+    """ A stub that answers every model after a latency of its own.
+    """
+
+    def __init__(self, latencies: dict) -> None:
+        super().__init__()
+        self.latencies = latencies
+
+    async def acreate(self, model: str, messages: list, max_tokens: int=None, **kwargs):
+        self.num_requests += 1
+        await asyncio.sleep(self.latencies[model])
+        return convert_to_openai_object(self._response(model, messages, max_tokens))
+
+
+def test_failed_stream_is_not_completed():
+    completed = []
+
+    def chunks():
+        yield "partial "
+        raise ConnectionError("Connection reset")
+
+    stream = COMPLETION_STREAM(chunks(), model="gpt-3.5-turbo", on_complete=completed.append)
+    with pytest.raises(ConnectionError):
+        for _ in stream:
+            pass
+    assert stream.content == "partial "
+    assert completed == [] and stream.total_tokens is None
+
+
+def test_consumed_stream_is_completed():
+    completed = []
+    stream = COMPLETION_STREAM(["full ", "answer"], model="gpt-3.5-turbo", usage={"total_tokens": 5}, extra_tokens=2, on_complete=completed.append)
+    assert "".join(stream) == "full answer"
+    assert completed == [stream] and stream.total_tokens == 7
+
+
+def test_fallback_answer_is_not_cached_for_selected_model(tmp_path):
+    gpt = GPT_UTILS(api_key=f"test-{uuid.uuid4().hex}", use_response_cache=False, use_semantic_cache=False, tail_latency_mode=True)
+    gpt.response_cache = RESPONSE_CACHE(cache_dir=str(tmp_path))
+    gpt.async_client.deadline = 0.2
+    gpt.async_client.hedge_default_delay = 0.05
+    gpt.async_client.hedge_min_samples = 10**9
+    messages = [{"role": "user", "content": "Summarize the documents."}]
+    stub = MODEL_LATENCY_LLM({gpt.default_model: 1.0, gpt.large_context_model: 0.0})
+    with stub.installed():
+        response = gpt.get_completion_from_messages(messages, max_tokens=50)
+    assert response["model"] == gpt.large_context_model
+    assert gpt.response_cache.get(gpt.response_cache.make_key(gpt.default_model, messages, 0.5, 50, [])) is None
+    assert gpt.response_cache.get(gpt.response_cache.make_key(gpt.large_context_model, messages, 0.5, 50, [])) is not None